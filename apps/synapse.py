@@ -1,9 +1,440 @@
 #!/usr/bin/env python
+import json
 from constructs import Construct
-from utils import EcsServiceStack
+from imports.aws.lb import Lb
+from imports.aws.lb_listener import LbListener, LbListenerDefaultAction
+from imports.aws.lb_target_group import LbTargetGroup, LbTargetGroupHealthCheck
+from imports.aws.security_group_rule import SecurityGroupRule
+from imports.aws.service_discovery_instance import ServiceDiscoveryInstance
+from imports.aws.service_discovery_service import ServiceDiscoveryService, ServiceDiscoveryServiceDnsConfig, ServiceDiscoveryServiceDnsConfigDnsRecords
+from utils import DOCKER_HUB, EcsServiceStack, parse_image
 from cdktf import Fn, TerraformOutput, Token
 
+# API Gateway route keys per Synapse endpoint group (converted to path rules behind the ALB), see
+# https://matrix-org.github.io/synapse/latest/workers.html#available-worker-applications
+# anything not matched here falls through to the main process catch-all route
+SYNAPSE_ENDPOINT_GROUPS = {
+    "sync": [
+        "GET /_matrix/client/{version}/sync",
+        "GET /_matrix/client/{version}/events",
+        "GET /_matrix/client/{version}/initialSync",
+        "GET /_matrix/client/{version}/rooms/{room_id}/initialSync"
+    ],
+    "federation": [
+        "ANY /_matrix/federation/{proxy+}",
+        "ANY /_matrix/key/v2/{proxy+}"
+    ],
+    "client": [
+        "GET /_matrix/client/{version}/rooms/{room_id}/messages",
+        "GET /_matrix/client/{version}/rooms/{room_id}/members",
+        "GET /_matrix/client/{version}/rooms/{room_id}/state",
+        "GET /_matrix/client/{version}/rooms/{room_id}/context/{proxy+}",
+        "GET /_matrix/client/{version}/rooms/{room_id}/event/{proxy+}",
+        "GET /_matrix/client/{version}/rooms/{room_id}/relations/{proxy+}",
+        "ANY /_matrix/client/{version}/publicRooms",
+        "POST /_matrix/client/{version}/search",
+        "POST /_matrix/client/{version}/user_directory/search",
+        "GET /_matrix/client/{version}/profile/{proxy+}",
+        "POST /_matrix/client/{version}/keys/query",
+        "POST /_matrix/client/{version}/keys/changes",
+        "POST /_matrix/client/{version}/keys/claim",
+        "ANY /_matrix/client/{version}/login"
+    ],
+    "media": [
+        "ANY /_matrix/media/{proxy+}",
+        "ANY /_matrix/client/v1/media/{proxy+}"
+    ]
+}
+
+# default worker pools, overridable per pool through service_config["workers"]
+SYNAPSE_WORKER_POOLS = {
+    "generic-worker": {
+        "count": 2,
+        "endpoint_groups": ["client", "federation"],
+        "resources": ["client", "federation"],
+        "cache_role": "client",
+        "worker_config": {}
+    },
+    "synchrotron": {
+        "count": 1,
+        "endpoint_groups": ["sync"],
+        "resources": ["client"],
+        "cache_role": "sync",
+        "worker_config": {}
+    },
+    "media-repository": {
+        "count": 1,
+        "endpoint_groups": ["media"],
+        "resources": ["media", "client"],
+        "cache_role": "media",
+        "worker_config": {"enable_media_repo": True}
+    },
+    # outbound only, its worker_name goes into federation_sender_instances of the main config
+    "federation-sender": {
+        "count": 1,
+        "endpoint_groups": [],
+        "resources": ["replication"],
+        "worker_name": "federation_sender1",
+        "federation_sender": True,
+        "cache_role": "federation_sender",
+        "worker_config": {}
+    }
+}
+
+# upstream images, without synapse-s3-storage-provider
+SYNAPSE_STOCK_IMAGES = {(DOCKER_HUB, "matrixdotorg/synapse"), ("ghcr.io", "element-hq/synapse")}
+
+WORKER_PORT = 8083
+METRICS_PORT = 9000
+# main process replication listener, workers reach it through <service_name>-replication.<namespace_name>
+REPLICATION_PORT = 9093
+
+# synapse log lines: "<time> - <logger> - <line> - <level> - <request> - <message>"
+SYNAPSE_LOG_ROUTING = {
+    "access_pattern": r"\s-\ssynapse\.access\.",
+    "cloudwatch_pattern": r"\s-\s(WARNING|ERROR|CRITICAL)\s-\s"
+}
+
+# synapse metrics that become cloudwatch metrics with the EMF exporter: per servlet latency, cache hit rates
+SYNAPSE_METRIC_DECLARATIONS = [
+    {"dimensions": [["service", "servlet", "method"]],
+     "metric_name_selectors": ["^synapse_http_server_response_time_seconds$",
+                               "^synapse_http_server_requests_received(_total)?$"]},
+    {"dimensions": [["service", "name"]],
+     "metric_name_selectors": ["^synapse_util_caches_cache(_hits|_size|_evicted_size)?$"]}
+]
+
+# ALB rule priorities: worker pool rules in blocks of 100 ahead of the main process catch-all
+ALB_POOL_PRIORITY_BLOCK = 100
+ALB_MAIN_PRIORITY = 50000
+
+# per process role: python/twisted baseline in MiB, share of the remaining memory given to caches,
+# and the caches that matter most for the role
+SYNAPSE_CACHE_PROFILES = {
+    "main": {"baseline": 256, "cache_share": 0.6, "per_cache_factors": {
+        "get_users_who_share_room_with_user": 2.0}},
+    "client": {"baseline": 192, "cache_share": 0.6, "per_cache_factors": {
+        "get_users_who_share_room_with_user": 2.0,
+        "get_rooms_for_user": 2.0}},
+    "sync": {"baseline": 192, "cache_share": 0.7, "per_cache_factors": {
+        "get_users_who_share_room_with_user": 4.0,
+        "get_rooms_for_user": 4.0,
+        "get_current_state_ids": 2.0}},
+    "federation_sender": {"baseline": 160, "cache_share": 0.5, "per_cache_factors": {
+        "get_users_in_room": 2.0,
+        "get_current_hosts_in_room": 2.0}},
+    "media": {"baseline": 192, "cache_share": 0.2, "per_cache_factors": {}}
+}
+
+
+def synapse_cache_config(memory_hard: int, memory_soft: int, role: str):
+    # derives synapse cache sizing from the container memory (MiB) and the process role.
+    # returns (environment, config fragment)
+    profile = SYNAPSE_CACHE_PROFILES[role]
+    if memory_hard <= profile["baseline"]:
+        raise ValueError(f"memory_hard {memory_hard}MiB leaves no room for {role} caches "
+                         f"(baseline {profile['baseline']}MiB)")
+
+    # caches aim for the reserved memory, and may grow towards the hard limit before eviction
+    target_mb = max(int((memory_soft - profile["baseline"]) * profile["cache_share"]), 32)
+    max_mb = max(int((memory_hard - profile["baseline"]) * profile["cache_share"]), target_mb)
+
+    # synapse default factor 0.5 is sized for roughly 1GiB of cache
+    global_factor = round(min(max(max_mb / 1024 * 0.5, 0.1), 10.0), 2)
+    environment = [{"name": "SYNAPSE_CACHE_FACTOR", "value": str(global_factor)}]
+    config = {
+        # a quarter of the budget for events, at ~8KiB each in memory
+        "event_cache_size": f"{max(max_mb * 32 // 1000, 1)}K",
+        "caches": {
+            "per_cache_factors": profile["per_cache_factors"],
+            # needs jemalloc, preloaded by the process wrapper
+            "cache_autotuning": {
+                "max_cache_memory_usage": f"{max_mb}M",
+                "target_cache_memory_usage": f"{target_mb}M",
+                "min_cache_ttl": "5m"
+            }
+        }
+    }
+    return environment, config
+
 
 class SynapseStack(EcsServiceStack):
     def __init__(self, scope: Construct, ns: str, provider_config: dict, state_config: dict, service_config: dict):
-        super().__init__(scope, ns, provider_config, state_config, service_config)
+        # every process loads the S3 storage provider at startup and would fail without it
+        if "media_store" in service_config and parse_image(service_config["image"])[:2] in SYNAPSE_STOCK_IMAGES:
+            raise ValueError(f"media_store needs an image with synapse-s3-storage-provider, "
+                             f"{service_config['image']} does not ship it")
+
+        # synapse metrics endpoint for the metrics sidecar of every process. without workers the main process
+        # metrics listener (type metrics, port METRICS_PORT) lives in homeserver.yaml, with workers the main
+        # process listeners are generated, see _main_replication_config
+        if "metrics" in service_config:
+            service_config = {**service_config, "metrics": {
+                "port": METRICS_PORT,
+                "path": "/_synapse/metrics",
+                "namespace": "Synapse",
+                "metric_declarations": SYNAPSE_METRIC_DECLARATIONS,
+                **service_config["metrics"]
+            }}
+
+        if "log_router" in service_config:
+            service_config = {**service_config, "log_router": {**SYNAPSE_LOG_ROUTING, **service_config["log_router"]}}
+
+        # main process, created by EcsServiceStack with the shared config fragment
+        super().__init__(scope, ns, provider_config, state_config, self._main_process_config(service_config))
+
+        # add the worker pools next to it
+        self._worker_services = {}
+        for index, (pool_name, pool_overrides) in enumerate(service_config.get("workers", {}).items()):
+            pool_config = self._worker_pool_config(service_config, pool_name, pool_overrides)
+            pool_config.setdefault("alb_priority", 1 + index * ALB_POOL_PRIORITY_BLOCK)
+            self._initWorkerPool(pool_name, pool_config)
+
+    def _initWorkerPool(self, pool_name: str, pool_config: dict):
+        construct_suffix = f"_{pool_name}"
+        routes = [route for group in pool_config["endpoint_groups"] for route in SYNAPSE_ENDPOINT_GROUPS[group]]
+        target_group = None
+        if routes and "alb_listener_arns" in pool_config:
+            target_group = self._initTargetGroup(pool_config, construct_suffix)
+
+        reg_srv = self._initServiceDiscovery(pool_config, construct_suffix)
+        self._worker_services[pool_name] = self._initEcsService(self._region,
+                                                                pool_config["subnets_ids"],
+                                                                pool_config["sec_group_id"],
+                                                                self._log_group_name,
+                                                                pool_config,
+                                                                reg_srv.arn,
+                                                                construct_suffix,
+                                                                target_group)
+        self._initAutoScaling(pool_config, self._worker_services[pool_name], construct_suffix, target_group)
+
+        if target_group:
+            self._initListenerRules(pool_config["service_name"],
+                                    pool_config["alb_listener_arns"],
+                                    target_group.arn,
+                                    routes,
+                                    pool_config["alb_priority"])
+        elif routes:
+            self._initGatewayRoute(pool_config["service_name"],
+                                   pool_config["api_gw_id"],
+                                   pool_config["vpc_link_id"],
+                                   reg_srv.arn,
+                                   routes)
+
+    def _initExtraTargets(self, service_config: dict):
+        # the main process replication listener behind an internal NLB, registered as a Cloud Map CNAME: bridge
+        # mode tasks only get SRV records, while instance_map needs a fixed host and port
+        if not service_config.get("workers"):
+            return []
+        service_name = service_config["service_name"]
+        replication_name = f"{service_name}-replication"
+        nlb = Lb(self, "NLB_Replication",
+                 name=replication_name[:32],
+                 load_balancer_type="network",
+                 internal=True,
+                 subnets=service_config["subnets_ids"],
+                 enable_cross_zone_load_balancing=True)
+        target_group = LbTargetGroup(self, "TargetGroup_Replication",
+                                     name=replication_name[:32],
+                                     vpc_id=service_config["vpc_id"],
+                                     port=REPLICATION_PORT,
+                                     protocol="TCP",
+                                     target_type="ip" if service_config.get("network_mode") == "awsvpc" else "instance",
+                                     deregistration_delay="30",
+                                     health_check=LbTargetGroupHealthCheck(protocol="TCP",
+                                                                           interval=10,
+                                                                           healthy_threshold=2,
+                                                                           unhealthy_threshold=2))
+        LbListener(self, "Listener_Replication",
+                   load_balancer_arn=nlb.arn,
+                   port=REPLICATION_PORT,
+                   protocol="TCP",
+                   default_action=[LbListenerDefaultAction(type="forward", target_group_arn=target_group.arn)])
+
+        # NLB health checks (and forwarded traffic of ip targets) come from the NLB addresses in the vpc
+        SecurityGroupRule(self, "Replication_Ingress",
+                          description="Synapse replication",
+                          security_group_id=service_config["sec_group_id"],
+                          from_port=REPLICATION_PORT,
+                          to_port=REPLICATION_PORT,
+                          protocol="tcp",
+                          cidr_blocks=[service_config["vpc_cidr"]],
+                          type="ingress")
+
+        reg_srv = ServiceDiscoveryService(self, "ServiceDiscovery_Replication",
+                                          name=replication_name,
+                                          dns_config=ServiceDiscoveryServiceDnsConfig(
+                                              namespace_id=service_config["ns_id"],
+                                              dns_records=[
+                                                  ServiceDiscoveryServiceDnsConfigDnsRecords(
+                                                      ttl=15,
+                                                      type="CNAME")
+                                              ],
+                                              routing_policy="WEIGHTED"
+                                          ))
+        ServiceDiscoveryInstance(self, "ServiceDiscovery_Replication_NLB",
+                                 instance_id=replication_name,
+                                 service_id=reg_srv.id,
+                                 attributes={"AWS_INSTANCE_CNAME": nlb.dns_name})
+        return [(target_group, REPLICATION_PORT)]
+
+    @staticmethod
+    def _shared_config(service_config: dict):
+        # config every synapse process loads on top of the homeserver.yaml kept on EFS
+        shared_config = {}
+
+        # replication between the main process and workers goes through redis pub/sub
+        if "redis_host" in service_config:
+            shared_config["redis"] = {
+                "enabled": True,
+                "host": service_config["redis_host"],
+                "port": service_config.get("redis_port", 6379)
+            }
+
+        if "metrics" in service_config:
+            shared_config["enable_metrics"] = True
+
+        # media in S3, the local media store only acts as a cache
+        media_store = service_config.get("media_store")
+        if media_store:
+            shared_config["media_store_path"] = media_store["cache_path"]
+            shared_config["media_storage_providers"] = [{
+                "module": "s3_storage_provider.S3StorageProviderBackend",
+                "store_local": True,
+                "store_remote": True,
+                "store_synchronous": not media_store.get("async_upload", True),
+                "config": {
+                    "bucket": media_store["bucket_name"],
+                    "region_name": media_store["region"]
+                }
+            }]
+        return shared_config
+
+    @staticmethod
+    def _process_config(service_config: dict, app: str, role: str, process_config: dict):
+        # cache sizing follows the memory of this process
+        cache_env, cache_config = synapse_cache_config(service_config["memory_hard"], service_config["memory_soft"], role)
+        process_config = {**cache_config, **process_config}
+
+        # the generated config is json (hence valid yaml), rendered in the container next to the shared
+        # homeserver.yaml and passed as a second --config-path
+        env_vars = service_config["env_vars"]
+        # the container starts as root to prepare the scratch volumes, synapse itself runs as 991 (gosu ships with
+        # the image)
+        prepare = ""
+        if "media_store" in service_config:
+            cache_path = service_config["media_store"]["cache_path"]
+            prepare = f"mkdir -p {cache_path} && chown 991:991 {cache_path} && "
+        overrides = {
+            "env_vars": (env_vars if isinstance(env_vars, list) else [env_vars]) + cache_env + [
+                {"name": "SYNAPSE_WORKER", "value": app},
+                {"name": "SYNAPSE_WORKER_CONFIG", "value": json.dumps(process_config)}
+            ],
+            "entry_point": ["/bin/sh", "-c"],
+            # jemalloc as in the image entrypoint, cache autotuning relies on it
+            "command": [
+                prepare +
+                'JEMALLOC=/usr/lib/$(uname -m)-linux-gnu/libjemalloc.so.2'
+                ' && if [ -f "$JEMALLOC" ]; then export LD_PRELOAD="$JEMALLOC"; fi'
+                ' && echo "$SYNAPSE_WORKER_CONFIG" | sed "s/@HOSTNAME@/$(hostname)/" > /tmp/worker.yaml'
+                f' && exec gosu 991:991 python -m "$SYNAPSE_WORKER" --config-path={service_config["mount_path"]}/homeserver.yaml'
+                ' --config-path=/tmp/worker.yaml'
+            ]
+        }
+        # local media cache lives on task scratch storage, not on EFS
+        if "media_store" in service_config:
+            overrides["scratch_volumes"] = {"media-cache": cache_path}
+        return overrides
+
+    @classmethod
+    def _main_process_config(cls, service_config: dict):
+        process_config = cls._shared_config(service_config)
+
+        # a dedicated media worker pool takes over the media repository
+        if "media-repository" in service_config.get("workers", {}):
+            process_config["enable_media_repo"] = False
+        # workers replicate through the main process
+        if service_config.get("workers"):
+            process_config.update(cls._main_replication_config(service_config))
+            # a fixed host port in bridge mode as well, the NLB target group forwards to it
+            service_config = {**service_config, "extra_port_mappings": [
+                {"protocol": "tcp", "containerPort": REPLICATION_PORT, "hostPort": REPLICATION_PORT}]}
+        # the main process takes whatever no worker rule matched
+        service_config = {"alb_priority": ALB_MAIN_PRIORITY, **service_config}
+        return {**service_config, **cls._process_config(service_config, "synapse.app.homeserver", "main", process_config)}
+
+    @staticmethod
+    def _main_replication_config(service_config: dict):
+        # workers need the main process replication listener in instance_map. generated listeners replace the
+        # ones of homeserver.yaml, so they cover the client/federation and metrics listeners too
+        port = service_config["port_mappings"]["containerPort"]
+        listeners = [
+            {"type": "http", "port": port, "x_forwarded": True, "resources": [{"names": ["client", "federation"]}]},
+            # not routed by the ingress, only reachable through the internal NLB
+            {"type": "http", "port": REPLICATION_PORT, "resources": [{"names": ["replication"]}]}
+        ]
+        if "metrics" in service_config:
+            listeners.append({"type": "metrics", "port": service_config["metrics"]["port"]})
+        config = {
+            "listeners": listeners,
+            "instance_map": {"main": {"host": f"{service_config['service_name']}-replication."
+                                              f"{service_config['namespace_name']}",
+                                      "port": REPLICATION_PORT}}
+        }
+
+        # only the listed federation senders send federation traffic, the main process stops sending it.
+        # the names are fixed, so such a pool runs a single process
+        senders = []
+        for pool_name, pool_overrides in service_config["workers"].items():
+            pool = {**SYNAPSE_WORKER_POOLS.get(pool_name, {}), **pool_overrides}
+            if not pool.get("federation_sender"):
+                continue
+            if "worker_name" not in pool or pool.get("count", 1) > 1 or "scaling" in pool:
+                raise ValueError(f"Synapse federation sender pool '{pool_name}' needs a fixed worker_name and a "
+                                 f"single task, its name is listed in federation_sender_instances")
+            senders.append(pool["worker_name"])
+        if senders:
+            config["federation_sender_instances"] = senders
+        return config
+
+    @classmethod
+    def _worker_pool_config(cls, service_config: dict, pool_name: str, pool_overrides: dict):
+        if pool_name not in SYNAPSE_WORKER_POOLS and "endpoint_groups" not in pool_overrides:
+            raise ValueError(f"Unknown synapse worker pool '{pool_name}', set its endpoint_groups explicitly")
+
+        # start from the main service, then pool defaults, then explicit overrides.
+        # scaling is per pool and never inherited from the main process
+        main_config = {k: v for k, v in service_config.items() if k not in ("workers", "scaling", "alb_priority")}
+        pool = {**main_config, **SYNAPSE_WORKER_POOLS.get(pool_name, {}), **pool_overrides}
+        port = pool.get("worker_port", WORKER_PORT)
+        service_name = f"{service_config['service_name']}-{pool_name}"
+
+        # worker_name must be unique per process, derive it from the task hostname unless pinned
+        worker_config = {
+            **cls._shared_config(service_config),
+            "worker_app": "synapse.app.generic_worker",
+            "worker_name": pool.get("worker_name", f"{pool_name}-@HOSTNAME@"),
+            "worker_listeners": [{
+                "type": "http",
+                "port": port,
+                "x_forwarded": True,
+                "resources": [{"names": pool["resources"]}]
+            }],
+            **pool["worker_config"]
+        }
+        if "metrics" in pool:
+            worker_config["worker_listeners"].append({"type": "metrics", "port": pool["metrics"]["port"]})
+
+        pool.update({
+            "service_name": service_name,
+            "desired_count": pool["count"],
+            "port": port,
+            # dynamic host port, so several workers can share one instance
+            "port_mappings": {"protocol": "tcp", "containerPort": port, "hostPort": 0},
+            **cls._process_config(pool, worker_config["worker_app"], pool.get("cache_role", "client"), worker_config)
+        })
+        return pool
+
+    @property
+    def worker_services(self):
+        return self._worker_services
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# Matrix client load generator: a swarm of asyncio clients logging in, joining a room, long-polling /sync,
+# sending messages and uploading/downloading media. Reports latency percentiles and throughput per endpoint.
+#
+#   python -m benchmarks.load_bench                                  against https://<apigw_custom_domain>
+#   python -m benchmarks.load_bench https://matrix.example.com --users 50 --duration 120 --room '#load:example.com'
+#   python -m benchmarks.load_bench http://127.0.0.1:8008 --register  against benchmarks.matrix_standin
+#
+# Users are <user-prefix><n> with password <password>, registered first with --register (needs open
+# registration). /sync latency includes the long-poll wait, it is the time until new events are delivered.
+# Standard library only: one keep-alive HTTP/1.1 connection per client for requests and one for /sync.
+import argparse
+import asyncio
+import json
+import math
+import os
+import secrets
+import ssl
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import quote, urlencode, urlsplit
+
+CLIENT_API = "/_matrix/client/v3"
+MEDIA_API = "/_matrix/media/v3"
+
+PERCENTILES = (50, 95, 99)
+
+
+class HttpConnection:
+    # a single keep-alive HTTP/1.1 connection, requests are sent one after the other
+    def __init__(self, base_url: str, timeout: float = 60.0):
+        url = urlsplit(base_url)
+        self._tls = url.scheme == "https"
+        self._host = url.hostname
+        self._port = url.port or (443 if self._tls else 80)
+        self._host_header = url.netloc
+        self._timeout = timeout
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: dict = None):
+        # returns (status, headers, body). an idle connection closed by the server is reopened once
+        for attempt in range(2):
+            reused = self._writer is not None
+            try:
+                return await asyncio.wait_for(self._request(method, path, body, headers or {}), self._timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                if not reused or attempt:
+                    raise
+            except asyncio.TimeoutError:
+                await self.close()
+                raise
+
+    async def _request(self, method: str, path: str, body: bytes, headers: dict):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self._host, self._port, ssl=ssl.create_default_context() if self._tls else None)
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self._host_header}", f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        self._writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readuntil(b"\r\n")
+        status = int(status_line.split(b" ", 2)[1])
+        response_headers = {}
+        while True:
+            line = await self._reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            response_body = b"".join(chunks)
+        else:
+            response_body = await self._reader.readexactly(int(response_headers.get("content-length", 0)))
+
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, response_headers, response_body
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+def percentile(values: list, p: float):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+class LoadStats:
+    # endpoint -> latencies in seconds, failed requests
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        if ok:
+            self.latencies[endpoint].append(seconds)
+        else:
+            self.errors[endpoint] += 1
+
+    def report(self, duration: float):
+        # endpoint -> {count, errors, rps, p50_ms, p95_ms, p99_ms}
+        report = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[endpoint]
+            report[endpoint] = {"count": len(latencies),
+                                "errors": self.errors[endpoint],
+                                "rps": round(len(latencies) / duration, 2) if duration else 0.0,
+                                **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) if latencies else None
+                                   for p in PERCENTILES}}
+        return report
+
+
+class MatrixClient:
+    def __init__(self, base_url: str, stats: LoadStats, timeout: float = 60.0):
+        self._stats = stats
+        self._http = HttpConnection(base_url, timeout)
+        # /sync long-polls on its own connection
+        self._sync_http = HttpConnection(base_url, timeout)
+        self._access_token = None
+        self.user_id = None
+        self._txn = 0
+
+    async def _call(self, endpoint: str, method: str, path: str, content=None, content_type: str = None,
+                    connection: HttpConnection = None):
+        # returns the decoded json (or raw bytes) of a 2xx response, None otherwise
+        headers = {}
+        if self._access_token:
+            headers["Authorization"] = f"Bearer {self._access_token}"
+        if isinstance(content, dict):
+            body, headers["Content-Type"] = json.dumps(content).encode(), "application/json"
+        else:
+            body = content or b""
+            if content_type:
+                headers["Content-Type"] = content_type
+
+        start = time.perf_counter()
+        try:
+            status, response_headers, response = await (connection or self._http).request(method, path, body, headers)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            self._stats.record(endpoint, time.perf_counter() - start, False)
+            return None
+        ok = 200 <= status < 300
+        self._stats.record(endpoint, time.perf_counter() - start, ok)
+        if not ok:
+            return None
+        if response_headers.get("content-type", "").startswith("application/json"):
+            return json.loads(response or b"{}")
+        return response
+
+    def _authenticated(self, response):
+        if response:
+            self._access_token, self.user_id = response["access_token"], response["user_id"]
+        return response is not None
+
+    async def register(self, user: str, password: str):
+        # open registration, m.login.dummy as the only stage
+        return self._authenticated(await self._call("POST /register", "POST", f"{CLIENT_API}/register", {
+            "username": user, "password": password, "auth": {"type": "m.login.dummy"},
+            "inhibit_login": False}))
+
+    async def login(self, user: str, password: str):
+        return self._authenticated(await self._call("POST /login", "POST", f"{CLIENT_API}/login", {
+            "type": "m.login.password", "identifier": {"type": "m.id.user", "user": user}, "password": password}))
+
+    async def join(self, room: str):
+        response = await self._call("POST /join", "POST", f"{CLIENT_API}/join/{quote(room, safe='')}", {})
+        return response and response["room_id"]
+
+    async def send(self, room_id: str, text: str):
+        self._txn += 1
+        path = f"{CLIENT_API}/rooms/{quote(room_id, safe='')}/send/m.room.message/{self._txn}-{secrets.token_hex(4)}"
+        return await self._call("PUT /send", "PUT", path, {"msgtype": "m.text", "body": text})
+
+    async def sync(self, since: str = None, timeout_ms: int = 30000):
+        query = {"timeout": timeout_ms, **({"since": since} if since else {})}
+        return await self._call("GET /sync", "GET", f"{CLIENT_API}/sync?{urlencode(query)}",
+                                connection=self._sync_http)
+
+    async def upload(self, content: bytes, content_type: str = "application/octet-stream"):
+        response = await self._call("POST /upload", "POST", f"{MEDIA_API}/upload", content, content_type)
+        return response and response["content_uri"]
+
+    async def download(self, content_uri: str):
+        server_name, media_id = content_uri.removeprefix("mxc://").split("/", 1)
+        return await self._call("GET /download", "GET", f"{MEDIA_API}/download/{server_name}/{media_id}")
+
+    async def close(self):
+        await self._http.close()
+        await self._sync_http.close()
+
+
+async def run_client(index: int, settings: argparse.Namespace, stats: LoadStats, deadline: float):
+    client = MatrixClient(settings.base_url, stats, settings.timeout)
+    user = f"{settings.user_prefix}{index}"
+    try:
+        if settings.register:
+            await client.register(user, settings.password)
+        if not client.user_id and not await client.login(user, settings.password):
+            return
+        room_id = await client.join(settings.room)
+        if not room_id:
+            return
+
+        async def sync_loop():
+            # long-polls until the deadline, without a since token the first sync is the initial one
+            since = None
+            while time.monotonic() < deadline:
+                timeout_ms = int(min(settings.sync_timeout, max(deadline - time.monotonic(), 0)) * 1000)
+                response = await client.sync(since, timeout_ms)
+                if response:
+                    since = response["next_batch"]
+                else:
+                    await asyncio.sleep(1)
+
+        sync_task = asyncio.create_task(sync_loop())
+        media = os.urandom(settings.media_size)
+        sent = 0
+        while time.monotonic() < deadline:
+            await client.send(room_id, f"load test message {sent} from {user}")
+            sent += 1
+            if settings.media_every and sent % settings.media_every == 0:
+                content_uri = await client.upload(media)
+                if content_uri:
+                    await client.download(content_uri)
+            await asyncio.sleep(settings.message_interval)
+        await sync_task
+    finally:
+        await client.close()
+
+
+async def run_load(settings: argparse.Namespace):
+    # clients start spread over the ramp-up period, all stop at the deadline
+    stats = LoadStats()
+    start = time.monotonic()
+    deadline = start + settings.ramp_up + settings.duration
+
+    async def delayed(index: int):
+        await asyncio.sleep(settings.ramp_up * index / max(settings.users, 1))
+        await run_client(index, settings, stats, deadline)
+
+    await asyncio.gather(*(delayed(index) for index in range(settings.users)))
+    return stats.report(time.monotonic() - start)
+
+
+def print_report(report: dict):
+    print(f"\n{'endpoint':<16} {'count':>7} {'errors':>7} {'req/s':>8} " +
+          " ".join(f"{f'p{p} ms':>9}" for p in PERCENTILES))
+    for endpoint, metrics in report.items():
+        print(f"{endpoint:<16} {metrics['count']:>7} {metrics['errors']:>7} {metrics['rps']:>8} " +
+              " ".join(f"{metrics[f'p{p}_ms'] if metrics[f'p{p}_ms'] is not None else '-':>9}" for p in PERCENTILES))
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description="Matrix client load generator")
+    parser.add_argument("base_url", nargs="?", help="homeserver url, https://<apigw_custom_domain> by default")
+    parser.add_argument("--users", type=int, default=10, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of full load, after the ramp-up")
+    parser.add_argument("--ramp-up", type=float, default=10, help="seconds to start all clients")
+    parser.add_argument("--room", default="#load-test:example.com", help="room alias or id every client joins")
+    parser.add_argument("--user-prefix", default="loadtest")
+    parser.add_argument("--password", default=os.environ.get("LOAD_TEST_PASSWORD", "loadtest"))
+    parser.add_argument("--register", action="store_true", help="register the users before logging in")
+    parser.add_argument("--message-interval", type=float, default=2.0, help="seconds between messages per client")
+    parser.add_argument("--media-every", type=int, default=10, help="upload/download after every n messages, 0 for none")
+    parser.add_argument("--media-size", type=int, default=64 * 1024, help="bytes per upload")
+    parser.add_argument("--sync-timeout", type=float, default=30, help="/sync long-poll timeout in seconds")
+    parser.add_argument("--timeout", type=float, default=60, help="request timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    settings = parser.parse_args(argv)
+    if not settings.base_url:
+        # same .env / environment as main.py
+        from decouple import config
+        settings.base_url = f"https://{config('apigw_custom_domain', default='example.com')}"
+    return settings
+
+
+def main(argv: list = None):
+    settings = parse_args(argv)
+    report = asyncio.run(run_load(settings))
+    if settings.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if not report or any(metrics["errors"] for metrics in report.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
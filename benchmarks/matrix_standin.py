@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# Minimal in-memory Matrix homeserver for testing the load generator offline, not a synapse replacement:
+# any login succeeds, rooms are created on join, /sync only returns the message events of the joined rooms.
+#
+#   python -m benchmarks.matrix_standin --port 8008 [--delay 0.01]
+#   python -m benchmarks.load_bench http://127.0.0.1:8008 --users 20 --duration 30
+import argparse
+import asyncio
+import json
+import secrets
+from urllib.parse import parse_qs, unquote, urlsplit
+
+SERVER_NAME = "standin"
+
+
+class StandinServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0):
+        self._host = host
+        self._port = port
+        # added to every response, a rough stand-in for processing time
+        self._delay = delay
+        self._server = None
+        self._tokens = {}
+        self._rooms = {}
+        self._joined = {}
+        # global event stream, /sync tokens are positions in it
+        self._events = []
+        self._new_events = asyncio.Condition()
+        self._media = {}
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self):
+        return f"http://{self._host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self._host, self._port)
+        return self
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # HTTP/1.1 keep-alive, one request at a time
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, content_type, payload = await self._dispatch(method, target, headers, body)
+                if self._delay:
+                    await asyncio.sleep(self._delay)
+                writer.write(f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                             f"Content-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, target: str, headers: dict, body: bytes):
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        if parts[:4] == ["_matrix", "client", "v3", "login"] and method == "POST" or \
+                parts[:4] == ["_matrix", "client", "v3", "register"] and method == "POST":
+            return self._login(json.loads(body or b"{}"))
+
+        user_id = self._tokens.get(headers.get("authorization", "").removeprefix("Bearer "))
+        if not user_id:
+            return self._error(401, "M_MISSING_TOKEN", "Missing access token")
+
+        if parts[:4] == ["_matrix", "client", "v3", "join"] and len(parts) == 5 and method == "POST":
+            room_id = self._rooms.setdefault(parts[4], f"!{secrets.token_hex(6)}:{SERVER_NAME}")
+            self._joined.setdefault(user_id, set()).add(room_id)
+            return self._json(200, {"room_id": room_id})
+        if parts[:4] == ["_matrix", "client", "v3", "rooms"] and len(parts) == 8 and parts[5] == "send" \
+                and method == "PUT":
+            return await self._send(user_id, parts[4], parts[6], json.loads(body or b"{}"))
+        if parts[:4] == ["_matrix", "client", "v3", "sync"] and method == "GET":
+            return await self._sync(user_id, query)
+        if parts[:4] == ["_matrix", "media", "v3", "upload"] and method == "POST":
+            media_id = secrets.token_hex(8)
+            self._media[media_id] = (headers.get("content-type", "application/octet-stream"), body)
+            return self._json(200, {"content_uri": f"mxc://{SERVER_NAME}/{media_id}"})
+        if parts[:4] == ["_matrix", "media", "v3", "download"] and len(parts) >= 6 and method == "GET":
+            if parts[5] not in self._media:
+                return self._error(404, "M_NOT_FOUND", "Unknown media")
+            content_type, content = self._media[parts[5]]
+            return 200, content_type, content
+        return self._error(404, "M_UNRECOGNIZED", "Unrecognized request")
+
+    def _login(self, request: dict):
+        user = request.get("identifier", {}).get("user") or request.get("username") or secrets.token_hex(4)
+        user_id = user if user.startswith("@") else f"@{user}:{SERVER_NAME}"
+        access_token = secrets.token_urlsafe(16)
+        self._tokens[access_token] = user_id
+        return self._json(200, {"user_id": user_id, "access_token": access_token, "device_id": secrets.token_hex(4)})
+
+    async def _send(self, user_id: str, room_id: str, event_type: str, content: dict):
+        if room_id not in self._joined.get(user_id, set()):
+            return self._error(403, "M_FORBIDDEN", "Not in room")
+        event_id = f"${secrets.token_urlsafe(12)}"
+        async with self._new_events:
+            self._events.append((room_id, {"type": event_type, "sender": user_id, "event_id": event_id,
+                                           "content": content}))
+            self._new_events.notify_all()
+        return self._json(200, {"event_id": event_id})
+
+    async def _sync(self, user_id: str, query: dict):
+        # long-poll: wait up to timeout ms for events in the joined rooms after the since position
+        since = int(query.get("since", 0))
+        timeout = int(query.get("timeout", 0)) / 1000
+
+        def pending():
+            joined = self._joined.get(user_id, set())
+            return [(room_id, event) for room_id, event in self._events[since:] if room_id in joined]
+
+        async with self._new_events:
+            try:
+                await asyncio.wait_for(self._new_events.wait_for(lambda: pending()), timeout)
+            except asyncio.TimeoutError:
+                pass
+            events = pending()
+            next_batch = len(self._events)
+
+        rooms = {}
+        for room_id, event in events:
+            rooms.setdefault(room_id, {"timeline": {"events": []}})["timeline"]["events"].append(event)
+        return self._json(200, {"next_batch": str(next_batch), "rooms": {"join": rooms}})
+
+    @staticmethod
+    def _json(status: int, content: dict):
+        return status, "application/json", json.dumps(content).encode()
+
+    @classmethod
+    def _error(cls, status: int, errcode: str, error: str):
+        return cls._json(status, {"errcode": errcode, "error": error})
+
+
+async def serve(host: str, port: int, delay: float):
+    async with StandinServer(host, port, delay) as server:
+        print(f"matrix stand-in listening on {server.base_url}", flush=True)
+        await asyncio.Event().wait()
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="in-memory Matrix stand-in server for the load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.delay))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
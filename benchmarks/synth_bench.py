@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# Synthesis benchmark for all stacks, runs offline through cdktf.Testing.
+#
+#   python -m benchmarks.synth_bench                     measure all cases and compare to the baseline
+#   python -m benchmarks.synth_bench synapse-service     measure some cases
+#   python -m benchmarks.synth_bench --update-baseline   store the current results as the baseline
+#   python -m benchmarks.synth_bench --update-sizes      store only the json sizes, the part main-test.py checks
+#
+# Timings and RSS depend on the machine, the synthesized json size does not: the committed baseline at least
+# holds json_bytes of every case.
+# Each case runs in its own interpreter, so import time and peak RSS are not shared between stacks.
+import argparse
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "synth_baseline.json")
+
+# allowed growth over the baseline before a metric counts as a regression
+TOLERANCES = {
+    "import_s": 1.5,
+    "synth_s": 1.5,
+    "peak_rss_kb": 1.25,
+    "json_bytes": 1.10
+}
+
+PROVIDER_CONFIG = {"region": "eu-west-1", "profile": "default"}
+STATE_CONFIG = {"region": "eu-west-1", "profile": "default", "bucket": "bench-state"}
+
+
+def cluster_config():
+    return {
+        "cluster_name": "shared",
+        "key_pair_name": "bench",
+        "subnets_ids": ["subnet-1"],
+        "security_groups": ["sg-vpc", "sg-ssh"],
+        "instance_type": "t4g.medium",
+        "ami": {"version": 1},
+        "desired_capacity": 1,
+        "min_capacity": 1,
+        "max_capacity": 4,
+        "capacity_provider": {"target_capacity": 90},
+        "prepull_images": ["matrixdotorg/synapse"],
+        "warm_pool": {"pool_state": "Stopped", "min_size": 1, "max_prepared_capacity": 2},
+        "spot": {
+            "instance_types": [{"type": "t4g.medium"}, {"type": "m6g.medium"}],
+            "on_demand_base": 0,
+            "spot_percentage": 100,
+            "desired_capacity": 0,
+            "min_capacity": 0,
+            "max_capacity": 6,
+            "capacity_provider": {"target_capacity": 100}
+        }
+    }
+
+
+def db_config():
+    return {
+        "db_name": "main-db",
+        "vpc_id": "vpc-1",
+        "preferred_az": "eu-west-1b",
+        "db_subnet_group_name": "db-subnets",
+        "sgroup_source_id": "sg-vpc",
+        "engine_version": "13.6",
+        "storage": 20,
+        "max_storage": 100,
+        "storage_type": "gp3",
+        "monitoring_interval": 60,
+        "instance_class": "db.t4g.micro",
+        "namespace_id": "ns-1",
+        "proxy": {"clients": 12},
+        "proxy_subnets_ids": ["subnet-db-1", "subnet-db-2"]
+    }
+
+
+def ingress_config(ingress: str):
+    if ingress == "alb":
+        return {"vpc_id": "vpc-1",
+                "alb_listener_arns": {443: "arn:aws:elasticloadbalancing:listener/443",
+                                      8448: "arn:aws:elasticloadbalancing:listener/8448"},
+                "alb_arn_suffix": "app/alb-shared/1"}
+    return {"api_gw_id": "api-1", "vpc_link_id": "link-1"}
+
+
+def service_config(generic_workers: int = 2, synchrotrons: int = 1, media_workers: int = 1, ingress: str = "apigw"):
+    # scaled pools start at min_capacity, so it follows the requested count
+    def scaling(count: int):
+        return {"min_capacity": count, "max_capacity": count * 3, "target_tracking": [{"metric": "cpu", "target": 60}]}
+
+    return {
+        "service_name": "synapse",
+        "subnets_ids": ["subnet-1"],
+        "sec_group_id": "sg-vpc",
+        "image": "matrixdotorg/synapse",
+        "cpu": 128,
+        "memory_soft": 512,
+        "memory_hard": 1024,
+        "env_vars": [],
+        "port_mappings": {"protocol": "tcp", "containerPort": 80, "hostPort": 80},
+        "port": 80,
+        "cluster_type": "EC2",
+        "cluster_id": "arn:aws:ecs:eu-west-1:123456789012:cluster/shared",
+        "cluster_name": "shared",
+        "capacity_provider": "cp-ecs-cluster-shared",
+        "ns_id": "ns-1",
+        "namespace_name": "matrix.lan",
+        "vpc_id": "vpc-1",
+        "vpc_cidr": "10.144.0.0/16",
+        **ingress_config(ingress),
+        "route_key": "ANY /{proxy+}",
+        "health_check": {"path": "/health"},
+        "efs_id": "fs-1",
+        "access_point_id": "fsap-1",
+        "mount_path": "/data",
+        "redis_host": "synapse-cache.matrix.lan",
+        "workers": {
+            "generic-worker": {"count": generic_workers, "scaling": scaling(generic_workers)},
+            "synchrotron": {"count": synchrotrons, "scaling": scaling(synchrotrons)},
+            "media-repository": {"count": media_workers},
+            "federation-sender": {"count": 1}
+        }
+    }
+
+
+# case name -> (module, stack class, stack id, constructor arguments after provider/state config)
+CASES = {
+    "vpc": ("shared.vpc", "VpcStack", "vpc",
+            lambda: ["1.2.3.4/32", "matrix.lan", "t4g.medium"]),
+    "apigw": ("shared.apigw", "ApiGatewayStack", "apigw",
+              lambda: [{"security_groups": ["sg-vpc"], "subnets": ["subnet-1", "subnet-2"],
+                        "domain_name": "example.com", "certificate_name": "*.example.com"}]),
+    "alb-ingress": ("shared.alb", "AlbIngressStack", "alb-ingress",
+                    lambda: [{"vpc_id": "vpc-1", "security_groups": ["sg-vpc"], "subnets": ["subnet-1", "subnet-2"],
+                              "domain_name": "example.com", "certificate_name": "*.example.com"}]),
+    "cdn": ("shared.cdn", "CdnStack", "cdn",
+            lambda: [{"domain_name": "example.com", "origin_domain": "origin.example.com",
+                      "certificate_name": "example.com", "well_known_bucket_name": "well-known"}]),
+    "ecs-cluster": ("shared.ecs_cluster", "Ec2EcsClusterStack", "ecs-cluster",
+                    lambda: [cluster_config()]),
+    "rds-postgres": ("data.rds_postgres", "RdsPostgressDbStack", "rds-postgres",
+                     lambda: [db_config(), "1.2.3.4/32"]),
+    "log-archive": ("data.log_archive", "LogArchiveStack", "log-archive",
+                    lambda: [{"bucket_name": "logs", "stream_name": "synapse-logs"}]),
+    "ecr": ("shared.ecr", "EcrStack", "ecr",
+            lambda: [{"mirrors": ["matrixdotorg/synapse", "matrixdotorg/synapse:v1.98.0"]}]),
+    "synapse-service": ("apps.synapse", "SynapseStack", "synapse-service",
+                        lambda: [service_config()]),
+    "synapse-service-large": ("apps.synapse", "SynapseStack", "synapse-service",
+                              lambda: [service_config(generic_workers=40, synchrotrons=20, media_workers=8)]),
+    "synapse-service-alb": ("apps.synapse", "SynapseStack", "synapse-service",
+                            lambda: [service_config(ingress="alb")]),
+    "synapse-service-metrics": ("apps.synapse", "SynapseStack", "synapse-service",
+                                lambda: [{**service_config(), "metrics": {"exporter": "emf"}}]),
+    "synapse-service-awsvpc": ("apps.synapse", "SynapseStack", "synapse-service",
+                               lambda: [{**service_config(), "network_mode": "awsvpc",
+                                         "placement_strategy": ["spread_az", "binpack_memory"],
+                                         "placement_constraints": [{"type": "distinctInstance"}],
+                                         "metrics": {"exporter": "emf"}}]),
+    "synapse-service-log-router": ("apps.synapse", "SynapseStack", "synapse-service",
+                                   lambda: [{**service_config(), "log_router": {
+                                       "delivery_stream": "synapse-logs",
+                                       "delivery_stream_arn": "arn:aws:firehose:eu-west-1:123456789012:deliverystream/synapse-logs",
+                                       "drop": [r"\s-\ssynapse\.storage\.SQL\s-\s"]}}]),
+    "synapse-service-media": ("apps.synapse", "SynapseStack", "synapse-service",
+                              lambda: [{**service_config(), "image": "example/synapse-s3:v1.98.0", "media_store": {
+                                  "bucket_name": "media",
+                                  "bucket_arn": "arn:aws:s3:::media",
+                                  "region": "eu-west-1",
+                                  "cache_path": "/media_cache"}}]),
+    "synapse-service-ecr": ("apps.synapse", "SynapseStack", "synapse-service",
+                            lambda: [{**service_config(), "metrics": {"exporter": "emf"}, "ecr": {
+                                "registry": "123456789012.dkr.ecr.eu-west-1.amazonaws.com",
+                                "mirrors": {"docker.io/matrixdotorg/synapse": "mirror/matrixdotorg/synapse"},
+                                "pull_through": {"public.ecr.aws": "ecr-public"}}}])
+}
+
+
+def synth_case(name: str):
+    # synthesized stack json for a case, in the current process
+    from cdktf import Testing
+    module_name, class_name, stack_id, args = CASES[name]
+    stack_class = getattr(importlib.import_module(module_name), class_name)
+    return Testing.synth(stack_class(Testing.app(), stack_id, PROVIDER_CONFIG, STATE_CONFIG, *args()))
+
+
+def measure_case(name: str):
+    module_name, class_name, stack_id, args = CASES[name]
+    start = time.perf_counter()
+    from cdktf import Testing
+    stack_class = getattr(importlib.import_module(module_name), class_name)
+    imported = time.perf_counter()
+    synthesized = Testing.synth(stack_class(Testing.app(), stack_id, PROVIDER_CONFIG, STATE_CONFIG, *args()))
+    done = time.perf_counter()
+
+    # ru_maxrss is in KiB on linux, the jsii node runtime is a child process. both peaks are per process, the
+    # larger one is reported as their sum was never reached at once
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        "import_s": round(imported - start, 3),
+        "synth_s": round(done - imported, 3),
+        "peak_rss_kb": rss,
+        "json_bytes": len(synthesized)
+    }
+
+
+def run_case(name: str):
+    # measure a case in a fresh interpreter
+    output = subprocess.run([sys.executable, "-m", "benchmarks.synth_bench", "--measure", name],
+                            check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def load_baseline(path: str = BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def find_regressions(results: dict, baseline: dict, tolerances: dict = TOLERANCES):
+    regressions = []
+    for name, metrics in results.items():
+        for metric, limit in tolerances.items():
+            expected = baseline.get(name, {}).get(metric)
+            if expected and metrics[metric] > expected * limit:
+                regressions.append(f"{name}: {metric} {metrics[metric]} > {expected} * {limit}")
+    return regressions
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="cdktf synthesis benchmark")
+    parser.add_argument("cases", nargs="*", help=f"cases to run, one of {list(CASES)}")
+    parser.add_argument("--update-baseline", action="store_true", help="store results as the new baseline")
+    parser.add_argument("--update-sizes", action="store_true", help="store only json_bytes in the baseline")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print(json.dumps(measure_case(args.measure)))
+        return 0
+
+    results = {name: run_case(name) for name in (args.cases or CASES)}
+    for name, metrics in results.items():
+        print(f"{name:<24} " + " ".join(f"{metric}={value}" for metric, value in metrics.items()))
+
+    baseline = load_baseline()
+    if args.update_baseline or args.update_sizes:
+        if args.update_sizes:
+            results = {name: {**baseline.get(name, {}), "json_bytes": metrics["json_bytes"]}
+                       for name, metrics in results.items()}
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump({**baseline, **results}, baseline_file, indent=2, sort_keys=True)
+        return 0
+
+    regressions = find_regressions(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+from cdktf import TerraformOutput
+from constructs import Construct
+from imports.aws.data_aws_iam_policy_document import (DataAwsIamPolicyDocument, DataAwsIamPolicyDocumentStatement,
+                                                      DataAwsIamPolicyDocumentStatementPrincipals)
+from imports.aws.iam_role import IamRole
+from imports.aws.iam_role_policy import IamRolePolicy
+from imports.aws.kinesis_firehose_delivery_stream import (KinesisFirehoseDeliveryStream,
+                                                          KinesisFirehoseDeliveryStreamExtendedS3Configuration)
+from imports.aws.s3_bucket import S3Bucket
+from imports.aws.s3_bucket_lifecycle_configuration import (S3BucketLifecycleConfiguration, S3BucketLifecycleConfigurationRule,
+                                                           S3BucketLifecycleConfigurationRuleExpiration,
+                                                           S3BucketLifecycleConfigurationRuleFilter,
+                                                           S3BucketLifecycleConfigurationRuleTransition)
+from imports.aws.s3_bucket_public_access_block import S3BucketPublicAccessBlock
+from utils import ExtendedTerraformStack
+
+
+# access (and archived application) logs of the FireLens log routers, batched by Firehose into gzipped S3 objects
+class LogArchiveStack(ExtendedTerraformStack):
+    def __init__(self, scope: Construct, ns: str,
+                 provider_config: dict,
+                 state_config: dict,
+                 archive_config: dict):
+        super().__init__(scope, ns, provider_config, state_config)
+
+        self._bucket = S3Bucket(self, "LogBucket", bucket=archive_config["bucket_name"])
+        S3BucketPublicAccessBlock(self, "LogBucket_PublicAccess",
+                                  bucket=self._bucket.id,
+                                  block_public_acls=True,
+                                  block_public_policy=True,
+                                  ignore_public_acls=True,
+                                  restrict_public_buckets=True)
+        S3BucketLifecycleConfiguration(self, "LogBucket_Lifecycle",
+                                       bucket=self._bucket.id,
+                                       rule=[S3BucketLifecycleConfigurationRule(
+                                           id="log-retention",
+                                           status="Enabled",
+                                           filter=S3BucketLifecycleConfigurationRuleFilter(prefix=""),
+                                           transition=[S3BucketLifecycleConfigurationRuleTransition(
+                                               days=archive_config.get("infrequent_access_after_days", 30),
+                                               storage_class="STANDARD_IA")],
+                                           expiration=S3BucketLifecycleConfigurationRuleExpiration(
+                                               days=archive_config.get("retention_days", 365))
+                                       )])
+
+        role = self._init_firehose_role(archive_config["stream_name"])
+
+        # large, compressed batches - few S3 puts, logs land within buffer_interval seconds
+        buffering = archive_config.get("buffering", {})
+        self._stream = KinesisFirehoseDeliveryStream(self, "LogStream",
+                                                     name=archive_config["stream_name"],
+                                                     destination="extended_s3",
+                                                     extended_s3_configuration=KinesisFirehoseDeliveryStreamExtendedS3Configuration(
+                                                         role_arn=role.arn,
+                                                         bucket_arn=self._bucket.arn,
+                                                         buffer_size=buffering.get("size_mb", 64),
+                                                         buffer_interval=buffering.get("interval", 300),
+                                                         compression_format="GZIP",
+                                                         prefix="logs/!{timestamp:yyyy/MM/dd}/",
+                                                         error_output_prefix="errors/!{firehose:error-output-type}/!{timestamp:yyyy/MM/dd}/"))
+
+        TerraformOutput(self, "TerrafromOutput_Log_Stream", value=self._stream.name)
+
+    def _init_firehose_role(self, stream_name: str):
+        assume_role = DataAwsIamPolicyDocument(self, "FirehoseAssumeRolePolicyDoc",
+                                               statement=[DataAwsIamPolicyDocumentStatement(
+                                                   actions=["sts:AssumeRole"],
+                                                   principals=[DataAwsIamPolicyDocumentStatementPrincipals(
+                                                       type="Service",
+                                                       identifiers=["firehose.amazonaws.com"])]
+                                               )])
+        role = IamRole(self, "FirehoseRole",
+                       name=f"role-firehose-{stream_name}",
+                       assume_role_policy=assume_role.json)
+
+        policy_doc = DataAwsIamPolicyDocument(self, "FirehosePolicyDoc",
+                                              statement=[DataAwsIamPolicyDocumentStatement(
+                                                  actions=["s3:AbortMultipartUpload",
+                                                           "s3:GetBucketLocation",
+                                                           "s3:GetObject",
+                                                           "s3:ListBucket",
+                                                           "s3:ListBucketMultipartUploads",
+                                                           "s3:PutObject"],
+                                                  effect="Allow",
+                                                  resources=[self._bucket.arn, f"{self._bucket.arn}/*"]
+                                              )])
+        IamRolePolicy(self, "FirehosePolicy",
+                      name=f"policy-firehose-{stream_name}",
+                      role=role.id,
+                      policy=policy_doc.json)
+        return role
+
+    @property
+    def bucket(self):
+        return self._bucket
+
+    @property
+    def delivery_stream_name(self):
+        return self._stream.name
+
+    @property
+    def delivery_stream_arn(self):
+        return self._stream.arn
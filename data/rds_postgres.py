@@ -3,7 +3,17 @@ from datetime import datetime
 from cdktf import Fn, TerraformOutput, Token, TerraformResourceLifecycle
 from constructs import Construct
 from imports.aws.data_aws_db_snapshot import DataAwsDbSnapshot
+from imports.aws.data_aws_iam_policy_document import DataAwsIamPolicyDocument, DataAwsIamPolicyDocumentStatement, DataAwsIamPolicyDocumentStatementPrincipals
 from imports.aws.db_instance import DbInstance
+from imports.aws.db_parameter_group import DbParameterGroup, DbParameterGroupParameter
+from imports.aws.db_proxy import DbProxy, DbProxyAuth
+from imports.aws.db_proxy_default_target_group import DbProxyDefaultTargetGroup, DbProxyDefaultTargetGroupConnectionPoolConfig
+from imports.aws.db_proxy_target import DbProxyTarget
+from imports.aws.iam_role import IamRole
+from imports.aws.iam_role_policy import IamRolePolicy
+from imports.aws.iam_role_policy_attachment import IamRolePolicyAttachment
+from imports.aws.secretsmanager_secret import SecretsmanagerSecret
+from imports.aws.secretsmanager_secret_version import SecretsmanagerSecretVersion
 from imports.aws.security_group import SecurityGroup
 from imports.aws.security_group_rule import SecurityGroupRule
 from imports.aws.service_discovery_instance import ServiceDiscoveryInstance
@@ -12,6 +22,26 @@ from imports.aws.ssm_parameter import SsmParameter
 from imports.random.provider import RandomProvider
 from imports.random.password import Password
 from utils import ExtendedTerraformStack
+from sizing import DB_INSTANCE_MEMORY_GIB, db_max_connections, db_pool_size_per_client
+
+
+def postgres_parameters(instance_class: str, max_connections: int = None):
+    # tuned for synapse: write heavy event tables on ssd backed storage.
+    # returns {name: (value, apply_method)}, memory values in the units postgres expects (8kB pages / kB)
+    memory_kb = DB_INSTANCE_MEMORY_GIB[instance_class] * 1024 * 1024
+    max_connections = max_connections or db_max_connections(instance_class)
+    return {
+        "max_connections": (str(max_connections), "pending-reboot"),
+        "shared_buffers": (str(memory_kb // 4 // 8), "pending-reboot"),
+        "effective_cache_size": (str(memory_kb * 3 // 4 // 8), "immediate"),
+        "work_mem": (str(max(memory_kb // 4 // max_connections, 4096)), "immediate"),
+        "maintenance_work_mem": (str(min(memory_kb // 16, 2 * 1024 * 1024)), "immediate"),
+        "random_page_cost": ("1.1", "immediate"),
+        "autovacuum_vacuum_scale_factor": ("0.05", "immediate"),
+        "autovacuum_analyze_scale_factor": ("0.02", "immediate"),
+        "autovacuum_vacuum_cost_limit": ("1000", "immediate"),
+        "autovacuum_naptime": ("15", "immediate")
+    }
 
 
 class RdsPostgressDbStack(ExtendedTerraformStack):
@@ -30,6 +60,14 @@ class RdsPostgressDbStack(ExtendedTerraformStack):
         # handle network access
         self._init_security(db_config["vpc_id"], db_config["db_name"], db_config["sgroup_source_id"], home_ip)
 
+        # workload derived parameters, explicit db_config["parameters"] win
+        self._init_parameter_group(db_config)
+
+        # performance insights and enhanced monitoring
+        monitoring_interval = db_config.get("monitoring_interval", 0)
+        monitoring_role = self._init_monitoring_role(db_config["db_name"]) if monitoring_interval else None
+        self._check_storage(db_config)
+
         # create db instance
         db_instance_id = f"rds-postgres-{db_config['db_name']}"
         final_snapshot_str_time = datetime.isoformat(datetime.now()).replace(":", "-")[1:-7]
@@ -37,16 +75,25 @@ class RdsPostgressDbStack(ExtendedTerraformStack):
         last_db_snapshot = DataAwsDbSnapshot(self, "Last_DB_Snapshot",
                                              most_recent=True,
                                              db_instance_identifier=db_instance_id)
-        print("Last snapshot found: ", last_db_snapshot.id)
         self._db_instance = DbInstance(self, "DBInstance",
                                        identifier=db_instance_id,
                                        engine="postgres",
                                        engine_version=db_config["engine_version"],
                                        allocated_storage=db_config["storage"],
                                        max_allocated_storage=db_config["max_storage"],
+                                       storage_type=db_config.get("storage_type"),
+                                       iops=db_config.get("iops"),
+                                       storage_throughput=db_config.get("storage_throughput"),
+                                       parameter_group_name=self._parameter_group.name,
+                                       performance_insights_enabled=db_config.get("performance_insights", False),
+                                       performance_insights_retention_period=7 if db_config.get("performance_insights") else None,
+                                       monitoring_interval=monitoring_interval,
+                                       monitoring_role_arn=monitoring_role.arn if monitoring_role else None,
                                        copy_tags_to_snapshot=True,
                                        db_subnet_group_name=db_config["db_subnet_group_name"],
-                                       availability_zone=db_config["preferred_az"],
+                                       # multi-AZ keeps a synchronous standby in another zone, RDS picks the zones
+                                       multi_az=db_config.get("multi_az", False),
+                                       availability_zone=None if db_config.get("multi_az") else db_config["preferred_az"],
                                        username=self._admin_username,
                                        password=self._admin_pass.result,
                                        skip_final_snapshot=False,
@@ -61,6 +108,11 @@ class RdsPostgressDbStack(ExtendedTerraformStack):
 
         self._initServiceDiscovery(db_config["namespace_id"], db_config["db_name"])
 
+        # optional connection pooling tier in front of the instance
+        self._db_proxy = None
+        if "proxy" in db_config:
+            self._init_proxy(db_config)
+
         TerraformOutput(self, "TerrafromOutput_DB_EndPoint", value=self._db_instance.endpoint)
         TerraformOutput(self, "TerrafromOutput_DB_SGroup", value=self._db_sg.id)
 
@@ -95,21 +147,165 @@ class RdsPostgressDbStack(ExtendedTerraformStack):
                      name=f"/infra/rds-{db_name}/admin-password",
                      value=self._admin_pass.result)
 
+    def _init_parameter_group(self, db_config: dict):
+        db_name = db_config["db_name"]
+        parameters = postgres_parameters(db_config["instance_class"], db_config.get("max_connections"))
+        parameters.update(db_config.get("parameters", {}))
+        self._max_connections = int(parameters["max_connections"][0])
+
+        family = f"postgres{db_config['engine_version'].split('.')[0]}"
+        self._parameter_group = DbParameterGroup(self, "DBParameterGroup",
+                                                 name_prefix=f"pg-{db_name}-{family}-",
+                                                 family=family,
+                                                 parameter=[DbParameterGroupParameter(name=name,
+                                                                                      value=value,
+                                                                                      apply_method=apply_method)
+                                                            for name, (value, apply_method) in sorted(parameters.items())],
+                                                 lifecycle=TerraformResourceLifecycle(create_before_destroy=True))
+
+    def _init_monitoring_role(self, db_name: str):
+        policy_doc_assume_role = DataAwsIamPolicyDocument(self, "Monitoring_AssumeRolePolicyDoc",
+                                                          statement=[DataAwsIamPolicyDocumentStatement(
+                                                              actions=["sts:AssumeRole"],
+                                                              principals=[DataAwsIamPolicyDocumentStatementPrincipals(
+                                                                  type="Service",
+                                                                  identifiers=["monitoring.rds.amazonaws.com"]
+                                                              )]
+                                                          )])
+        monitoring_role = IamRole(self, "MonitoringRole",
+                                  name=f"role-rds-monitoring-{db_name}",
+                                  assume_role_policy=policy_doc_assume_role.json)
+        IamRolePolicyAttachment(self, "MonitoringRole_AttachPolicy",
+                                role=monitoring_role.name,
+                                policy_arn="arn:aws:iam::aws:policy/service-role/AmazonRDSEnhancedMonitoringRole")
+        return monitoring_role
+
+    @staticmethod
+    def _check_storage(db_config: dict):
+        # gp3 below 400GiB has a fixed 3000 IOPS / 125MiB/s baseline, which can't be changed
+        provisioned = db_config.get("iops") or db_config.get("storage_throughput")
+        if db_config.get("storage_type") == "gp3" and provisioned and db_config["storage"] < 400:
+            raise ValueError("gp3 iops/storage_throughput can only be set with 400GiB or more allocated storage")
+
+    def _init_proxy(self, db_config: dict):
+        db_name = db_config["db_name"]
+        proxy_config = db_config["proxy"]
+        connections_percent = proxy_config.get("max_connections_percent", 90)
+
+        # RDS Proxy reads credentials from secrets manager only, mirror the ssm admin credentials there
+        secret = SecretsmanagerSecret(self, "Secret_admin",
+                                      name=f"/infra/rds-{db_name}/admin-credentials",
+                                      recovery_window_in_days=0)
+        SecretsmanagerSecretVersion(self, "Secret_admin_version",
+                                    secret_id=secret.id,
+                                    secret_string=Fn.jsonencode({"username": self._admin_username,
+                                                                 "password": self._admin_pass.result}))
+
+        policy_doc_assume_role = DataAwsIamPolicyDocument(self, "Proxy_AssumeRolePolicyDoc",
+                                                          statement=[DataAwsIamPolicyDocumentStatement(
+                                                              actions=["sts:AssumeRole"],
+                                                              principals=[DataAwsIamPolicyDocumentStatementPrincipals(
+                                                                  type="Service",
+                                                                  identifiers=["rds.amazonaws.com"]
+                                                              )]
+                                                          )])
+        proxy_role = IamRole(self, "ProxyRole",
+                             name=f"role-rds-proxy-{db_name}",
+                             assume_role_policy=policy_doc_assume_role.json)
+        policy_doc_secret = DataAwsIamPolicyDocument(self, "Proxy_SecretPolicyDoc",
+                                                     statement=[DataAwsIamPolicyDocumentStatement(
+                                                         sid="ReadAdminCredentials",
+                                                         actions=["secretsmanager:GetSecretValue"],
+                                                         effect="Allow",
+                                                         resources=[secret.arn]
+                                                     )])
+        IamRolePolicy(self, "ProxyRole_Policy",
+                      name=f"policy-rds-proxy-{db_name}",
+                      role=proxy_role.id,
+                      policy=policy_doc_secret.json)
+
+        # proxy accepts clients from the shared vpc group, and reaches the db through its own group
+        proxy_sg = SecurityGroup(self, "ProxySecurityGroup", name=f"sgroup-{db_name}-proxy", vpc_id=db_config["vpc_id"])
+        SecurityGroupRule(self, "ProxyAccessRule_Ingres",
+                          description="Access to DB Proxy",
+                          type="ingress",
+                          security_group_id=proxy_sg.id,
+                          protocol="tcp",
+                          to_port=5432,
+                          from_port=5432,
+                          source_security_group_id=db_config["sgroup_source_id"])
+        SecurityGroupRule(self, "ProxyAccessRule_Egress",
+                          description="Proxy to DB",
+                          type="egress",
+                          security_group_id=proxy_sg.id,
+                          protocol="tcp",
+                          to_port=5432,
+                          from_port=5432,
+                          source_security_group_id=self._db_sg.id)
+        SecurityGroupRule(self, "DbAccessRule_Proxy",
+                          description="Access from DB Proxy",
+                          type="ingress",
+                          security_group_id=self._db_sg.id,
+                          protocol="tcp",
+                          to_port=5432,
+                          from_port=5432,
+                          source_security_group_id=proxy_sg.id)
+
+        self._db_proxy = DbProxy(self, "DBProxy",
+                                 name=f"rds-proxy-{db_name}",
+                                 engine_family="POSTGRESQL",
+                                 role_arn=proxy_role.arn,
+                                 vpc_subnet_ids=db_config["proxy_subnets_ids"],
+                                 vpc_security_group_ids=[proxy_sg.id],
+                                 idle_client_timeout=proxy_config.get("idle_client_timeout", 1800),
+                                 require_tls=False,
+                                 auth=[DbProxyAuth(auth_scheme="SECRETS",
+                                                   iam_auth="DISABLED",
+                                                   secret_arn=secret.arn)])
+
+        target_group = DbProxyDefaultTargetGroup(self, "DBProxy_TargetGroup",
+                                                 db_proxy_name=self._db_proxy.name,
+                                                 connection_pool_config=DbProxyDefaultTargetGroupConnectionPoolConfig(
+                                                     max_connections_percent=connections_percent,
+                                                     max_idle_connections_percent=proxy_config.get("max_idle_connections_percent", 50),
+                                                     connection_borrow_timeout=proxy_config.get("connection_borrow_timeout", 120)))
+        DbProxyTarget(self, "DBProxy_Target",
+                      db_proxy_name=self._db_proxy.name,
+                      target_group_name=target_group.name,
+                      db_instance_identifier=self._db_instance.identifier)
+
+        # register the proxy under its own name, next to the instance
+        self._proxy_reg_srv = self._new_cname_service(db_config["namespace_id"], f"{db_name}-proxy", "ServiceDiscovery_Proxy")
+        ServiceDiscoveryInstance(self, "ServiceDiscovery_DBProxy",
+                                 instance_id=self._db_proxy.name,
+                                 service_id=self._proxy_reg_srv.id,
+                                 attributes={"AWS_INSTANCE_CNAME": self._db_proxy.endpoint})
+
+        # cp_max every synapse process can use without exhausting the proxy's share of max_connections
+        TerraformOutput(self, "TerrafromOutput_DB_Proxy_EndPoint", value=self._db_proxy.endpoint)
+        TerraformOutput(self, "TerrafromOutput_DB_Proxy_Pool_Size_Per_Client",
+                        value=db_pool_size_per_client(self._max_connections,
+                                                      proxy_config["clients"],
+                                                      connections_percent))
+
+    def _new_cname_service(self, namespace_id: str, service_name: str, construct_id: str):
+        return ServiceDiscoveryService(self, construct_id,
+                                       name=service_name,
+                                       dns_config=ServiceDiscoveryServiceDnsConfig(
+                                           namespace_id=namespace_id,
+                                           dns_records=[
+                                               ServiceDiscoveryServiceDnsConfigDnsRecords(
+                                                   ttl=15,
+                                                   type="CNAME")
+                                           ],
+                                           routing_policy="WEIGHTED"
+                                       ),
+                                       health_check_custom_config=ServiceDiscoveryServiceHealthCheckCustomConfig(
+                                           failure_threshold=1)
+                                       )
+
     def _initServiceDiscovery(self, namespace_id: str, service_name: str):
-        self._reg_srv = ServiceDiscoveryService(self, "ServiceDiscovery",
-                                                name=service_name,
-                                                dns_config=ServiceDiscoveryServiceDnsConfig(
-                                                    namespace_id=namespace_id,
-                                                    dns_records=[
-                                                        ServiceDiscoveryServiceDnsConfigDnsRecords(
-                                                            ttl=15,
-                                                            type="CNAME")
-                                                    ],
-                                                    routing_policy="WEIGHTED"
-                                                ),
-                                                health_check_custom_config=ServiceDiscoveryServiceHealthCheckCustomConfig(
-                                                    failure_threshold=1)
-                                                )
+        self._reg_srv = self._new_cname_service(namespace_id, service_name, "ServiceDiscovery")
         ServiceDiscoveryInstance(self, "ServiceDiscovery_DB",
                                  instance_id=self._db_instance.identifier,
                                  service_id=self._reg_srv.id,
@@ -122,3 +318,15 @@ class RdsPostgressDbStack(ExtendedTerraformStack):
     @property
     def db_instance(self):
         return self._db_instance
+
+    @property
+    def parameter_group(self):
+        return self._parameter_group
+
+    @property
+    def max_connections(self):
+        return self._max_connections
+
+    @property
+    def db_proxy(self):
+        return self._db_proxy
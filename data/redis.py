@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from cdktf import TerraformOutput
+from constructs import Construct
+from imports.aws.elasticache_replication_group import ElasticacheReplicationGroup
+from imports.aws.elasticache_subnet_group import ElasticacheSubnetGroup
+from imports.aws.security_group import SecurityGroup
+from imports.aws.security_group_rule import SecurityGroupRule
+from imports.aws.service_discovery_instance import ServiceDiscoveryInstance
+from imports.aws.service_discovery_service import ServiceDiscoveryService, ServiceDiscoveryServiceDnsConfig, ServiceDiscoveryServiceDnsConfigDnsRecords, ServiceDiscoveryServiceHealthCheckCustomConfig
+from imports.aws.ssm_parameter import SsmParameter
+from utils import ExtendedTerraformStack
+
+REDIS_PORT = 6379
+
+
+class ElastiCacheRedisStack(ExtendedTerraformStack):
+    def __init__(self, scope: Construct, ns: str,
+                 provider_config: dict,
+                 state_config: dict,
+                 cache_config: dict):
+        super().__init__(scope, ns, provider_config, state_config)
+        cache_name = cache_config["cache_name"]
+
+        # handle network access
+        self._init_security(cache_config["vpc_id"], cache_name, cache_config["sgroup_source_id"])
+
+        subnet_group = ElasticacheSubnetGroup(self, "CacheSubnetGroup",
+                                              name=f"subnet-group-{cache_name}",
+                                              subnet_ids=cache_config["subnets_ids"])
+
+        # create redis replication group, used by synapse for worker replication pub/sub and shared caching
+        self._replication_group = ElasticacheReplicationGroup(self, "ReplicationGroup",
+                                                               replication_group_id=f"redis-{cache_name}",
+                                                               description=f"Redis for {cache_name}",
+                                                               engine="redis",
+                                                               engine_version=cache_config["engine_version"],
+                                                               node_type=cache_config["node_type"],
+                                                               num_cache_clusters=cache_config["num_nodes"],
+                                                               automatic_failover_enabled=cache_config["num_nodes"] > 1,
+                                                               # replicas in other zones, failover on zone loss
+                                                               multi_az_enabled=cache_config.get("multi_az", False) and cache_config["num_nodes"] > 1,
+                                                               port=REDIS_PORT,
+                                                               subnet_group_name=subnet_group.name,
+                                                               security_group_ids=[self._cache_sg.id],
+                                                               at_rest_encryption_enabled=True,
+                                                               apply_immediately=True)
+
+        self._init_ssm_params(cache_name)
+
+        self._initServiceDiscovery(cache_config["namespace_id"], cache_name)
+
+        TerraformOutput(self, "TerrafromOutput_Redis_EndPoint", value=self.endpoint)
+        TerraformOutput(self, "TerrafromOutput_Redis_SGroup", value=self._cache_sg.id)
+
+    def _init_security(self, vpc_id: str, cache_name: str, sgroup_source_id: str):
+        self._cache_sg = SecurityGroup(self, "CacheSecurityGroup", name=f"sgroup-{cache_name}", vpc_id=vpc_id)
+        SecurityGroupRule(self, "CacheAccessRule_Ingres",
+                          description="Access to Redis",
+                          type="ingress",
+                          security_group_id=self._cache_sg.id,
+                          protocol="tcp",
+                          to_port=REDIS_PORT,
+                          from_port=REDIS_PORT,
+                          source_security_group_id=sgroup_source_id)
+
+    def _init_ssm_params(self, cache_name: str):
+        SsmParameter(self, "Param_endpoint",
+                     type="String",
+                     name=f"/infra/redis-{cache_name}/endpoint",
+                     value=self.endpoint)
+        SsmParameter(self, "Param_port",
+                     type="String",
+                     name=f"/infra/redis-{cache_name}/port",
+                     value=str(REDIS_PORT))
+
+    def _initServiceDiscovery(self, namespace_id: str, service_name: str):
+        self._reg_srv = ServiceDiscoveryService(self, "ServiceDiscovery",
+                                                name=service_name,
+                                                dns_config=ServiceDiscoveryServiceDnsConfig(
+                                                    namespace_id=namespace_id,
+                                                    dns_records=[
+                                                        ServiceDiscoveryServiceDnsConfigDnsRecords(
+                                                            ttl=15,
+                                                            type="CNAME")
+                                                    ],
+                                                    routing_policy="WEIGHTED"
+                                                ),
+                                                health_check_custom_config=ServiceDiscoveryServiceHealthCheckCustomConfig(
+                                                    failure_threshold=1)
+                                                )
+        ServiceDiscoveryInstance(self, "ServiceDiscovery_Redis",
+                                 instance_id=self._replication_group.replication_group_id,
+                                 service_id=self._reg_srv.id,
+                                 attributes={"AWS_INSTANCE_CNAME": self.endpoint})
+
+    @property
+    def endpoint(self):
+        return self._replication_group.primary_endpoint_address
+
+    @property
+    def port(self):
+        return REDIS_PORT
+
+    @property
+    def cache_security_group_id(self):
+        return self._cache_sg.id
+
+    @property
+    def replication_group(self):
+        return self._replication_group
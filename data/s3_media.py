@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+from cdktf import TerraformOutput
+from constructs import Construct
+from imports.aws.s3_bucket import S3Bucket
+from imports.aws.s3_bucket_lifecycle_configuration import (S3BucketLifecycleConfiguration, S3BucketLifecycleConfigurationRule,
+                                                           S3BucketLifecycleConfigurationRuleAbortIncompleteMultipartUpload,
+                                                           S3BucketLifecycleConfigurationRuleFilter,
+                                                           S3BucketLifecycleConfigurationRuleTransition)
+from imports.aws.s3_bucket_public_access_block import S3BucketPublicAccessBlock
+from imports.aws.s3_bucket_server_side_encryption_configuration import (S3BucketServerSideEncryptionConfigurationA,
+                                                                         S3BucketServerSideEncryptionConfigurationRuleA,
+                                                                         S3BucketServerSideEncryptionConfigurationRuleApplyServerSideEncryptionByDefaultA)
+from utils import ExtendedTerraformStack
+
+
+class S3MediaStoreStack(ExtendedTerraformStack):
+    def __init__(self, scope: Construct, ns: str,
+                 provider_config: dict,
+                 state_config: dict,
+                 media_config: dict):
+        super().__init__(scope, ns, provider_config, state_config)
+
+        self._bucket = S3Bucket(self, "MediaBucket", bucket=media_config["bucket_name"])
+
+        # media is only served through synapse
+        S3BucketPublicAccessBlock(self, "MediaBucket_PublicAccess",
+                                  bucket=self._bucket.id,
+                                  block_public_acls=True,
+                                  block_public_policy=True,
+                                  ignore_public_acls=True,
+                                  restrict_public_buckets=True)
+
+        S3BucketServerSideEncryptionConfigurationA(self, "MediaBucket_Encryption",
+                                                   bucket=self._bucket.id,
+                                                   rule=[S3BucketServerSideEncryptionConfigurationRuleA(
+                                                       apply_server_side_encryption_by_default=S3BucketServerSideEncryptionConfigurationRuleApplyServerSideEncryptionByDefaultA(
+                                                           sse_algorithm="AES256"),
+                                                       bucket_key_enabled=True)])
+
+        # media is written once and read less over time - let S3 tier it
+        self._init_lifecycle(media_config)
+
+        TerraformOutput(self, "TerrafromOutput_Media_Bucket", value=self._bucket.bucket)
+
+    def _init_lifecycle(self, media_config: dict):
+        S3BucketLifecycleConfiguration(self, "MediaBucket_Lifecycle",
+                                       bucket=self._bucket.id,
+                                       rule=[S3BucketLifecycleConfigurationRule(
+                                           id="media-tiering",
+                                           status="Enabled",
+                                           filter=S3BucketLifecycleConfigurationRuleFilter(prefix=""),
+                                           transition=[S3BucketLifecycleConfigurationRuleTransition(
+                                               days=media_config.get("tiering_after_days", 30),
+                                               storage_class="INTELLIGENT_TIERING")],
+                                           abort_incomplete_multipart_upload=S3BucketLifecycleConfigurationRuleAbortIncompleteMultipartUpload(
+                                               days_after_initiation=7)
+                                       )])
+
+    @property
+    def bucket(self):
+        return self._bucket
+
+    @property
+    def bucket_name(self):
+        return self._bucket.bucket
+
+    @property
+    def bucket_arn(self):
+        return self._bucket.arn
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Runs cdktf diff/deploy only for the stacks whose synthesized output changed since their last deploy.
+#
+#   pipenv run python deploy_changed.py diff
+#   pipenv run python deploy_changed.py deploy --auto-approve
+#   pipenv run python deploy_changed.py deploy synapse-service     limit to some stacks (and dependencies)
+#
+# Changed stacks are deployed in dependency order, unchanged dependencies are left out of the deploy.
+import argparse
+import os
+import subprocess
+import sys
+from orchestrator import load_graph, select_stacks
+from synth_cache import CACHE_DIR, SynthCache
+
+
+def cdktf(args: list, env: dict):
+    print("$ cdktf " + " ".join(args), flush=True)
+    return subprocess.run(["cdktf"] + args, env=env).returncode
+
+
+def dependency_order(graph: dict, names: list):
+    # names sorted so every stack comes after its dependencies
+    ordered = []
+
+    def visit(name: str):
+        if name not in ordered:
+            for dependency in graph[name][1]:
+                visit(dependency)
+            ordered.append(name)
+
+    for name in sorted(names):
+        visit(name)
+    return [name for name in ordered if name in names]
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="diff/deploy changed stacks only")
+    parser.add_argument("command", choices=["diff", "deploy"])
+    parser.add_argument("stacks", nargs="*", help="limit to these stacks")
+    parser.add_argument("--auto-approve", action="store_true")
+    parser.add_argument("--outdir", default=os.environ.get("CDKTF_OUTDIR", "cdktf.out"))
+    args = parser.parse_args(argv)
+
+    # every synth below runs incrementally, later ones are served from the cache
+    env = {**os.environ, "incremental": "true"}
+    if args.stacks:
+        env["synth_stacks"] = ",".join(args.stacks)
+
+    if cdktf(["synth"], env):
+        return 1
+
+    # the requested stacks and their dependencies, as synthesized
+    graph = select_stacks(load_graph(args.outdir), args.stacks)
+    cache = SynthCache(CACHE_DIR)
+    pending = dependency_order(graph, [name for name in cache.pending() if name in graph])
+    if not pending:
+        print("No changed stacks")
+        return 0
+    print("Changed stacks: " + ", ".join(pending))
+
+    if args.command == "diff":
+        # cdktf diff takes a single stack
+        return max(cdktf(["diff", name], env) for name in pending)
+
+    # the unchanged dependencies are already deployed
+    deploy_args = ["deploy"] + pending + ["--ignore-missing-stack-dependencies"] + \
+        (["--auto-approve"] if args.auto_approve else [])
+    if cdktf(deploy_args, env):
+        return 1
+    cache.mark_deployed(pending)
+    cache.save()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
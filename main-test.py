@@ -1,9 +1,30 @@
+import asyncio
+import base64
+import json
+import os
 import pytest 
 from cdktf import Testing
+from imports.aws.db_instance import DbInstance
+from imports.aws.db_parameter_group import DbParameterGroup
+from apps.synapse import SynapseStack, synapse_cache_config
+from benchmarks.synth_bench import CASES, TOLERANCES, cluster_config, find_regressions, load_baseline, service_config, synth_case
+from benchmarks.load_bench import LoadStats, MatrixClient, parse_args, percentile, run_load
+from benchmarks.matrix_standin import StandinServer
+from utils import alb_rule_conditions, fluent_bit_config, parse_image
+from synth_cache import SynthCache, incremental_synth
+from sizing import PROFILES, TaskConfig, capacity_profile
+from orchestrator import critical_path, load_graph, orchestrate, select_stacks
+from deploy_changed import dependency_order
+from shared.ecs_cluster import ECS_AMI_PARAMETER, Ec2EcsClusterStack
+from data.rds_postgres import RdsPostgressDbStack, db_max_connections, db_pool_size_per_client, postgres_parameters
 
 # The tests below are example tests, you can find more information at
 # https://cdk.tf/testing
 
+PROVIDER_CONFIG = {"region": "eu-west-1", "profile": "default"}
+STATE_CONFIG = {"region": "eu-west-1", "profile": "default", "bucket": "test-bucket"}
+
+
 class TestMain:
 
     def test_my_app(self):
@@ -22,4 +43,527 @@ class TestMain:
     #    }) 
     
     #def test_check_validity(self):
-    #    assert Testing.to_be_valid_terraform(Testing.full_synth(stack)) 
\ No newline at end of file
+    #    assert Testing.to_be_valid_terraform(Testing.full_synth(stack)) 
+
+
+class TestRdsPostgres:
+
+    db_config = {
+        "db_name": "test-db",
+        "vpc_id": "vpc-123",
+        "preferred_az": "eu-west-1b",
+        "db_subnet_group_name": "db-subnets",
+        "sgroup_source_id": "sg-123",
+        "engine_version": "13.6",
+        "storage": 20,
+        "max_storage": 100,
+        "storage_type": "gp3",
+        "monitoring_interval": 60,
+        "instance_class": "db.t4g.medium",
+        "namespace_id": "ns-123"
+    }
+
+    def synth(self, db_config: dict):
+        stack = RdsPostgressDbStack(Testing.app(), "rds-postgres", PROVIDER_CONFIG, STATE_CONFIG, db_config, "1.2.3.4/32")
+        return Testing.synth(stack)
+
+    def test_parameters_follow_instance_memory(self):
+        small = postgres_parameters("db.t4g.micro")
+        large = postgres_parameters("db.r6g.xlarge")
+        # 25% of 1GiB / 32GiB in 8kB pages
+        assert small["shared_buffers"][0] == "32768"
+        assert large["shared_buffers"][0] == "1048576"
+        assert int(large["effective_cache_size"][0]) == 3 * int(large["shared_buffers"][0])
+        assert small["max_connections"] == (str(db_max_connections("db.t4g.micro")), "pending-reboot")
+        assert int(large["maintenance_work_mem"][0]) == 2 * 1024 * 1024
+
+    def test_pool_size_per_client(self):
+        assert db_pool_size_per_client(112, 10) == 10
+        assert db_pool_size_per_client(112, 500) == 1
+
+    def test_synth_parameter_group(self):
+        synthesized = self.synth(self.db_config)
+        expected = postgres_parameters("db.t4g.medium")
+        resources = json.loads(synthesized)["resource"][DbParameterGroup.TF_RESOURCE_TYPE]
+        parameters = {p["name"]: p["value"] for p in next(iter(resources.values()))["parameter"]}
+        assert parameters == {name: value for name, (value, _) in expected.items()}
+        assert Testing.to_have_resource_with_properties(synthesized, DbInstance.TF_RESOURCE_TYPE, {
+            "storage_type": "gp3",
+            "monitoring_interval": 60
+        })
+
+    def test_parameter_overrides(self):
+        synthesized = self.synth({**self.db_config, "parameters": {"random_page_cost": ("1.0", "immediate")}})
+        resources = json.loads(synthesized)["resource"][DbParameterGroup.TF_RESOURCE_TYPE]
+        parameters = {p["name"]: p["value"] for p in next(iter(resources.values()))["parameter"]}
+        assert parameters["random_page_cost"] == "1.0"
+
+    def test_multi_az_standby(self):
+        synthesized = self.synth({**self.db_config, "multi_az": True})
+        instance = next(iter(json.loads(synthesized)["resource"][DbInstance.TF_RESOURCE_TYPE].values()))
+        assert instance["multi_az"] is True
+        assert "availability_zone" not in instance
+
+    def test_gp3_provisioned_needs_large_volume(self):
+        with pytest.raises(ValueError):
+            self.synth({**self.db_config, "iops": 12000})
+
+
+class TestCapacityProfiles:
+
+    @pytest.mark.parametrize("name", list(PROFILES))
+    def test_profiles_fit(self, name):
+        # metrics collector and log router next to every process
+        profile = capacity_profile(name, sidecars=2)
+        assert profile.db.pool_size >= 5
+        assert profile.db.clients == sum(task.max_count for _, task in profile.service.tasks())
+
+    def test_profile_by_users(self):
+        assert capacity_profile("100").name == "small"
+        assert capacity_profile("2000").name == "large"
+        with pytest.raises(ValueError):
+            capacity_profile("1000000")
+
+    def test_worker_count_keeps_scale_ratio(self):
+        profile = capacity_profile("small", worker_counts={"generic-worker": 3})
+        assert (profile.service.workers["generic-worker"].count, profile.service.workers["generic-worker"].max_count) == (3, 9)
+
+    @pytest.mark.parametrize("overrides", [
+        # main task memory above the usable memory of an a1.medium
+        {"instance_type": "a1.medium"},
+        # 34 processes on 112 connections
+        {"db_instance_class": "db.t4g.micro"},
+        # spot workers beyond the spot ASG max size
+        {"worker_counts": {"generic-worker": 30}}
+    ])
+    def test_impossible_combinations(self, overrides):
+        with pytest.raises(ValueError):
+            capacity_profile("large", sidecars=2, **overrides)
+
+    def test_task_memory_limits(self):
+        with pytest.raises(ValueError):
+            TaskConfig(128, 2048, 1024)
+
+
+class TestSynapseCacheConfig:
+
+    def test_caches_follow_memory(self):
+        small_env, small = synapse_cache_config(1024, 512, "client")
+        large_env, large = synapse_cache_config(4096, 2048, "client")
+        assert float(large_env[0]["value"]) > float(small_env[0]["value"])
+        assert small["caches"]["cache_autotuning"]["max_cache_memory_usage"] == "499M"
+        assert small["caches"]["cache_autotuning"]["target_cache_memory_usage"] == "192M"
+
+    def test_memory_below_baseline_is_rejected(self):
+        with pytest.raises(ValueError):
+            synapse_cache_config(128, 128, "main")
+
+
+class TestSynthSnapshots:
+
+    def resources(self, case: str, resource_type: str):
+        return json.loads(synth_case(case))["resource"][resource_type]
+
+    def test_db_instance_class(self):
+        instances = self.resources("rds-postgres", "aws_db_instance")
+        assert [i["instance_class"] for i in instances.values()] == ["db.t4g.micro"]
+
+    def test_cluster_instance_types(self):
+        groups = self.resources("ecs-cluster", "aws_autoscaling_group")
+        templates = self.resources("ecs-cluster", "aws_launch_template")
+        assert [t["instance_type"] for t in templates.values()] == ["t4g.medium"]
+        spot = [g for g in groups.values() if "mixed_instances_policy" in g]
+        overrides = spot[0]["mixed_instances_policy"]["launch_template"]["override"]
+        assert [o["instance_type"] for o in overrides] == ["t4g.medium", "m6g.medium"]
+
+    def test_cluster_ami_pinned(self):
+        parameters = json.loads(synth_case("ecs-cluster"))["data"]["aws_ssm_parameter"]
+        assert [p["name"] for p in parameters.values()] == [f"{ECS_AMI_PARAMETER}:1"]
+        with pytest.raises(ValueError):
+            Ec2EcsClusterStack(Testing.app(), "ecs-cluster", PROVIDER_CONFIG, STATE_CONFIG, {**cluster_config(), "ami": {}})
+
+    def test_cluster_warm_pool(self):
+        # the warm pool stays on the on-demand group, mixed instances policies can't have one
+        groups = self.resources("ecs-cluster", "aws_autoscaling_group")
+        assert sorted(("warm_pool" in g, "mixed_instances_policy" in g) for g in groups.values()) == [(False, True),
+                                                                                                      (True, False)]
+        warm_pool = [g["warm_pool"] for g in groups.values() if "warm_pool" in g][0]
+        assert warm_pool["pool_state"] == "Stopped"
+        assert warm_pool["instance_reuse_policy"]["reuse_on_scale_in"] is True
+
+        template = list(self.resources("ecs-cluster", "aws_launch_template").values())[0]
+        user_data = base64.b64decode(template["user_data"]).decode()
+        assert "\nECS_IMAGE_PULL_BEHAVIOR=prefer-cached\n" in user_data
+        assert "\nECS_WARM_POOLS_CHECK=true\nEOF\n" in user_data
+        assert "docker pull matrixdotorg/synapse" in user_data
+
+    @pytest.mark.parametrize("case,expected", [
+        ("synapse-service", {"synapse": 1, "synapse-generic-worker": 2, "synapse-synchrotron": 1,
+                             "synapse-media-repository": 1, "synapse-federation-sender": 1}),
+        ("synapse-service-large", {"synapse": 1, "synapse-generic-worker": 40, "synapse-synchrotron": 20,
+                                   "synapse-media-repository": 8, "synapse-federation-sender": 1})
+    ])
+    def test_service_desired_counts(self, case, expected):
+        # scaled pools start at their scaling min_capacity
+        services = self.resources(case, "aws_ecs_service")
+        assert {s["name"]: s["desired_count"] for s in services.values()} == expected
+
+    def test_cache_env_vars(self):
+        task_defs = self.resources("synapse-service", "aws_ecs_task_definition")
+        for task_def in task_defs.values():
+            container = json.loads(task_def["container_definitions"])[0]
+            env = {e["name"]: e["value"] for e in container["environment"]}
+            assert float(env["SYNAPSE_CACHE_FACTOR"]) > 0
+            assert "cache_autotuning" in json.loads(env["SYNAPSE_WORKER_CONFIG"])["caches"]
+
+    def test_media_store(self):
+        task_defs = self.resources("synapse-service-media", "aws_ecs_task_definition")
+        for task_def in task_defs.values():
+            container = json.loads(task_def["container_definitions"])[0]
+            env = {e["name"]: e["value"] for e in container["environment"]}
+            assert json.loads(env["SYNAPSE_WORKER_CONFIG"])["media_storage_providers"][0]["config"]["bucket"] == "media"
+            assert {"sourceVolume": "media-cache", "containerPath": "/media_cache"} in container["mountPoints"]
+
+    def test_media_store_needs_provider_image(self):
+        config = {**service_config(), "media_store": {"bucket_name": "media", "bucket_arn": "arn:aws:s3:::media",
+                                                      "region": "eu-west-1", "cache_path": "/media_cache"}}
+        with pytest.raises(ValueError, match="synapse-s3-storage-provider"):
+            SynapseStack(Testing.app(), "synapse-service", PROVIDER_CONFIG, STATE_CONFIG, config)
+
+    def test_main_replication_config(self):
+        task_defs = self.resources("synapse-service", "aws_ecs_task_definition")
+        main = next(json.loads(t["container_definitions"])[0] for t in task_defs.values() if t["family"] == "synapse")
+        config = json.loads(next(e["value"] for e in main["environment"] if e["name"] == "SYNAPSE_WORKER_CONFIG"))
+        assert config["instance_map"] == {"main": {"host": "synapse-replication.matrix.lan", "port": 9093}}
+        assert config["federation_sender_instances"] == ["federation_sender1"]
+        assert {"type": "http", "port": 9093, "resources": [{"names": ["replication"]}]} in config["listeners"]
+        assert config["enable_media_repo"] is False
+        assert {"protocol": "tcp", "containerPort": 9093, "hostPort": 9093} in main["portMappings"]
+        services = self.resources("synapse-service", "aws_ecs_service")
+        main_service = next(s for s in services.values() if s["name"] == "synapse")
+        assert [lb["container_port"] for lb in main_service["load_balancer"]] == [9093]
+
+    def test_alb_ingress_rules(self):
+        # every routed pool gets a target group (next to the main replication one), rules on both listeners and
+        # no api gateway routes
+        resources = json.loads(synth_case("synapse-service-alb"))["resource"]
+        assert "aws_apigatewayv2_route" not in resources
+        assert sorted(t["name"] for t in resources["aws_lb_target_group"].values()) == [
+            "synapse", "synapse-generic-worker", "synapse-media-repository", "synapse-replication", "synapse-synchrotron"]
+        rules = resources["aws_lb_listener_rule"].values()
+        for listener in ("arn:aws:elasticloadbalancing:listener/443", "arn:aws:elasticloadbalancing:listener/8448"):
+            priorities = [r["priority"] for r in rules if r["listener_arn"] == listener]
+            assert len(priorities) == len(set(priorities))
+            assert max(priorities) == 50000
+
+    def test_cdn_cache_behaviors(self):
+        resources = json.loads(synth_case("cdn"))["resource"]
+        distribution = next(iter(resources["aws_cloudfront_distribution"].values()))
+        behaviors = {b["path_pattern"]: b for b in distribution["ordered_cache_behavior"]}
+        assert set(behaviors) == {"/_matrix/media/*/download/*", "/_matrix/media/*/thumbnail/*", "/.well-known/matrix/*"}
+        assert behaviors["/.well-known/matrix/*"]["target_origin_id"] == "well-known"
+        assert distribution["default_cache_behavior"]["compress"] is True
+        policy = next(iter(resources["aws_cloudfront_cache_policy"].values()))
+        assert policy["min_ttl"] == 86400
+        documents = {o["key"]: json.loads(o["content"]) for o in resources["aws_s3_object"].values()}
+        assert documents[".well-known/matrix/server"] == {"m.server": "example.com:443"}
+
+    def test_metrics_sidecar(self):
+        resources = json.loads(synth_case("synapse-service-metrics"))["resource"]
+        for task_def in resources["aws_ecs_task_definition"].values():
+            service, sidecar = json.loads(task_def["container_definitions"])
+            assert sidecar["links"] == [service["name"]]
+            assert int(task_def["memory"]) == service["memory"] + sidecar["memory"]
+            collector = json.loads(sidecar["environment"][0]["value"])
+            scrape = collector["receivers"]["prometheus"]["config"]["scrape_configs"][0]
+            assert scrape["static_configs"][0]["targets"] == [f"{service['name']}:9000"]
+            assert scrape["metrics_path"] == "/_synapse/metrics"
+        assert "aws_cloudwatch_log_group" in resources
+
+    def test_amp_metrics_need_workspace(self):
+        config = {**service_config(), "metrics": {"exporter": "amp", "amp_workspace_arn": "",
+                                                  "amp_remote_write_url": "https://aps.example.com/api/v1/remote_write"}}
+        with pytest.raises(ValueError, match="amp_workspace_arn"):
+            SynapseStack(Testing.app(), "synapse-service", PROVIDER_CONFIG, STATE_CONFIG, config)
+
+    def test_awsvpc_placement(self):
+        resources = json.loads(synth_case("synapse-service-awsvpc"))["resource"]
+        for task_def in resources["aws_ecs_task_definition"].values():
+            assert task_def["network_mode"] == "awsvpc"
+            service, sidecar = json.loads(task_def["container_definitions"])
+            port = service["portMappings"][0]
+            assert port["hostPort"] == port["containerPort"]
+            assert "links" not in sidecar
+        for service in resources["aws_ecs_service"].values():
+            assert service["network_configuration"]["security_groups"] == ["sg-vpc"]
+            assert [s["type"] for s in service["ordered_placement_strategy"]] == ["spread", "binpack"]
+            assert service["placement_constraints"] == [{"type": "distinctInstance"}]
+
+    def test_log_router(self):
+        resources = json.loads(synth_case("synapse-service-log-router"))["resource"]
+        for task_def in resources["aws_ecs_task_definition"].values():
+            service, router = json.loads(task_def["container_definitions"])
+            assert service["logConfiguration"]["logDriver"] == "awsfirelens"
+            assert router["firelensConfiguration"]["type"] == "fluentbit"
+            config = router["environment"][0]["value"]
+            assert "Exclude log \\s-\\ssynapse\\.storage\\.SQL\\s-\\s" in config
+            assert "delivery_stream synapse-logs" in config
+
+    def test_log_router_patterns_without_spaces(self):
+        with pytest.raises(ValueError):
+            fluent_bit_config("eu-west-1", "logs", "synapse", {"access_pattern": " - synapse.access",
+                                                                "cloudwatch_pattern": "ERROR",
+                                                                "delivery_stream": "logs"})
+
+    def test_alb_rule_conditions(self):
+        rules = alb_rule_conditions(["GET /_matrix/client/{version}/sync", "GET /_matrix/client/{version}/events",
+                                     "ANY /_matrix/federation/{proxy+}", "GET /a/{w}/b/{x}/c/{y}/d/{z}"])
+        assert rules == [("GET", ["/_matrix/client/*/sync", "/_matrix/client/*/events"]),
+                         (None, ["/_matrix/federation/*"]),
+                         ("GET", ["/a/*/b/*/c/*/d/*"])]
+
+    def test_ecr_images(self):
+        # mirrored docker hub images pinned by digest, public.ecr.aws sidecars through the pull-through cache
+        registry = "123456789012.dkr.ecr.eu-west-1.amazonaws.com"
+        task_defs = self.resources("synapse-service-ecr", "aws_ecs_task_definition")
+        images = {c["name"]: c["image"] for t in task_defs.values() for c in json.loads(t["container_definitions"])}
+        assert images["synapse"].startswith(f"{registry}/mirror/matrixdotorg/synapse@${{data.aws_ecr_image.")
+        assert images["adot-collector"] == f"{registry}/ecr-public/aws-observability/aws-otel-collector:v0.40.0"
+        # one digest lookup per mirrored tag, shared by the workers
+        assert len(json.loads(synth_case("synapse-service-ecr"))["data"]["aws_ecr_image"]) == 1
+
+    def test_ecr_mirror_repositories(self):
+        repositories = self.resources("ecr", "aws_ecr_repository")
+        assert [r["name"] for r in repositories.values()] == ["mirror/matrixdotorg/synapse"]
+        rules = self.resources("ecr", "aws_ecr_pull_through_cache_rule")
+        assert [(r["ecr_repository_prefix"], r["upstream_registry_url"]) for r in rules.values()] == \
+            [("ecr-public", "public.ecr.aws")]
+
+    @pytest.mark.parametrize("image,expected", [
+        ("matrixdotorg/synapse", ("docker.io", "matrixdotorg/synapse", "latest", None)),
+        ("redis:7", ("docker.io", "library/redis", "7", None)),
+        ("public.ecr.aws/aws-observability/aws-for-fluent-bit:stable",
+         ("public.ecr.aws", "aws-observability/aws-for-fluent-bit", "stable", None)),
+        ("localhost:5000/synapse@sha256:abc", ("localhost:5000", "synapse", None, "sha256:abc"))
+    ])
+    def test_parse_image(self, image, expected):
+        assert parse_image(image) == expected
+
+
+class TestSynthBenchmark:
+
+    def test_find_regressions(self):
+        baseline = {"vpc": {"synth_s": 1.0, "json_bytes": 1000}}
+        assert find_regressions({"vpc": {"synth_s": 1.2, "json_bytes": 1000, "import_s": 9, "peak_rss_kb": 9}}, baseline) == []
+        assert len(find_regressions({"vpc": {"synth_s": 2.0, "json_bytes": 1200, "import_s": 0, "peak_rss_kb": 0}}, baseline)) == 2
+
+    @pytest.mark.parametrize("case", list(CASES))
+    def test_json_size_within_baseline(self, case):
+        # the synthesized json is deterministic, unlike the timings only checked by the synth_bench cli
+        baseline = load_baseline()
+        assert "json_bytes" in baseline.get(case, {}), \
+            f"no baseline for {case}, record it with: python -m benchmarks.synth_bench --update-sizes {case}"
+        results = {case: {"json_bytes": len(synth_case(case))}}
+        assert find_regressions(results, baseline, {"json_bytes": TOLERANCES["json_bytes"]}) == []
+
+
+class TestLoadBench:
+
+    def test_percentiles(self):
+        values = [i / 1000 for i in range(1, 101)]
+        assert [percentile(values, p) for p in (50, 95, 99)] == [0.05, 0.095, 0.099]
+        stats = LoadStats()
+        stats.record("GET /sync", 0.2, True)
+        stats.record("GET /sync", 1.0, False)
+        assert stats.report(2.0) == {"GET /sync": {"count": 1, "errors": 1, "rps": 0.5,
+                                                   "p50_ms": 200.0, "p95_ms": 200.0, "p99_ms": 200.0}}
+
+    def test_sync_wakes_on_send(self):
+        async def scenario():
+            async with StandinServer() as server:
+                stats = LoadStats()
+                sender, receiver = MatrixClient(server.base_url, stats), MatrixClient(server.base_url, stats)
+                for client, user in ((sender, "alice"), (receiver, "bob")):
+                    assert await client.login(user, "secret")
+                room_id = await sender.join("#room:standin")
+                assert await receiver.join("#room:standin") == room_id
+                since = (await receiver.sync(timeout_ms=0))["next_batch"]
+                poll = asyncio.create_task(receiver.sync(since, timeout_ms=10000))
+                await asyncio.sleep(0.1)
+                await sender.send(room_id, "hello")
+                response = await asyncio.wait_for(poll, 5)
+                content_uri = await sender.upload(b"media")
+                downloaded = await receiver.download(content_uri)
+                await sender.close()
+                await receiver.close()
+                return response, downloaded
+
+        response, downloaded = asyncio.run(scenario())
+        events = next(iter(response["rooms"]["join"].values()))["timeline"]["events"]
+        assert [e["content"]["body"] for e in events] == ["hello"]
+        assert downloaded == b"media"
+
+    def test_swarm_against_standin(self):
+        async def swarm():
+            async with StandinServer() as server:
+                return await run_load(parse_args([server.base_url, "--users", "4", "--duration", "1",
+                                                  "--ramp-up", "0.2", "--room", "#load:standin", "--register",
+                                                  "--message-interval", "0.1", "--media-every", "2",
+                                                  "--sync-timeout", "0.5"]))
+
+        report = asyncio.run(swarm())
+        assert set(report) == {"POST /register", "POST /join", "GET /sync", "PUT /send", "POST /upload",
+                               "GET /download"}
+        assert all(metrics["errors"] == 0 and metrics["count"] > 0 for metrics in report.values())
+        assert report["POST /register"]["count"] == 4
+        assert report["PUT /send"]["p50_ms"] <= report["PUT /send"]["p99_ms"]
+
+
+# builders for the incremental synth tests, outputs depend on BUILD_INPUTS
+BUILD_INPUTS = {"vpc": 1, "app": 1, "app_refs": ["vpc_id"]}
+
+
+def build_test_vpc(app, stacks):
+    return BUILD_INPUTS["vpc"]
+
+
+def build_test_app(app, stacks):
+    return BUILD_INPUTS["app"]
+
+
+class TestSynthCache:
+
+    stacks = {"vpc": ([], build_test_vpc), "db": (["vpc"], build_test_vpc), "app": (["vpc"], build_test_app)}
+
+    def fake_synth(self, calls: list):
+        # mimics cdktf: producer stacks only get the outputs used by the consumers built with them
+        def synth(outdir, names):
+            calls.append(names)
+            manifest = {"version": "test", "stacks": {}}
+            for name in names:
+                stack_dir = os.path.join(outdir, "stacks", name)
+                os.makedirs(stack_dir)
+                outputs = {}
+                if name == "vpc" and "app" in names:
+                    outputs = {f"app_{ref}": 1 for ref in BUILD_INPUTS["app_refs"]}
+                with open(os.path.join(stack_dir, "cdk.tf.json"), "w") as stack_file:
+                    json.dump({"inputs": BUILD_INPUTS[name if name != "db" else "vpc"], "output": outputs}, stack_file)
+                manifest["stacks"][name] = {"name": name}
+            with open(os.path.join(outdir, "manifest.json"), "w") as manifest_file:
+                json.dump(manifest, manifest_file)
+        return synth
+
+    def test_unchanged_stacks_come_from_cache(self, tmp_path):
+        calls = []
+        outdir, cache_dir = str(tmp_path / "out"), str(tmp_path / "cache")
+        settings = {"BUILD_INPUTS": dict(BUILD_INPUTS)}
+        assert incremental_synth(self.stacks, [], self.fake_synth(calls), settings, outdir, cache_dir) == ["vpc", "db", "app"]
+        assert incremental_synth(self.stacks, [], self.fake_synth(calls), settings, outdir, cache_dir) == []
+        assert len(calls) == 1
+        with open(os.path.join(outdir, "manifest.json")) as manifest_file:
+            assert set(json.load(manifest_file)["stacks"]) == {"vpc", "db", "app"}
+
+    def test_dependencies_keep_outputs_of_unbuilt_consumers(self, tmp_path):
+        calls = []
+        outdir, cache_dir = str(tmp_path / "out"), str(tmp_path / "cache")
+        incremental_synth(self.stacks, [], self.fake_synth(calls), {"BUILD_INPUTS": 1}, outdir, cache_dir)
+
+        # app needs a new vpc output, so vpc changes as well
+        BUILD_INPUTS["app_refs"].append("subnets")
+        try:
+            changed = incremental_synth(self.stacks, ["app"], self.fake_synth(calls), {"BUILD_INPUTS": 2}, outdir, cache_dir)
+        finally:
+            BUILD_INPUTS["app_refs"].remove("subnets")
+        assert changed == ["vpc"]
+        with open(os.path.join(outdir, "stacks", "vpc", "cdk.tf.json")) as stack_file:
+            assert set(json.load(stack_file)["output"]) == {"app_vpc_id", "app_subnets"}
+
+    def test_cold_cache_single_target(self, tmp_path):
+        # app is rebuilt with the target db and needs vpc, which was never cached
+        stacks = {"vpc": ([], build_test_vpc), "db": ([], build_test_vpc), "app": (["vpc", "db"], build_test_app)}
+        outdir, cache_dir = str(tmp_path / "out"), str(tmp_path / "cache")
+        changed = incremental_synth(stacks, ["db"], self.fake_synth([]), {}, outdir, cache_dir)
+        assert changed == ["vpc", "db", "app"]
+        with open(os.path.join(outdir, "stacks", "vpc", "cdk.tf.json")) as stack_file:
+            assert set(json.load(stack_file)["output"]) == {"app_vpc_id"}
+
+    def test_pending_until_deployed(self, tmp_path):
+        outdir, cache_dir = str(tmp_path / "out"), str(tmp_path / "cache")
+        incremental_synth(self.stacks, [], self.fake_synth([]), {}, outdir, cache_dir)
+        cache = SynthCache(cache_dir)
+        assert sorted(cache.pending()) == ["app", "db", "vpc"]
+        cache.mark_deployed(["vpc"])
+        assert sorted(cache.pending()) == ["app", "db"]
+
+
+# fake terraform: records "<stack> <command>" and fails in stacks containing a FAIL file
+FAKE_TERRAFORM = """#!/bin/sh
+echo "$(basename "$PWD") $1" >> "$TF_CALLS"
+sleep 0.2
+[ -e FAIL ] && [ "$1" = plan ] && exit 1
+echo "$1 ok"
+"""
+
+
+class TestOrchestrator:
+
+    stacks = {"vpc": [], "apigw": ["vpc"], "ecs-cluster": ["vpc"], "media-store": [],
+              "synapse-service": ["apigw", "ecs-cluster", "media-store"]}
+
+    @pytest.fixture
+    def outdir(self, tmp_path, monkeypatch):
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir()
+        (bin_dir / "terraform").write_text(FAKE_TERRAFORM)
+        (bin_dir / "terraform").chmod(0o755)
+        monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+        monkeypatch.setenv("TF_CALLS", str(tmp_path / "calls"))
+
+        manifest = {"version": "test", "stacks": {}}
+        for name, dependencies in self.stacks.items():
+            (tmp_path / "out" / "stacks" / name).mkdir(parents=True)
+            manifest["stacks"][name] = {"name": name, "workingDirectory": f"stacks/{name}", "dependencies": dependencies}
+        (tmp_path / "out" / "manifest.json").write_text(json.dumps(manifest))
+        return tmp_path / "out"
+
+    def calls(self, outdir):
+        return (outdir.parent / "calls").read_text().split("\n")[:-1]
+
+    def test_apply_in_dependency_order(self, outdir):
+        graph = load_graph(str(outdir))
+        results = orchestrate(graph, "apply", 4, str(outdir / "logs"))
+        assert all(result["status"] == "succeeded" for result in results.values())
+
+        # independent stacks overlap, dependents start after their dependencies finished
+        assert results["media-store"]["start"] < results["vpc"]["end"]
+        for name, dependencies in self.stacks.items():
+            for dependency in dependencies:
+                assert results[dependency]["end"] <= results[name]["start"]
+        assert critical_path(graph, results)[0] == "vpc"
+        assert critical_path(graph, results)[-1] == "synapse-service"
+        assert self.calls(outdir).count("vpc apply") == 1
+        assert (outdir / "logs" / "vpc.log").read_text() == "init ok\nplan ok\napply ok\n"
+
+    def test_failure_skips_descendants(self, outdir):
+        (outdir / "stacks" / "ecs-cluster" / "FAIL").touch()
+        results = orchestrate(load_graph(str(outdir)), "apply", 2, str(outdir / "logs"))
+        assert results["ecs-cluster"]["status"] == "failed"
+        assert results["synapse-service"]["status"] == "skipped"
+        assert results["apigw"]["status"] == "succeeded"
+        assert "ecs-cluster apply" not in self.calls(outdir)
+        assert not any(call.startswith("synapse-service") for call in self.calls(outdir))
+
+    def test_select_with_dependencies(self, outdir):
+        graph = select_stacks(load_graph(str(outdir)), ["apigw"])
+        assert sorted(graph) == ["apigw", "vpc"]
+
+    def test_deploy_changed_order(self, outdir):
+        graph = select_stacks(load_graph(str(outdir)), ["synapse-service"])
+        assert dependency_order(graph, ["synapse-service", "vpc", "media-store"]) == ["media-store", "vpc", "synapse-service"]
+
+    def test_unknown_dependency(self, outdir):
+        manifest = json.loads((outdir / "manifest.json").read_text())
+        del manifest["stacks"]["vpc"]
+        (outdir / "manifest.json").write_text(json.dumps(manifest))
+        with pytest.raises(SystemExit, match="apigw"):
+            load_graph(str(outdir))
@@ -1,11 +1,9 @@
 #!/usr/bin/env python
-from decouple import config
-from cdktf import App, Fn, TerraformOutput, Token
-from shared.vpc import VpcStack
-from shared.ecs_cluster import Ec2EcsClusterStack
-from shared.apigw import ApiGatewayStack
-from data.rds_postgres import RdsPostgressDbStack
-from apps.synapse import SynapseStack
+import os
+import sys
+from decouple import config, Csv
+from cdktf import App, Token
+from sizing import CapacityProfile, capacity_profile
 
 # load env config
 region = config('region', default='eu-west-1')
@@ -15,12 +13,68 @@ home_ip = config('home_ip')
 key_pair_name = config('key_pair_name', default='my_key_pair')
 apigw_custom_domain = config('apigw_custom_domain', default='example.com')
 acm_cert_domain = config('acm_cert_domain', default='*.example.com')
+# synapse ingress: apigw (HTTP API, per request pricing, 30s timeout) or alb (listeners on 443 and 8448)
+ingress = config('ingress', default='apigw')
+alb_idle_timeout = config('alb_idle_timeout', default=120, cast=int)
+# cloudfront in front of the ingress: cached media, well-known documents. the ingress moves to cdn_origin_domain
+cdn = config('cdn', default=False, cast=bool)
+cdn_origin_domain = config('cdn_origin_domain', default=f'origin.{apigw_custom_domain}')
+cdn_cert_domain = config('cdn_cert_domain', default=acm_cert_domain)
+well_known_bucket_name = config('well_known_bucket_name', default='matrix-well-known')
 private_namespace = config('private_namespace', default='matrix.lan')
-ecs_instance_type = config('ecs_instance_type', default='a1.medium')
+# sizing of the ECS hosts, synapse tasks, database and cache: small, medium, large or a number of active users.
+# the settings below override single values of the profile, the result is checked as a whole (sizing.py)
+capacity_profile_name = config('capacity_profile', default='small')
+ecs_instance_type = config('ecs_instance_type', default='')
+db_instance_class = config('db_instance_class', default='')
+# ssm parameter version of the recommended ECS AMI (required), instances only roll when it is bumped.
+# see ECS_AMI_PARAMETER in shared/ecs_cluster.py for looking up the current one
+ecs_ami_version = config('ecs_ami_version', default='')
+# stopped, pre-initialized ECS hosts with the synapse image already pulled: Stopped, Hibernated or none
+ecs_warm_pool = config('ecs_warm_pool', default='none')
+synapse_image = config('synapse_image', default='matrixdotorg/synapse')
+# pull service images from ECR: a pull-through cache for public.ecr.aws, an in-region mirror of the docker hub
+# images (copy them with mirror_images.py after deploying the ecr stack, before the services)
+ecr_mirror = config('ecr_mirror', default=False, cast=bool)
+# media in S3 through synapse-s3-storage-provider, needs a synapse_image that ships it (the stock image does not)
+s3_media_store = config('s3_media_store', default=False, cast=bool)
+media_bucket_name = config('media_bucket_name', default='matrix-synapse-media')
+# worker counts, 0 keeps the profile's count
+synapse_generic_workers = config('synapse_generic_workers', default=0, cast=int)
+synapse_synchrotrons = config('synapse_synchrotrons', default=0, cast=int)
+synapse_media_workers = config('synapse_media_workers', default=0, cast=int)
+# spread the homeserver over every zone of the vpc: ASG, EFS, RDS standby, redis replica and ECS services
+multi_az = config('multi_az', default=False, cast=bool)
+# RDS Multi-AZ standby, doubles the instance cost
+rds_standby = config('rds_standby', default=multi_az, cast=bool)
+# subnet tier of the ECS hosts: public, or private (needs NAT or VPC endpoints to reach ECS and ECR)
+ecs_subnet_tier = config('ecs_subnet_tier', default='public')
+# task networking: bridge (dynamic host ports) or awsvpc (ENI per task, needs trunking capable instance types,
+# and private subnets with a NAT gateway for outbound federation traffic)
+ecs_network_mode = config('ecs_network_mode', default='bridge')
+# synapse metrics through an ADOT sidecar: emf (cloudwatch), amp (managed prometheus) or none
+metrics_exporter = config('metrics_exporter', default='emf')
+amp_workspace_arn = config('amp_workspace_arn', default='')
+amp_remote_write_url = config('amp_remote_write_url', default='')
+# synapse logs through a FireLens log router: access logs to S3 via firehose, warnings and errors to cloudwatch
+log_router = config('log_router', default=True, cast=bool)
+log_archive_bucket_name = config('log_archive_bucket_name', default='matrix-synapse-logs')
+# stacks to synthesize together with their dependencies, e.g. synth_stacks=vpc,apigw. all stacks when empty
+synth_stacks = config('synth_stacks', default='', cast=Csv())
+verbose = config('verbose', default=False, cast=bool)
+# reuse cached output of stacks whose inputs did not change, see synth_cache.py
+incremental = config('incremental', default=False, cast=bool)
 
-
-print("aws_profile: ", aws_profile)
-print("bucket: ", tf_state_bucket)
+#### capacity profile ####
+profile = capacity_profile(capacity_profile_name,
+                           sidecars=(metrics_exporter != "none") + log_router,
+                           instance_type=ecs_instance_type or None,
+                           db_instance_class=db_instance_class or None,
+                           worker_counts={pool: count for pool, count in {
+                               "generic-worker": synapse_generic_workers,
+                               "synchrotron": synapse_synchrotrons,
+                               "media-repository": synapse_media_workers}.items() if count})
+workers_sizing = profile.service.workers
 
 #### global configs ####
 provider_config = {
@@ -34,102 +88,438 @@ state_config = {
     "bucket": tf_state_bucket
 }
 
+cache_name = "synapse-cache"
 
-#### main app ####
-app = App()
+
+#### stack builders ####
+# stack modules (and the provider bindings they import) are only loaded for the stacks being built
 
 #### shared stacks ####
-vpc_stack = VpcStack(app, "vpc", provider_config, state_config, home_ip, private_namespace, ecs_instance_type)
+def build_vpc(app: App, stacks: dict):
+    from shared.vpc import VpcStack
+    return VpcStack(app, "vpc", provider_config, state_config, home_ip, private_namespace,
+                    profile.cluster.instance_type,
+                    efs_config={
+                        # regional with multi_az. switching replaces the file system, migrate its data first
+                        "one_zone": not multi_az,
+                        "throughput_mode": "elastic",
+                        "performance_mode": "generalPurpose",
+                        "mount_subnets": ["public"]
+                    })
+
 
 # API Gateway
-apigw_stack = ApiGatewayStack(app, "apigw",
+def build_apigw(app: App, stacks: dict):
+    from shared.apigw import ApiGatewayStack
+    vpc_stack = stacks["vpc"]
+    return ApiGatewayStack(app, "apigw",
+                           provider_config,
+                           state_config,
+                           api_config={
+                               "security_groups": [vpc_stack.vpc_sgroup.id],
+                               "subnets": Token.as_list(vpc_stack.vpc.public_subnets_output),
+                               "domain_name": cdn_origin_domain if cdn else apigw_custom_domain,
+                               "zone_name": apigw_custom_domain,
+                               "certificate_name": acm_cert_domain
+                           })
+
+
+# ALB ingress, same domain as the API Gateway
+def build_alb_ingress(app: App, stacks: dict):
+    from shared.alb import AlbIngressStack
+    vpc_stack = stacks["vpc"]
+    return AlbIngressStack(app, "alb-ingress",
+                           provider_config,
+                           state_config,
+                           alb_config={
+                               "vpc_id": vpc_stack.vpc.vpc_id_output,
+                               "security_groups": [vpc_stack.vpc_sgroup.id],
+                               "subnets": Token.as_list(vpc_stack.vpc.public_subnets_output),
+                               "domain_name": cdn_origin_domain if cdn else apigw_custom_domain,
+                               "zone_name": apigw_custom_domain,
+                               "certificate_name": acm_cert_domain,
+                               "listener_ports": [443, 8448],
+                               "idle_timeout": alb_idle_timeout,
+                               "http2": True
+                           })
+
+
+# CloudFront in front of the ingress, serves the custom domain
+def build_cdn(app: App, stacks: dict):
+    from shared.cdn import CdnStack
+    return CdnStack(app, "cdn",
+                    provider_config,
+                    state_config,
+                    cdn_config={
+                        "domain_name": apigw_custom_domain,
+                        "origin_domain": cdn_origin_domain,
+                        "certificate_name": cdn_cert_domain,
+                        "well_known_bucket_name": well_known_bucket_name,
+                        "media_ttl": {"min": 86400, "default": 31536000, "max": 31536000}
+                    })
+
+
+# ECS Cluster - EC2
+def build_ecs_cluster(app: App, stacks: dict):
+    from shared.ecs_cluster import Ec2EcsClusterStack
+    vpc_stack = stacks["vpc"]
+    return Ec2EcsClusterStack(app, "ecs-cluster",
                               provider_config,
                               state_config,
-                              api_config={
-                                  "security_groups": [vpc_stack.vpc_sgroup.id],
-                                  "subnets": Token.as_list(vpc_stack.vpc.public_subnets_output),
-                                  "domain_name": apigw_custom_domain,
-                                  "certificate_name": acm_cert_domain
-                              })
-apigw_stack.add_dependency(vpc_stack)
+                              cluster_config={
+                                  "cluster_name": "shared",
+                                  "key_pair_name": key_pair_name,
+                                  "subnets_ids": vpc_stack.subnet_ids(ecs_subnet_tier, None if multi_az else 1),
+                                  "security_groups": [vpc_stack.vpc_sgroup.id, vpc_stack.ssh_sgroup.id],
+                                  "instance_type": profile.cluster.instance_type,
+                                  "desired_capacity": profile.cluster.desired_capacity,
+                                  "min_capacity": profile.cluster.min_capacity,
+                                  "max_capacity": profile.cluster.max_capacity,
+                                  "container_insights": True,
+                                  "ami": {"version": ecs_ami_version},
+                                  # pulled at boot, tasks start from the cached image (ECS_IMAGE_PULL_BEHAVIOR).
+                                  # not with the mirror: tasks pull it by digest under its ECR name, which needs a login
+                                  "prepull_images": [] if ecr_mirror else [synapse_image],
+                                  **({"warm_pool": {"pool_state": ecs_warm_pool,
+                                                    "min_size": 1,
+                                                    "max_prepared_capacity": 2}}
+                                     if ecs_warm_pool != "none" else {}),
+                                  "capacity_provider": {
+                                      "target_capacity": 90,
+                                      "min_step": 1,
+                                      "max_step": 2
+                                  },
+                                  # stateless synapse workers, graviton types only (arm64 AMI)
+                                  "spot": {
+                                      "instance_types": [{"type": instance_type}
+                                                         for instance_type in profile.cluster.spot_instance_types],
+                                      "on_demand_base": 0,
+                                      "spot_percentage": 100,
+                                      "desired_capacity": 0,
+                                      "min_capacity": 0,
+                                      "max_capacity": profile.cluster.spot_max_capacity,
+                                      "capacity_provider": {
+                                          "target_capacity": 100,
+                                          "min_step": 1,
+                                          "max_step": 3
+                                      }
+                                  }
+                              }
+                              )
+
+
+def build_ecr(app: App, stacks: dict):
+    from shared.ecr import EcrStack
+    return EcrStack(app, "ecr",
+                    provider_config,
+                    state_config,
+                    ecr_config={
+                        "pull_through": {"public.ecr.aws": "ecr-public"},
+                        "mirrors": [synapse_image],
+                        "keep_images": 10
+                    })
 
-# ECS Cluster - EC2
-ecs_cluster_stack = Ec2EcsClusterStack(app, "ecs-cluster",
-                                       provider_config,
-                                       state_config,
-                                       cluster_config={
-                                           "cluster_name": "shared",
-                                           "key_pair_name": key_pair_name,
-                                           "subnets_ids": [vpc_stack.primary_public_subnet_id],
-                                           "security_groups": [vpc_stack.vpc_sgroup.id, vpc_stack.ssh_sgroup.id],
-                                           "instance_type": ecs_instance_type,
-                                           "desired_capacity": 1,
-                                           "min_capacity": 1,
-                                           "max_capacity": 1
-                                       }
-                                       )
-
-ecs_cluster_stack.add_dependency(vpc_stack)
 
 #### data stacks ####
-db_config = {
-    "db_name": "main-db",
-    "vpc_id": vpc_stack.vpc.vpc_id_output,
-    "preferred_az": vpc_stack.primary_availability_zone.name,
-    "db_subnet_group_name": Token.as_string(vpc_stack.vpc.database_subnet_group_name_output),
-    "sgroup_source_id": vpc_stack.vpc_sgroup.id,
-    "engine_version": "13.6",
-    "storage": 5,
-    "max_storage": 10,
-
-    "instance_class": "db.t4g.micro",
-    "namespace_id": vpc_stack.namespace.id
-}
+def build_rds_postgres(app: App, stacks: dict):
+    from data.rds_postgres import RdsPostgressDbStack
+    vpc_stack = stacks["vpc"]
+    db_config = {
+        "db_name": "main-db",
+        "vpc_id": vpc_stack.vpc.vpc_id_output,
+        "preferred_az": vpc_stack.availability_zone(0),
+        "multi_az": rds_standby,
+        "db_subnet_group_name": Token.as_string(vpc_stack.vpc.database_subnet_group_name_output),
+        "sgroup_source_id": vpc_stack.vpc_sgroup.id,
+        "engine_version": "13.6",
+        "storage": 20,
+        "max_storage": 100,
+        "storage_type": "gp3",
+        "performance_insights": False,
+        "monitoring_interval": 60,
+
+        "instance_class": profile.db.instance_class,
+        "namespace_id": vpc_stack.namespace.id,
+        "proxy": {
+            # main process + max scaled synapse workers, each holding its own connection pool
+            "clients": profile.db.clients,
+            "max_connections_percent": profile.db.max_connections_percent
+        },
+        "proxy_subnets_ids": Token.as_list(vpc_stack.vpc.database_subnets_output)
+    }
+
+    return RdsPostgressDbStack(app, "rds-postgres",
+                               provider_config,
+                               state_config,
+                               db_config,
+                               home_ip)
+
+
+def build_redis_cache(app: App, stacks: dict):
+    from data.redis import ElastiCacheRedisStack
+    vpc_stack = stacks["vpc"]
+    cache_config = {
+        "cache_name": cache_name,
+        "vpc_id": vpc_stack.vpc.vpc_id_output,
+        "subnets_ids": Token.as_list(vpc_stack.vpc.database_subnets_output),
+        "sgroup_source_id": vpc_stack.vpc_sgroup.id,
+        "engine_version": "7.0",
+        "node_type": profile.cache_node_type,
+        "num_nodes": 2 if multi_az else 1,
+        "multi_az": multi_az,
+        "namespace_id": vpc_stack.namespace.id
+    }
 
-rds_postrgres_db = RdsPostgressDbStack(app, "rds-postgres",
-                                       provider_config,
-                                       state_config,
-                                       db_config,
-                                       home_ip)
+    return ElastiCacheRedisStack(app, "redis-cache",
+                                 provider_config,
+                                 state_config,
+                                 cache_config)
+
+
+def build_media_store(app: App, stacks: dict):
+    from data.s3_media import S3MediaStoreStack
+    return S3MediaStoreStack(app, "media-store",
+                             provider_config,
+                             state_config,
+                             media_config={
+                                 "bucket_name": media_bucket_name,
+                                 "tiering_after_days": 30
+                             })
+
+
+def build_log_archive(app: App, stacks: dict):
+    from data.log_archive import LogArchiveStack
+    return LogArchiveStack(app, "log-archive",
+                           provider_config,
+                           state_config,
+                           archive_config={
+                               "bucket_name": log_archive_bucket_name,
+                               "stream_name": "synapse-logs",
+                               "retention_days": 365,
+                               "buffering": {"size_mb": 64, "interval": 300}
+                           })
 
-rds_postrgres_db.add_dependency(vpc_stack)
 
 #### apps stacks ####
-service_config = {
-    "service_name": "synapse",
-    "subnets_ids": [vpc_stack.primary_public_subnet_id],
-    "sec_group_id": Token.as_string(vpc_stack.vpc_sgroup.id),
-    "image": "matrixdotorg/synapse",
-    "cpu": 128,
-    "memory_soft": 128,
-    "memory_hard": 1024,
-    "env_vars": {
-        "name": "varA",
-        "value": "valueA"
-    },
-    "port_mappings": {
-        "protocol": "tcp",
-        "containerPort": 80,
-        "hostPort": 80
-    },
-    "port": 80,
-    "cluster_type": "EC2",
-    "cluster_id": ecs_cluster_stack.cluster.id,
-    "ns_id": vpc_stack.namespace.id,
-    "api_gw_id": apigw_stack.api_id,
-    "vpc_link_id": apigw_stack.vpc_link_id,
-    "route_key": 'ANY /{proxy+}',
-    "efs_id": vpc_stack.efs.id,
-    "access_point_id": vpc_stack.efs_ap_synapse.id,
-    "mount_path": "/data"
+def build_synapse_service(app: App, stacks: dict):
+    from apps.synapse import SynapseStack
+    vpc_stack = stacks["vpc"]
+    if ingress == "alb":
+        alb_stack = stacks["alb-ingress"]
+        ingress_config = {
+            "vpc_id": vpc_stack.vpc.vpc_id_output,
+            "alb_listener_arns": alb_stack.listener_arns,
+            "alb_arn_suffix": alb_stack.lb_arn_suffix
+        }
+        # requests per target and minute
+        request_metric, request_threshold = "alb_request_count", 1500
+    else:
+        apigw_stack = stacks["apigw"]
+        ingress_config = {
+            "api_gw_id": apigw_stack.api_id,
+            "vpc_link_id": apigw_stack.vpc_link_id
+        }
+        # requests to the whole api per minute
+        request_metric, request_threshold = "api_request_count", 6000
+    ecs_cluster_stack = stacks["ecs-cluster"]
+    service_config = {
+        "service_name": "synapse",
+        "subnets_ids": vpc_stack.subnet_ids(ecs_subnet_tier, None if multi_az else 1),
+        "sec_group_id": Token.as_string(vpc_stack.vpc_sgroup.id),
+        "image": synapse_image,
+        **profile.service.main.as_dict(),
+        "env_vars": [],
+        # dynamic host port, tasks are found through the SRV records / target group
+        "port_mappings": {
+            "protocol": "tcp",
+            "containerPort": 80,
+            "hostPort": 0
+        },
+        "port": 80,
+        "network_mode": ecs_network_mode,
+        # spread over zones first, then fill instances up by memory; pools inherit it
+        "placement_strategy": ["spread_az", "binpack_memory"],
+        "cluster_type": "EC2",
+        "cluster_id": ecs_cluster_stack.cluster.id,
+        "cluster_name": ecs_cluster_stack.cluster.name,
+        "capacity_provider": ecs_cluster_stack.capacity_provider_name,
+        "ns_id": vpc_stack.namespace.id,
+        # the main process replication endpoint: <service_name>-replication.<namespace_name>
+        "namespace_name": private_namespace,
+        "vpc_id": vpc_stack.vpc.vpc_id_output,
+        "vpc_cidr": vpc_stack.vpc.vpc_cidr_block_output,
+        **ingress_config,
+        # images from the regional ECR, synapse pinned by digest
+        **({"ecr": stacks["ecr"].image_config} if ecr_mirror else {}),
+        "route_key": 'ANY /{proxy+}',
+        "health_check": {
+            "path": "/health",
+            "start_period": 180
+        },
+        # start the replacement task before stopping the old one
+        "deployment": {
+            "minimum_healthy_percent": 100,
+            "maximum_percent": 200,
+            "circuit_breaker": True
+        },
+        **({"metrics": {
+            "exporter": metrics_exporter,
+            "amp_workspace_arn": amp_workspace_arn,
+            "amp_remote_write_url": amp_remote_write_url
+        }} if metrics_exporter != "none" else {}),
+        **({"log_router": {
+            "delivery_stream": stacks["log-archive"].delivery_stream_name,
+            "delivery_stream_arn": stacks["log-archive"].delivery_stream_arn,
+            "flush": 5,
+            "buffer_limit": 4096,
+            # per statement SQL timing, DEBUG level when enabled
+            "drop": [r"\s-\ssynapse\.storage\.SQL\s-\s"],
+            "sample": {"rate": 100, "window": 60, "interval": "1s"}
+        }} if log_router else {}),
+        "efs_id": vpc_stack.efs.id,
+        "access_point_id": vpc_stack.efs_ap_synapse.id,
+        "mount_path": "/data",
+        "redis_host": f"{cache_name}.{private_namespace}",
+        "redis_port": stacks["redis-cache"].port,
+        **({"media_store": {
+            "bucket_name": stacks["media-store"].bucket_name,
+            "bucket_arn": stacks["media-store"].bucket_arn,
+            "region": region,
+            "cache_path": "/media_cache",
+            "async_upload": True
+        }} if s3_media_store else {}),
+        # task sizes and counts from the capacity profile, spot pools on the spot capacity provider
+        "workers": {
+            "generic-worker": {
+                **workers_sizing["generic-worker"].as_dict(),
+                "count": workers_sizing["generic-worker"].count,
+                "capacity_provider": ecs_cluster_stack.spot_capacity_provider_name,
+                "scaling": {
+                    "min_capacity": workers_sizing["generic-worker"].count,
+                    "max_capacity": workers_sizing["generic-worker"].max_count,
+                    "target_tracking": [{"metric": "cpu", "target": 60}],
+                    "step_scaling": [{
+                        "name": "api-requests",
+                        "metric": request_metric,
+                        "threshold": request_threshold,
+                        "steps": [{"lower": 0, "upper": request_threshold, "change": 1},
+                                  {"lower": request_threshold, "change": 2}]
+                    }]
+                }
+            },
+            "synchrotron": {
+                **workers_sizing["synchrotron"].as_dict(),
+                "count": workers_sizing["synchrotron"].count,
+                "capacity_provider": ecs_cluster_stack.spot_capacity_provider_name,
+                "scaling": {
+                    "min_capacity": workers_sizing["synchrotron"].count,
+                    "max_capacity": workers_sizing["synchrotron"].max_count,
+                    "target_tracking": [{"metric": "cpu", "target": 60}, {"metric": "memory", "target": 75}]
+                }
+            },
+            "media-repository": {
+                **workers_sizing["media-repository"].as_dict(),
+                "count": workers_sizing["media-repository"].count,
+                "capacity_provider": ecs_cluster_stack.spot_capacity_provider_name
+            },
+            "federation-sender": {
+                **workers_sizing["federation-sender"].as_dict(),
+                "count": workers_sizing["federation-sender"].count
+            }
+        }
+    }
+
+    return SynapseStack(app, "synapse-service",
+                        provider_config,
+                        state_config,
+                        service_config)
+
+
+INGRESS_STACKS = {"apigw": "apigw", "alb": "alb-ingress"}
+
+# stack name -> (dependencies, builder), in build order
+STACKS = {
+    "vpc": ([], build_vpc),
+    "apigw": (["vpc"], build_apigw),
+    "alb-ingress": (["vpc"], build_alb_ingress),
+    "cdn": ([INGRESS_STACKS[ingress]], build_cdn),
+    "ecs-cluster": (["vpc"], build_ecs_cluster),
+    "ecr": ([], build_ecr),
+    "rds-postgres": (["vpc"], build_rds_postgres),
+    "redis-cache": (["vpc"], build_redis_cache),
+    "media-store": ([], build_media_store),
+    "log-archive": ([], build_log_archive),
+    "synapse-service": (["vpc", INGRESS_STACKS[ingress], "ecs-cluster", "rds-postgres", "redis-cache"]
+                        + (["media-store"] if s3_media_store else [])
+                        + (["log-archive"] if log_router else [])
+                        + (["ecr"] if ecr_mirror else []),
+                        build_synapse_service)
+}
+# optional stacks, only deployed when enabled
+ENABLED_STACKS = {
+    "apigw": ingress == "apigw",
+    "alb-ingress": ingress == "alb",
+    "cdn": cdn,
+    "log-archive": log_router,
+    "media-store": s3_media_store,
+    "ecr": ecr_mirror
 }
+STACKS = {name: stack for name, stack in STACKS.items() if ENABLED_STACKS.get(name, True)}
 
-synapse_service = SynapseStack(app, "synapse-service",
-                               provider_config,
-                               state_config,
-                               service_config)
-synapse_service.add_dependency(ecs_cluster_stack)
-synapse_service.add_dependency(rds_postrgres_db)
 
-#### synth - end of code ####
-app.synth()
+def stack_closure(targets: list):
+    # targets and everything they depend on, in build order
+    unknown = [name for name in targets if name not in STACKS]
+    if unknown:
+        raise SystemExit(f"Unknown stacks {unknown}, available: {list(STACKS)}")
+
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(STACKS[name][0])
+    return [name for name in STACKS if name in selected]
+
+
+# note: a stack only gets the cross-stack outputs used by the stacks built with it. when synthesizing a
+# subset, only the targets are complete - don't deploy their dependencies from it (incremental mode handles this)
+def build_stacks(app: App, targets: list = None):
+    stacks = {}
+    for name in stack_closure(targets or list(STACKS)):
+        dependencies, builder = STACKS[name]
+        stacks[name] = builder(app, stacks)
+        for dependency in dependencies:
+            stacks[name].add_dependency(stacks[dependency])
+    return stacks
+
+
+#### main app ####
+if __name__ == "__main__":
+    targets = sys.argv[1:] or synth_stacks
+    if verbose:
+        print("aws_profile: ", aws_profile)
+        print("bucket: ", tf_state_bucket)
+        print("capacity profile: ", profile.name)
+        print("stacks: ", stack_closure(targets or list(STACKS)))
+
+    if incremental:
+        from synth_cache import incremental_synth
+
+        def synth_into(outdir: str, names: list):
+            app = App(outdir=outdir)
+            build_stacks(app, names)
+            app.synth()
+
+        settings = {name: value for name, value in globals().items()
+                    if isinstance(value, (str, int, float, bool, list, dict, CapacityProfile)) and not name.startswith("_")}
+        changed = incremental_synth(STACKS, targets, synth_into, settings, os.environ.get("CDKTF_OUTDIR", "cdktf.out"))
+        if verbose:
+            print("changed stacks: ", changed)
+    else:
+        app = App()
+        build_stacks(app, targets)
+
+        #### synth - end of code ####
+        app.synth()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copies the upstream images into their ECR mirror repositories (ecr stack, ecr_mirror=true).
+#
+#   pipenv run python orchestrator.py apply ecr && pipenv run python mirror_images.py
+#   pipenv run python orchestrator.py apply
+#
+# Images are copied unchanged with crane, with the same manifest digest as upstream. The next plan pins the
+# services to the mirrored digests.
+# Set CRANE / TERRAFORM to use other binaries, needs the aws cli for the registry login.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+def load_mirrors(stack_dir: str):
+    # upstream image -> mirror "registry/repository:tag", from the ecr stack state
+    terraform = os.environ.get("TERRAFORM", "terraform")
+    output = subprocess.run([terraform, "output", "-json", "mirrors"], cwd=stack_dir,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def login(crane: str, registry: str):
+    region = registry.split(".")[3]
+    password = subprocess.run(["aws", "ecr", "get-login-password", "--region", region],
+                              capture_output=True, text=True, check=True).stdout
+    subprocess.run([crane, "auth", "login", registry, "-u", "AWS", "--password-stdin"],
+                   input=password, text=True, check=True)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="copy upstream images into the ECR mirror repositories")
+    parser.add_argument("images", nargs="*", help="limit to these upstream images")
+    parser.add_argument("--outdir", default=os.environ.get("CDKTF_OUTDIR", "cdktf.out"))
+    args = parser.parse_args(argv)
+
+    crane = os.environ.get("CRANE", "crane")
+    mirrors = load_mirrors(os.path.join(args.outdir, "stacks", "ecr"))
+    unknown = [image for image in args.images if image not in mirrors]
+    if unknown:
+        raise SystemExit(f"Unknown images {unknown}, mirrored: {list(mirrors)}")
+
+    for registry in {target.split("/", 1)[0] for target in mirrors.values()}:
+        login(crane, registry)
+
+    failed = []
+    for image, target in mirrors.items():
+        if args.images and image not in args.images:
+            continue
+        print(f"$ crane copy {image} {target}", flush=True)
+        if subprocess.run([crane, "copy", image, target]).returncode:
+            failed.append(image)
+    if failed:
+        print(f"Failed to mirror {failed}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
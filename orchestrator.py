@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Runs terraform init/plan/apply on the synthesized stacks, independent stacks in parallel.
+#
+#   cdktf synth && pipenv run python orchestrator.py plan
+#   pipenv run python orchestrator.py apply --jobs 3
+#   pipenv run python orchestrator.py apply synapse-service     limit to some stacks (and dependencies)
+#
+# The stack graph comes from the dependencies in cdktf.out/manifest.json (add_dependency in main.py). A stack
+# starts once all its dependencies succeeded, the stacks depending on a failed one are skipped.
+# Per stack logs go to cdktf.out/logs/<stack>.log, set TERRAFORM to use another terraform binary.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+COMMANDS = {
+    "plan": [["init", "-input=false"],
+             ["plan", "-input=false", "-out=plan.tfplan"]],
+    "apply": [["init", "-input=false"],
+              ["plan", "-input=false", "-out=plan.tfplan"],
+              ["apply", "-input=false", "plan.tfplan"]]
+}
+
+
+def load_graph(outdir: str):
+    # stack name -> (working directory, dependencies)
+    with open(os.path.join(outdir, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    graph = {name: (os.path.join(outdir, stack.get("workingDirectory", os.path.join("stacks", name))),
+                    stack.get("dependencies", []))
+             for name, stack in manifest["stacks"].items()}
+    # a dependency that was not synthesized would never be scheduled
+    unknown = {name: [dep for dep in dependencies if dep not in graph]
+               for name, (_, dependencies) in graph.items() if not set(dependencies) <= set(graph)}
+    if unknown:
+        raise SystemExit(f"Stacks depend on stacks missing from {outdir}: {unknown}, synthesize them too")
+    return graph
+
+
+def select_stacks(graph: dict, targets: list):
+    unknown = [name for name in targets if name not in graph]
+    if unknown:
+        raise SystemExit(f"Unknown stacks {unknown}, available: {list(graph)}")
+
+    selected = set()
+    pending = list(targets or graph)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(graph[name][1])
+    return {name: (stack_dir, [dep for dep in dependencies if dep in selected])
+            for name, (stack_dir, dependencies) in graph.items() if name in selected}
+
+
+def run_stack(name: str, stack_dir: str, steps: list, log_path: str):
+    # runs in a pool process, streams prefixed terraform output and returns (succeeded, start, end)
+    terraform = os.environ.get("TERRAFORM", "terraform")
+    env = {**os.environ, "TF_IN_AUTOMATION": "1"}
+    start = time.time()
+    with open(log_path, "w") as log_file:
+        for step in steps:
+            print(f"[{name}] $ terraform {' '.join(step)}", flush=True)
+            process = subprocess.Popen([terraform] + step, cwd=stack_dir, env=env, text=True,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in process.stdout:
+                log_file.write(line)
+                print(f"[{name}] {line}", end="", flush=True)
+            if process.wait():
+                print(f"[{name}] terraform {step[0]} failed with exit code {process.returncode}", flush=True)
+                return False, start, time.time()
+    return True, start, time.time()
+
+
+def orchestrate(graph: dict, command: str, jobs: int, log_dir: str):
+    # returns stack name -> {"status": succeeded|failed|skipped, "start", "end"}
+    os.makedirs(log_dir, exist_ok=True)
+    results = {}
+    running = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while len(results) < len(graph):
+            for name, (stack_dir, dependencies) in graph.items():
+                if name in results or name in running.values():
+                    continue
+                states = [results.get(dep, {}).get("status") for dep in dependencies]
+                if any(state in ("failed", "skipped") for state in states):
+                    print(f"[{name}] skipped, a dependency failed", flush=True)
+                    results[name] = {"status": "skipped"}
+                elif all(state == "succeeded" for state in states):
+                    future = pool.submit(run_stack, name, stack_dir, COMMANDS[command],
+                                         os.path.join(log_dir, f"{name}.log"))
+                    running[future] = name
+
+            if not running:
+                # skipping above may have settled the remaining stacks
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                succeeded, start, end = future.result()
+                results[running.pop(future)] = {"status": "succeeded" if succeeded else "failed",
+                                                "start": start, "end": end}
+    return results
+
+
+def critical_path(graph: dict, results: dict):
+    # chain of stacks that bounded the wall time: from the last finished stack, follow the dependency that
+    # finished last
+    timed = {name: result for name, result in results.items() if "end" in result}
+    if not timed:
+        return []
+    path = [max(timed, key=lambda name: timed[name]["end"])]
+    while True:
+        dependencies = [dep for dep in graph[path[-1]][1] if dep in timed]
+        if not dependencies:
+            return list(reversed(path))
+        path.append(max(dependencies, key=lambda dep: timed[dep]["end"]))
+
+
+def print_report(graph: dict, results: dict):
+    timed = [result for result in results.values() if "end" in result]
+    origin = min((result["start"] for result in timed), default=0)
+    print("\nstack                    status      start  duration")
+    for name, result in results.items():
+        if "end" in result:
+            print(f"{name:<24} {result['status']:<10} {result['start'] - origin:6.1f}s {result['end'] - result['start']:8.1f}s")
+        else:
+            print(f"{name:<24} {result['status']:<10}")
+
+    path = critical_path(graph, results)
+    if path:
+        wall = max(result["end"] for result in timed) - origin
+        serial = sum(result["end"] - result["start"] for result in timed)
+        print(f"\ncritical path: {' -> '.join(path)}")
+        print(f"wall time {wall:.1f}s, serial time {serial:.1f}s")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="parallel terraform plan/apply of the synthesized stacks")
+    parser.add_argument("command", choices=list(COMMANDS))
+    parser.add_argument("stacks", nargs="*", help="limit to these stacks")
+    parser.add_argument("--jobs", type=int, default=4, help="max stacks running at once")
+    parser.add_argument("--outdir", default=os.environ.get("CDKTF_OUTDIR", "cdktf.out"))
+    args = parser.parse_args(argv)
+
+    graph = select_stacks(load_graph(args.outdir), args.stacks)
+    results = orchestrate(graph, args.command, args.jobs, os.path.join(args.outdir, "logs"))
+    print_report(graph, results)
+    return 0 if all(result["status"] == "succeeded" for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+from constructs import Construct
+from utils import ExtendedTerraformStack
+from imports.aws.lb import Lb
+from imports.aws.lb_listener import LbListener, LbListenerDefaultAction, LbListenerDefaultActionFixedResponse
+from imports.aws.security_group import SecurityGroup
+from imports.aws.security_group_rule import SecurityGroupRule
+
+
+# ALB in front of the ECS services: no integration timeout (long-polling /sync) and no per request pricing.
+# services add their own path rules to the listeners, see EcsServiceStack._initListenerRules
+class AlbIngressStack(ExtendedTerraformStack):
+    def __init__(self, scope: Construct, ns: str, provider_config: dict, state_config: dict, alb_config: dict):
+        super().__init__(scope, ns, provider_config, state_config)
+
+        # public listener ports, the shared vpc group gives access to the services
+        self._public_sg = SecurityGroup(self, "alb_sg",
+                                        vpc_id=alb_config["vpc_id"],
+                                        name="ALB Ingress")
+        for port in alb_config.get("listener_ports", [443, 8448]):
+            SecurityGroupRule(self, f"ALB Ingress {port}",
+                              description=f"HTTPS {port}",
+                              security_group_id=self._public_sg.id,
+                              from_port=port,
+                              to_port=port,
+                              protocol="tcp",
+                              cidr_blocks=["0.0.0.0/0"],
+                              type="ingress")
+
+        self._lb = Lb(self, "ALB",
+                      name="alb-shared",
+                      load_balancer_type="application",
+                      internal=False,
+                      security_groups=alb_config["security_groups"] + [self._public_sg.id],
+                      subnets=alb_config["subnets"],
+                      # above the 30s sync long-poll timeout clients use
+                      idle_timeout=alb_config.get("idle_timeout", 120),
+                      enable_http2=alb_config.get("http2", True),
+                      drop_invalid_header_fields=True)
+
+        ssl_cert = self._initCertificate(alb_config["certificate_name"])
+
+        # requests no service rule matches get a matrix style 404
+        self._listeners = {}
+        for port in alb_config.get("listener_ports", [443, 8448]):
+            self._listeners[port] = LbListener(self, f"Listener_{port}",
+                                               load_balancer_arn=self._lb.arn,
+                                               port=port,
+                                               protocol="HTTPS",
+                                               ssl_policy=alb_config.get("ssl_policy", "ELBSecurityPolicy-TLS13-1-2-2021-06"),
+                                               certificate_arn=ssl_cert.arn,
+                                               default_action=[LbListenerDefaultAction(
+                                                   type="fixed-response",
+                                                   fixed_response=LbListenerDefaultActionFixedResponse(
+                                                       content_type="application/json",
+                                                       status_code="404",
+                                                       message_body='{"errcode":"M_UNRECOGNIZED","error":"Unrecognized request"}'))])
+
+        self._initDnsAlias("DNS_Record_ALB",
+                           alb_config["domain_name"],
+                           self._lb.dns_name,
+                           self._lb.zone_id,
+                           alb_config.get("zone_name"))
+
+    @property
+    def lb(self):
+        return self._lb
+
+    @property
+    def lb_arn_suffix(self):
+        return self._lb.arn_suffix
+
+    @property
+    def listener_arns(self):
+        return {port: listener.arn for port, listener in self._listeners.items()}
+
+    @property
+    def security_group_id(self):
+        return self._public_sg.id
@@ -5,9 +5,6 @@ from imports.aws.apigatewayv2_vpc_link import Apigatewayv2VpcLink
 from imports.aws.apigatewayv2_stage import Apigatewayv2Stage
 from imports.aws.apigatewayv2_domain_name import Apigatewayv2DomainName, Apigatewayv2DomainNameDomainNameConfiguration
 from imports.aws.apigatewayv2_api_mapping import Apigatewayv2ApiMapping
-from imports.aws.data_aws_acm_certificate import DataAwsAcmCertificate
-from imports.aws.data_aws_route53_zone import DataAwsRoute53Zone
-from imports.aws.route53_record import Route53Record, Route53RecordAlias
 
 
 class ApiGatewayStack(ExtendedTerraformStack):
@@ -30,7 +27,7 @@ class ApiGatewayStack(ExtendedTerraformStack):
                                           name="$default",
                                           auto_deploy=True
                                           )
-        ssl_cert = DataAwsAcmCertificate(self, "main_cert", domain=api_config["certificate_name"])
+        ssl_cert = self._initCertificate(api_config["certificate_name"])
         custom_domain = Apigatewayv2DomainName(self, "API_Domain",
                                                domain_name=api_config["domain_name"],
                                                domain_name_configuration=Apigatewayv2DomainNameDomainNameConfiguration(
@@ -43,17 +40,11 @@ class ApiGatewayStack(ExtendedTerraformStack):
                                stage=deafult_stage.name,
                                domain_name=custom_domain.domain_name)
 
-        zone = DataAwsRoute53Zone(self, "hosted_zone", name=api_config["domain_name"])
-        Route53Record(self, "DNS_Record_API",
-                      zone_id=zone.id,
-                      name=api_config["domain_name"],
-                      type="A",
-                      alias=[Route53RecordAlias(
-                          zone_id=custom_domain.domain_name_configuration.hosted_zone_id,
-                          name=custom_domain.domain_name_configuration.target_domain_name,
-                          evaluate_target_health=True
-                      )]
-                      )
+        self._initDnsAlias("DNS_Record_API",
+                           api_config["domain_name"],
+                           custom_domain.domain_name_configuration.target_domain_name,
+                           custom_domain.domain_name_configuration.hosted_zone_id,
+                           api_config.get("zone_name"))
 
     @property
     def api_id(self):
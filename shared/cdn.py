@@ -0,0 +1,206 @@
+import json
+from constructs import Construct
+from utils import ExtendedTerraformStack
+from imports.aws.cloudfront_cache_policy import (CloudfrontCachePolicy, CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOrigin,
+                                                 CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOriginCookiesConfig,
+                                                 CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOriginHeadersConfig,
+                                                 CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOriginQueryStringsConfig)
+from imports.aws.cloudfront_distribution import (CloudfrontDistribution, CloudfrontDistributionDefaultCacheBehavior,
+                                                 CloudfrontDistributionOrderedCacheBehavior, CloudfrontDistributionOrigin,
+                                                 CloudfrontDistributionOriginCustomOriginConfig,
+                                                 CloudfrontDistributionRestrictions,
+                                                 CloudfrontDistributionRestrictionsGeoRestriction,
+                                                 CloudfrontDistributionViewerCertificate)
+from imports.aws.cloudfront_origin_access_control import CloudfrontOriginAccessControl
+from imports.aws.data_aws_cloudfront_cache_policy import DataAwsCloudfrontCachePolicy
+from imports.aws.data_aws_cloudfront_origin_request_policy import DataAwsCloudfrontOriginRequestPolicy
+from imports.aws.data_aws_cloudfront_response_headers_policy import DataAwsCloudfrontResponseHeadersPolicy
+from imports.aws.data_aws_iam_policy_document import (DataAwsIamPolicyDocument, DataAwsIamPolicyDocumentStatement,
+                                                      DataAwsIamPolicyDocumentStatementCondition,
+                                                      DataAwsIamPolicyDocumentStatementPrincipals)
+from imports.aws.provider import AwsProvider
+from imports.aws.s3_bucket import S3Bucket
+from imports.aws.s3_bucket_policy import S3BucketPolicy
+from imports.aws.s3_bucket_public_access_block import S3BucketPublicAccessBlock
+from imports.aws.s3_object import S3Object
+
+# media addressed by mxc id never changes, only the legacy unauthenticated endpoints are cacheable -
+# /_matrix/client/v1/media needs the access token and stays uncached
+MEDIA_PATHS = [
+    "/_matrix/media/*/download/*",
+    "/_matrix/media/*/thumbnail/*"
+]
+
+ALL_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "POST", "PATCH", "DELETE"]
+
+API_ORIGIN = "ingress"
+WELL_KNOWN_ORIGIN = "well-known"
+
+
+class CdnStack(ExtendedTerraformStack):
+    def __init__(self, scope: Construct, ns: str, provider_config: dict, state_config: dict, cdn_config: dict):
+        super().__init__(scope, ns, provider_config, state_config)
+
+        # cloudfront certificates must be in us-east-1
+        provider_us_east_1 = AwsProvider(self, "us_east_1",
+                                         region="us-east-1",
+                                         profile=provider_config["profile"],
+                                         alias="us_east_1")
+        ssl_cert = self._initCertificate(cdn_config["certificate_name"], provider_us_east_1)
+
+        self._initWellKnown(cdn_config)
+        media_cache_policy = self._initMediaCachePolicy(cdn_config)
+
+        caching_disabled = DataAwsCloudfrontCachePolicy(self, "CachingDisabled", name="Managed-CachingDisabled")
+        caching_optimized = DataAwsCloudfrontCachePolicy(self, "CachingOptimized", name="Managed-CachingOptimized")
+        # the origin (api gateway custom domain, ALB certificate) is addressed by its own host name
+        all_viewer = DataAwsCloudfrontOriginRequestPolicy(self, "AllViewerExceptHost",
+                                                          name="Managed-AllViewerExceptHostHeader")
+        simple_cors = DataAwsCloudfrontResponseHeadersPolicy(self, "SimpleCORS", name="Managed-SimpleCORS")
+
+        self._distribution = CloudfrontDistribution(self, "Distribution",
+                                                    enabled=True,
+                                                    comment=f"{cdn_config['domain_name']} matrix",
+                                                    aliases=[cdn_config["domain_name"]],
+                                                    price_class=cdn_config.get("price_class", "PriceClass_100"),
+                                                    http_version="http2and3",
+                                                    is_ipv6_enabled=True,
+                                                    origin=[
+                                                        CloudfrontDistributionOrigin(
+                                                            origin_id=API_ORIGIN,
+                                                            domain_name=cdn_config["origin_domain"],
+                                                            custom_origin_config=CloudfrontDistributionOriginCustomOriginConfig(
+                                                                http_port=80,
+                                                                https_port=443,
+                                                                origin_protocol_policy="https-only",
+                                                                origin_ssl_protocols=["TLSv1.2"],
+                                                                # above the 30s sync long-poll
+                                                                origin_read_timeout=60,
+                                                                origin_keepalive_timeout=60)),
+                                                        CloudfrontDistributionOrigin(
+                                                            origin_id=WELL_KNOWN_ORIGIN,
+                                                            domain_name=self._well_known_bucket.bucket_regional_domain_name,
+                                                            origin_access_control_id=self._well_known_oac.id)
+                                                    ],
+                                                    # client and federation apis pass through uncached
+                                                    default_cache_behavior=CloudfrontDistributionDefaultCacheBehavior(
+                                                        target_origin_id=API_ORIGIN,
+                                                        viewer_protocol_policy="redirect-to-https",
+                                                        allowed_methods=ALL_METHODS,
+                                                        cached_methods=["GET", "HEAD"],
+                                                        cache_policy_id=caching_disabled.id,
+                                                        origin_request_policy_id=all_viewer.id,
+                                                        compress=True),
+                                                    ordered_cache_behavior=[
+                                                        CloudfrontDistributionOrderedCacheBehavior(
+                                                            path_pattern=path,
+                                                            target_origin_id=API_ORIGIN,
+                                                            viewer_protocol_policy="redirect-to-https",
+                                                            allowed_methods=["GET", "HEAD", "OPTIONS"],
+                                                            cached_methods=["GET", "HEAD"],
+                                                            cache_policy_id=media_cache_policy.id,
+                                                            response_headers_policy_id=simple_cors.id,
+                                                            compress=True)
+                                                        for path in MEDIA_PATHS
+                                                    ] + [
+                                                        CloudfrontDistributionOrderedCacheBehavior(
+                                                            path_pattern="/.well-known/matrix/*",
+                                                            target_origin_id=WELL_KNOWN_ORIGIN,
+                                                            viewer_protocol_policy="redirect-to-https",
+                                                            allowed_methods=["GET", "HEAD", "OPTIONS"],
+                                                            cached_methods=["GET", "HEAD"],
+                                                            cache_policy_id=caching_optimized.id,
+                                                            # clients fetch the client document cross origin
+                                                            response_headers_policy_id=simple_cors.id,
+                                                            compress=True)
+                                                    ],
+                                                    restrictions=CloudfrontDistributionRestrictions(
+                                                        geo_restriction=CloudfrontDistributionRestrictionsGeoRestriction(
+                                                            restriction_type="none")),
+                                                    viewer_certificate=CloudfrontDistributionViewerCertificate(
+                                                        acm_certificate_arn=ssl_cert.arn,
+                                                        ssl_support_method="sni-only",
+                                                        minimum_protocol_version="TLSv1.2_2021"))
+
+        self._initWellKnownPolicy()
+
+        self._initDnsAlias("DNS_Record_CDN",
+                           cdn_config["domain_name"],
+                           self._distribution.domain_name,
+                           self._distribution.hosted_zone_id,
+                           cdn_config.get("zone_name"))
+
+    def _initWellKnown(self, cdn_config: dict):
+        # delegation documents, federation goes to 443 through cloudfront instead of 8448
+        domain_name = cdn_config["domain_name"]
+        documents = {
+            "server": {"m.server": f"{domain_name}:443"},
+            "client": {"m.homeserver": {"base_url": f"https://{domain_name}"}},
+            **cdn_config.get("well_known", {})
+        }
+
+        self._well_known_bucket = S3Bucket(self, "WellKnownBucket", bucket=cdn_config["well_known_bucket_name"])
+        S3BucketPublicAccessBlock(self, "WellKnownBucket_PublicAccess",
+                                  bucket=self._well_known_bucket.id,
+                                  block_public_acls=True,
+                                  block_public_policy=True,
+                                  ignore_public_acls=True,
+                                  restrict_public_buckets=True)
+        for name, document in documents.items():
+            S3Object(self, f"WellKnown_{name}",
+                     bucket=self._well_known_bucket.id,
+                     key=f".well-known/matrix/{name}",
+                     content=json.dumps(document),
+                     content_type="application/json",
+                     cache_control="public, max-age=3600")
+
+        self._well_known_oac = CloudfrontOriginAccessControl(self, "WellKnownOAC",
+                                                             name=f"oac-{cdn_config['well_known_bucket_name']}",
+                                                             origin_access_control_origin_type="s3",
+                                                             signing_behavior="always",
+                                                             signing_protocol="sigv4")
+
+    def _initWellKnownPolicy(self):
+        # only this distribution reads the bucket
+        policy_doc = DataAwsIamPolicyDocument(self, "WellKnownPolicyDoc",
+                                              statement=[DataAwsIamPolicyDocumentStatement(
+                                                  actions=["s3:GetObject"],
+                                                  effect="Allow",
+                                                  resources=[f"{self._well_known_bucket.arn}/*"],
+                                                  principals=[DataAwsIamPolicyDocumentStatementPrincipals(
+                                                      type="Service",
+                                                      identifiers=["cloudfront.amazonaws.com"])],
+                                                  condition=[DataAwsIamPolicyDocumentStatementCondition(
+                                                      test="StringEquals",
+                                                      variable="AWS:SourceArn",
+                                                      values=[self._distribution.arn])]
+                                              )])
+        S3BucketPolicy(self, "WellKnownBucket_Policy",
+                       bucket=self._well_known_bucket.id,
+                       policy=policy_doc.json)
+
+    def _initMediaCachePolicy(self, cdn_config: dict):
+        # thumbnail sizes are query parameters. min_ttl overrides the short max-age synapse sends
+        media_ttl = cdn_config.get("media_ttl", {})
+        return CloudfrontCachePolicy(self, "MediaCachePolicy",
+                                     name=f"matrix-media-{cdn_config['domain_name'].replace('.', '-')}",
+                                     min_ttl=media_ttl.get("min", 86400),
+                                     default_ttl=media_ttl.get("default", 31536000),
+                                     max_ttl=media_ttl.get("max", 31536000),
+                                     parameters_in_cache_key_and_forwarded_to_origin=CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOrigin(
+                                         cookies_config=CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOriginCookiesConfig(
+                                             cookie_behavior="none"),
+                                         headers_config=CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOriginHeadersConfig(
+                                             header_behavior="none"),
+                                         query_strings_config=CloudfrontCachePolicyParametersInCacheKeyAndForwardedToOriginQueryStringsConfig(
+                                             query_string_behavior="all"),
+                                         enable_accept_encoding_gzip=True,
+                                         enable_accept_encoding_brotli=True))
+
+    @property
+    def distribution(self):
+        return self._distribution
+
+    @property
+    def distribution_domain_name(self):
+        return self._distribution.domain_name
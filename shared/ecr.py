@@ -0,0 +1,68 @@
+import json
+from cdktf import TerraformOutput
+from constructs import Construct
+from utils import ExtendedTerraformStack, parse_image
+from imports.aws.data_aws_caller_identity import DataAwsCallerIdentity
+from imports.aws.ecr_lifecycle_policy import EcrLifecyclePolicy
+from imports.aws.ecr_pull_through_cache_rule import EcrPullThroughCacheRule
+from imports.aws.ecr_repository import EcrRepository, EcrRepositoryImageScanningConfiguration
+
+# repository prefix of the mirrored images, e.g. mirror/matrixdotorg/synapse
+MIRROR_PREFIX = "mirror"
+
+
+# regional copies of the service images: tasks pull from ECR instead of the (rate limited) upstream registries.
+# - pull-through cache rules for registries without credentials (public.ecr.aws: ADOT, fluent bit)
+# - mirror repositories for docker hub, the cache needs docker hub credentials there. mirror_images.py copies
+#   the images, the services pin the mirrored tags by digest (EcsServiceStack._initImage)
+class EcrStack(ExtendedTerraformStack):
+    def __init__(self, scope: Construct, ns: str, provider_config: dict, state_config: dict, ecr_config: dict):
+        super().__init__(scope, ns, provider_config, state_config)
+
+        self._registry = f"{DataAwsCallerIdentity(self, 'caller').account_id}.dkr.ecr.{provider_config['region']}.amazonaws.com"
+
+        # upstream registry -> repository prefix
+        self._pull_through = ecr_config.get("pull_through", {"public.ecr.aws": "ecr-public"})
+        for registry, prefix in self._pull_through.items():
+            EcrPullThroughCacheRule(self, f"PullThrough_{prefix}",
+                                    ecr_repository_prefix=prefix,
+                                    upstream_registry_url=registry)
+
+        # upstream "registry/repository" -> mirror repository name, upstream image -> mirror tag
+        self._mirrors = {}
+        mirror_targets = {}
+        for image in ecr_config.get("mirrors", []):
+            registry, repository, tag, _ = parse_image(image)
+            name = f"{MIRROR_PREFIX}/{repository}"
+            if f"{registry}/{repository}" not in self._mirrors:
+                repo = EcrRepository(self, f"Mirror_{repository.replace('/', '_')}",
+                                     name=name,
+                                     # mirror_images.py moves the tags, services pin the digests
+                                     image_tag_mutability="MUTABLE",
+                                     image_scanning_configuration=EcrRepositoryImageScanningConfiguration(scan_on_push=True))
+                # older digests may still be pinned by previous task definitions, keep a few for rollbacks
+                EcrLifecyclePolicy(self, f"Mirror_{repository.replace('/', '_')}_Lifecycle",
+                                   repository=repo.name,
+                                   policy=json.dumps({"rules": [{
+                                       "rulePriority": 1,
+                                       "description": "keep the most recent images",
+                                       "selection": {
+                                           "tagStatus": "any",
+                                           "countType": "imageCountMoreThan",
+                                           "countNumber": ecr_config.get("keep_images", 10)
+                                       },
+                                       "action": {"type": "expire"}
+                                   }]}))
+                self._mirrors[f"{registry}/{repository}"] = name
+            mirror_targets[image] = f"{self._registry}/{name}:{tag}"
+
+        TerraformOutput(self, "mirrors", value=mirror_targets)
+
+    @property
+    def registry(self):
+        return self._registry
+
+    @property
+    def image_config(self):
+        # "ecr" setting of the service configs
+        return {"registry": self._registry, "mirrors": self._mirrors, "pull_through": self._pull_through}
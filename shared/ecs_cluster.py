@@ -2,26 +2,40 @@
 import base64
 from constructs import Construct
 from utils import ExtendedTerraformStack
-from cdktf import Fn, TerraformOutput, Token
-from imports.aws.data_aws_ami import DataAwsAmi, DataAwsAmiFilter
-from imports.aws.ecs_cluster import EcsCluster
+from cdktf import Fn, TerraformOutput, Token, TerraformResourceLifecycle
+from imports.aws.data_aws_ssm_parameter import DataAwsSsmParameter
+from imports.aws.ecs_cluster import EcsCluster, EcsClusterSetting
+from imports.aws.ecs_capacity_provider import EcsCapacityProvider, EcsCapacityProviderAutoScalingGroupProvider, EcsCapacityProviderAutoScalingGroupProviderManagedScaling
+from imports.aws.ecs_cluster_capacity_providers import EcsClusterCapacityProviders, EcsClusterCapacityProvidersDefaultCapacityProviderStrategy
 from imports.aws.ecs_account_setting_default import EcsAccountSettingDefault
 from imports.aws.data_aws_iam_policy_document import DataAwsIamPolicyDocument, DataAwsIamPolicyDocumentStatement, DataAwsIamPolicyDocumentStatementPrincipals
 from imports.aws.data_aws_iam_policy import DataAwsIamPolicy
 from imports.aws.iam_role_policy_attachment import IamRolePolicyAttachment
 from imports.aws.iam_role import IamRole
 from imports.aws.iam_instance_profile import IamInstanceProfile
-from imports.aws.launch_template import LaunchTemplate, LaunchTemplateIamInstanceProfile, LaunchTemplatePrivateDnsNameOptions
-from imports.aws.autoscaling_group import AutoscalingGroup, AutoscalingGroupTag, AutoscalingGroupLaunchTemplate
+from imports.aws.launch_template import (LaunchTemplate, LaunchTemplateBlockDeviceMappings, LaunchTemplateBlockDeviceMappingsEbs,
+                                         LaunchTemplateHibernationOptions, LaunchTemplateIamInstanceProfile,
+                                         LaunchTemplatePrivateDnsNameOptions)
+from imports.aws.autoscaling_group import (AutoscalingGroup, AutoscalingGroupTag, AutoscalingGroupLaunchTemplate,
+                                           AutoscalingGroupWarmPool, AutoscalingGroupWarmPoolInstanceReusePolicy,
+                                           AutoscalingGroupMixedInstancesPolicy,
+                                           AutoscalingGroupMixedInstancesPolicyInstancesDistribution,
+                                           AutoscalingGroupMixedInstancesPolicyLaunchTemplate,
+                                           AutoscalingGroupMixedInstancesPolicyLaunchTemplateLaunchTemplateSpecification,
+                                           AutoscalingGroupMixedInstancesPolicyLaunchTemplateOverride)
 from imports.aws.data_aws_instances import DataAwsInstances
 
+# ECS optimized Amazon Linux 2 AMI, recommended release. pinned to a parameter version, the current one is listed by
+#   aws ssm get-parameter-history --name <ECS_AMI_PARAMETER> --query 'Parameters[-1].Version'
+ECS_AMI_PARAMETER = "/aws/service/ecs/optimized-ami/amazon-linux-2/arm64/recommended/image_id"
+
 
 class Ec2EcsClusterStack(ExtendedTerraformStack):
     def __init__(self, scope: Construct, ns: str, provider_config: dict, state_config: dict, cluster_config: dict):
         super().__init__(scope, ns, provider_config, state_config)
 
         # ECS settings
-        self._init_cluster(cluster_config["cluster_name"])
+        self._init_cluster(cluster_config["cluster_name"], cluster_config.get("container_insights", True))
 
         # IAM Roles
         ecs_instance_profile = self._init_IAM_roles()
@@ -29,60 +43,185 @@ class Ec2EcsClusterStack(ExtendedTerraformStack):
         # Ec2 instance cluster
         self._init_autoscale_group(cluster_config, ecs_instance_profile)
 
+        # let ECS drive the ASG size from task demand
+        self._init_capacity_provider(cluster_config)
+
         instances = DataAwsInstances(self, "Instances", instance_tags={"is_autoscale": "true"})
 
         # stack outputs
-        TerraformOutput(self, "ami_id", value=self._ami.id)
+        TerraformOutput(self, "ami_id", value=self._ami_id)
         TerraformOutput(self, "public_ips", value=Token.as_list(instances.public_ips))
 
     def _init_autoscale_group(self, cluster_config, ecs_instance_profile):
         cluster_name = cluster_config["cluster_name"]
-        self._ami = DataAwsAmi(self, "ami_ids",
-                               most_recent=True,
-                               owners=["amazon"],
-                               filter=[DataAwsAmiFilter(name="name", values=["amzn2-ami-ecs-*"]),
-                                       DataAwsAmiFilter(name="architecture", values=["arm64"])]
-                               )
+        warm_pool = cluster_config.get("warm_pool")
+        # the AMI only changes with the pinned parameter version, not with every new AWS release
+        ami_config = cluster_config.get("ami", {})
+        ami_parameter = ami_config.get("ssm_parameter", ECS_AMI_PARAMETER)
+        if not ami_config.get("version"):
+            raise ValueError(f"Pin the ECS AMI to a version of the {ami_parameter} parameter, the unversioned "
+                             f"parameter follows every AWS release and replaces the launch template with it")
+        ami_parameter = f"{ami_parameter}:{ami_config['version']}"
+        # the provider marks every parameter value sensitive, a public AMI id is not
+        self._ami_id = Fn.nonsensitive(DataAwsSsmParameter(self, "ami_id_parameter", name=ami_parameter).value)
 
         # Launch Template
         template_profile = LaunchTemplateIamInstanceProfile(arn=ecs_instance_profile.arn)
         template_dns_options = LaunchTemplatePrivateDnsNameOptions(enable_resource_name_dns_a_record=False)
-        user_data_str = f"""#!/bin/bash
-                        cat <<EOF >> /etc/ecs/ecs.config
-                        ECS_CLUSTER={cluster_name}
-                        ECS_CONTAINER_INSTANCE_TAGS={{"name": "i-ecs-cluster-{cluster_name}"}}
-                        EOF
-                        """
+        # images already on the instance are used as is, with a warm pool the agent registers once the
+        # instance enters service. lines are unindented, an indented EOF would not close the heredoc
+        ecs_settings = [f"ECS_CLUSTER={cluster_name}",
+                        f'ECS_CONTAINER_INSTANCE_TAGS={{"name": "i-ecs-cluster-{cluster_name}"}}',
+                        "ECS_ENABLE_SPOT_INSTANCE_DRAINING=true",
+                        "ECS_IMAGE_PULL_BEHAVIOR=prefer-cached"] + (["ECS_WARM_POOLS_CHECK=true"] if warm_pool else [])
+        # pre-pull the service images, a warmed instance keeps them on its volume
+        prepull = [f"docker pull {image} || true" for image in cluster_config.get("prepull_images", [])]
+        user_data_str = "\n".join(["#!/bin/bash", "cat <<EOF >> /etc/ecs/ecs.config"] + ecs_settings + ["EOF"] +
+                                  prepull) + "\n"
         user_data_b64_bytes = base64.b64encode(user_data_str.encode('ascii'))
 
+        # hibernation needs an encrypted root volume large enough for the instance memory
+        hibernate = (warm_pool or {}).get("pool_state") == "Hibernated"
+
         template = LaunchTemplate(self, "LaunchTemplate",
                                   name=f"launch-template-{cluster_name}",
-                                  image_id=self._ami.id,
+                                  image_id=self._ami_id,
                                   key_name=cluster_config["key_pair_name"],
                                   vpc_security_group_ids=cluster_config["security_groups"],
                                   iam_instance_profile=template_profile,
                                   private_dns_name_options=template_dns_options,
                                   user_data=user_data_b64_bytes.decode('ascii'),
-                                  instance_type=cluster_config["instance_type"]
+                                  instance_type=cluster_config["instance_type"],
+                                  hibernation_options=LaunchTemplateHibernationOptions(configured=True) if hibernate else None,
+                                  block_device_mappings=[LaunchTemplateBlockDeviceMappings(
+                                      device_name="/dev/xvda",
+                                      ebs=LaunchTemplateBlockDeviceMappingsEbs(
+                                          volume_size=warm_pool.get("root_volume_size", 30),
+                                          volume_type="gp3",
+                                          encrypted="true"))] if hibernate else None
                                   )
 
-        # Autoscaling Group
-        self._as_group = AutoscalingGroup(self, "AutoscalingGroup",
-                                    name=f"asg-ecs-cluster-{cluster_name}",
-                                    vpc_zone_identifier=cluster_config["subnets_ids"],
-                                    launch_template=AutoscalingGroupLaunchTemplate(id=template.id,
-                                                                                   version="$Latest"
-                                                                                   ),
-                                    health_check_type="EC2",
-                                    health_check_grace_period=300,
-                                    desired_capacity=cluster_config["desired_capacity"],
-                                    min_size=cluster_config["min_capacity"],
-                                    max_size=cluster_config["max_capacity"],
-                                    tag=[AutoscalingGroupTag(key="is_autoscale",
-                                                             value="true",
-                                                             propagate_at_launch=True)
-                                         ]
-                                    )
+        # Autoscaling Group - on-demand capacity
+        self._as_group = self._new_autoscale_group("AutoscalingGroup",
+                                                   f"asg-ecs-cluster-{cluster_name}",
+                                                   cluster_config,
+                                                   template)
+
+        # Autoscaling Group - mixed instances with spot, for stateless services
+        self._spot_as_group = None
+        spot_config = cluster_config.get("spot")
+        if spot_config:
+            if "warm_pool" in spot_config:
+                raise ValueError("ASG warm pools don't support mixed instances policies, drop the spot warm_pool")
+            # subnets and sizing default to the on-demand group, the capacity provider and warm pool are never inherited
+            base_config = {k: v for k, v in cluster_config.items() if k not in ("capacity_provider", "warm_pool")}
+            self._spot_as_group = self._new_autoscale_group("AutoscalingGroup_spot",
+                                                            f"asg-ecs-cluster-{cluster_name}-spot",
+                                                            {**base_config, **spot_config},
+                                                            template,
+                                                            spot_config)
+
+    def _new_autoscale_group(self, construct_id: str, name: str, group_config: dict, template: LaunchTemplate,
+                             spot_config: dict = None):
+        # with a capacity provider, ECS owns the desired capacity and scale-in protection
+        managed = "capacity_provider" in group_config
+        launch_template = AutoscalingGroupLaunchTemplate(id=template.id, version="$Latest")
+        mixed_instances_policy = None
+        if spot_config:
+            instance_types = spot_config["instance_types"]
+            if managed and any(instance.get("weight", 1) != 1 for instance in instance_types):
+                raise ValueError("ECS capacity providers do not support ASG instance weights, drop the weights "
+                                 "or the spot capacity_provider")
+            launch_template = None
+            mixed_instances_policy = AutoscalingGroupMixedInstancesPolicy(
+                instances_distribution=AutoscalingGroupMixedInstancesPolicyInstancesDistribution(
+                    on_demand_base_capacity=spot_config.get("on_demand_base", 0),
+                    on_demand_percentage_above_base_capacity=100 - spot_config["spot_percentage"],
+                    spot_allocation_strategy="capacity-optimized"),
+                launch_template=AutoscalingGroupMixedInstancesPolicyLaunchTemplate(
+                    launch_template_specification=AutoscalingGroupMixedInstancesPolicyLaunchTemplateLaunchTemplateSpecification(
+                        launch_template_id=template.id,
+                        version="$Latest"),
+                    override=[AutoscalingGroupMixedInstancesPolicyLaunchTemplateOverride(
+                        instance_type=instance["type"],
+                        weighted_capacity=str(instance["weight"]) if "weight" in instance else None)
+                        for instance in instance_types]
+                ))
+
+        return AutoscalingGroup(self, construct_id,
+                                name=name,
+                                vpc_zone_identifier=group_config["subnets_ids"],
+                                launch_template=launch_template,
+                                mixed_instances_policy=mixed_instances_policy,
+                                health_check_type="EC2",
+                                health_check_grace_period=300,
+                                desired_capacity=group_config["desired_capacity"],
+                                min_size=group_config["min_capacity"],
+                                max_size=group_config["max_capacity"],
+                                protect_from_scale_in=managed,
+                                # stopped (or hibernated) pre-initialized instances, scale-in returns instances to the pool
+                                warm_pool=AutoscalingGroupWarmPool(
+                                    pool_state=group_config["warm_pool"].get("pool_state", "Stopped"),
+                                    min_size=group_config["warm_pool"].get("min_size", 1),
+                                    max_group_prepared_capacity=group_config["warm_pool"].get("max_prepared_capacity"),
+                                    instance_reuse_policy=AutoscalingGroupWarmPoolInstanceReusePolicy(
+                                        reuse_on_scale_in=group_config["warm_pool"].get("reuse_on_scale_in", True))
+                                ) if "warm_pool" in group_config else None,
+                                tag=[AutoscalingGroupTag(key="is_autoscale",
+                                                         value="true",
+                                                         propagate_at_launch=True),
+                                     AutoscalingGroupTag(key="AmazonECSManaged",
+                                                         value="true",
+                                                         propagate_at_launch=True)
+                                     ],
+                                lifecycle=TerraformResourceLifecycle(ignore_changes=["desired_capacity"]) if managed else None
+                                )
+
+    def _init_capacity_provider(self, cluster_config):
+        cluster_name = cluster_config["cluster_name"]
+        self._capacity_provider = None
+        self._spot_capacity_provider = None
+        if "capacity_provider" in cluster_config:
+            self._capacity_provider = self._new_capacity_provider("CapacityProvider",
+                                                                  f"cp-ecs-cluster-{cluster_name}",
+                                                                  self._as_group,
+                                                                  cluster_config["capacity_provider"])
+        spot_config = cluster_config.get("spot", {})
+        if "capacity_provider" in spot_config:
+            self._spot_capacity_provider = self._new_capacity_provider("CapacityProvider_spot",
+                                                                       f"cp-ecs-cluster-{cluster_name}-spot",
+                                                                       self._spot_as_group,
+                                                                       spot_config["capacity_provider"])
+
+        providers = [provider for provider in (self._capacity_provider, self._spot_capacity_provider) if provider]
+        if not providers:
+            return
+
+        # services without an explicit strategy land on the first (on-demand) provider
+        default_provider = providers[0]
+        EcsClusterCapacityProviders(self, "ClusterCapacityProviders",
+                                    cluster_name=self._cluster.name,
+                                    capacity_providers=[provider.name for provider in providers],
+                                    default_capacity_provider_strategy=[
+                                        EcsClusterCapacityProvidersDefaultCapacityProviderStrategy(
+                                            capacity_provider=default_provider.name,
+                                            base=cluster_config.get("capacity_provider", {}).get("base", 0),
+                                            weight=100)
+                                    ])
+
+    def _new_capacity_provider(self, construct_id: str, name: str, as_group: AutoscalingGroup, provider_config: dict):
+        return EcsCapacityProvider(self, construct_id,
+                                   name=name,
+                                   auto_scaling_group_provider=EcsCapacityProviderAutoScalingGroupProvider(
+                                       auto_scaling_group_arn=as_group.arn,
+                                       managed_termination_protection="ENABLED",
+                                       managed_scaling=EcsCapacityProviderAutoScalingGroupProviderManagedScaling(
+                                           status="ENABLED",
+                                           target_capacity=provider_config["target_capacity"],
+                                           minimum_scaling_step_size=provider_config.get("min_step", 1),
+                                           maximum_scaling_step_size=provider_config.get("max_step", 2),
+                                           instance_warmup_period=provider_config.get("instance_warmup", 300))
+                                   ))
 
     def _init_IAM_roles(self):
         policy_ecs_for_ec2 = DataAwsIamPolicy(self, "EcsForEc2Policy", name="AmazonEC2ContainerServiceforEC2Role")
@@ -110,11 +249,14 @@ class Ec2EcsClusterStack(ExtendedTerraformStack):
 
         return ecs_instance_profile
 
-    def _init_cluster(self, cluster_name):
+    def _init_cluster(self, cluster_name, container_insights: bool = True):
         EcsAccountSettingDefault(
             self, "AccountSettings", name="awsvpcTrunking", value="enabled")
 
-        self._cluster = EcsCluster(self, "EcsCluster", name=cluster_name)
+        # task/service level cpu, memory, network and storage metrics
+        self._cluster = EcsCluster(self, "EcsCluster", name=cluster_name,
+                                   setting=[EcsClusterSetting(name="containerInsights",
+                                                              value="enabled" if container_insights else "disabled")])
 
     @property
     def cluster(self):
@@ -123,3 +265,15 @@ class Ec2EcsClusterStack(ExtendedTerraformStack):
     @property
     def autoscaling_group(self):
         return self._as_group
+
+    @property
+    def spot_autoscaling_group(self):
+        return self._spot_as_group
+
+    @property
+    def capacity_provider_name(self):
+        return self._capacity_provider.name if self._capacity_provider else None
+
+    @property
+    def spot_capacity_provider_name(self):
+        return self._spot_capacity_provider.name if self._spot_capacity_provider else None
@@ -1,6 +1,7 @@
 from cdktf import Token, Fn
 from constructs import Construct
 from utils import ExtendedTerraformStack
+from imports.aws.cloudwatch_metric_alarm import CloudwatchMetricAlarm
 from imports.aws.data_aws_availability_zone import DataAwsAvailabilityZone
 from imports.aws.security_group import SecurityGroup
 from imports.aws.security_group_rule import SecurityGroupRule
@@ -18,7 +19,8 @@ class VpcStack(ExtendedTerraformStack):
                  state_config: dict,
                  home_ip: str,
                  private_namespace: str,
-                 preferred_instance_type: str):
+                 preferred_instance_type: str,
+                 efs_config: dict = None):
         super().__init__(scope, ns, provider_config, state_config)
 
         # create base vpc and security groups
@@ -28,7 +30,7 @@ class VpcStack(ExtendedTerraformStack):
         self._initCloudMap(private_namespace)
 
         # create Shared File System
-        self._intEFS()
+        self._intEFS(efs_config or {})
 
     def _initVPC(self, home_ip: str, private_namespace: str, preferred_instance_type: str):
         # #########################################################################################################
@@ -41,11 +43,12 @@ class VpcStack(ExtendedTerraformStack):
 
 
         # create the VPC
+        self._azs = [f'{self._provider.region}b',
+                     f'{self._provider.region}c']
         self._vpc = Vpc(self, "shared_vpc",
                         name="shared_vpc",
                         cidr="10.144.0.0/16",
-                        azs=[f'{self._provider.region}b',
-                             f'{self._provider.region}c'],
+                        azs=self._azs,
                         private_subnets=["10.144.5.0/24", "10.144.6.0/24"],
                         public_subnets=["10.144.0.0/24", "10.144.1.0/24"],
                         database_subnets=["10.144.10.0/24", "10.144.11.0/24"],
@@ -95,10 +98,16 @@ class VpcStack(ExtendedTerraformStack):
                                                               description="Namespace for all privatier services",
                                                               vpc=self._vpc.vpc_id_output)
 
-    def _intEFS(self):
+    def _intEFS(self, efs_config: dict):
+        # one zone (default) pins the file system to the primary az, regional spans all of them
+        one_zone = efs_config.get("one_zone", True)
+        throughput_mode = efs_config.get("throughput_mode", "bursting")
         self._efs = EfsFileSystem(self, "EFS",
-                                  availability_zone_name=self._primary_az.name,
+                                  availability_zone_name=self._primary_az.name if one_zone else None,
                                   creation_token="shared_efs",
+                                  performance_mode=efs_config.get("performance_mode", "generalPurpose"),
+                                  throughput_mode=throughput_mode,
+                                  provisioned_throughput_in_mibps=efs_config.get("provisioned_mibps") if throughput_mode == "provisioned" else None,
                                   encrypted=True)
 
         EfsBackupPolicy(self,"EFS_Backup", file_system_id=self._efs.id, backup_policy={"status": "ENABLED"})
@@ -112,42 +121,93 @@ class VpcStack(ExtendedTerraformStack):
                                                     permissions="0755")),
                                               posix_user=EfsAccessPointPosixUser(uid=991, gid=991))
 
-        EfsMountTarget(self, f"MountTarget_public_subnet",
-                       file_system_id=self._efs.id,
-                       security_groups=[self._vpc_sg.id],
-                       subnet_id=self.primary_public_subnet_id)
+        # EFS allows a single mount target per az, hosts in the other tiers reach it through the vpc routing
+        mount_subnets = efs_config.get("mount_subnets", ["public"])
+        if len(mount_subnets) != 1:
+            raise ValueError(f"EFS takes one mount target per availability zone, pick a single mount_subnets tier "
+                             f"instead of {mount_subnets}")
+        tier = mount_subnets[0]
+
+        # mount target per az ECS hosts can land in, a one zone file system can only be mounted in its own az
+        zones = 1 if one_zone else len(self._azs)
+        for index in range(zones):
+            construct_id = f"MountTarget_{tier}_subnet" if index == 0 else f"MountTarget_{tier}_subnet_{index}"
+            EfsMountTarget(self, construct_id,
+                           file_system_id=self._efs.id,
+                           security_groups=[self._vpc_sg.id],
+                           subnet_id=self.subnet_id(tier, index))
+
+        self._init_efs_alarms(efs_config, throughput_mode)
+
+    def _init_efs_alarms(self, efs_config: dict, throughput_mode: str):
+        alarm_actions = efs_config.get("alarm_actions", [])
+        # burst credits only apply to bursting throughput
+        if throughput_mode == "bursting":
+            CloudwatchMetricAlarm(self, "EFS_Alarm_BurstCredits",
+                                  alarm_name="alarm-efs-shared-burst-credits",
+                                  alarm_description="EFS burst credits running out, I/O will be throttled to baseline",
+                                  namespace="AWS/EFS",
+                                  metric_name="BurstCreditBalance",
+                                  dimensions={"FileSystemId": self._efs.id},
+                                  statistic="Minimum",
+                                  period=300,
+                                  evaluation_periods=3,
+                                  threshold=efs_config.get("burst_credit_threshold", 192 * 1024 ** 3),
+                                  comparison_operator="LessThanThreshold",
+                                  alarm_actions=alarm_actions)
+        # general purpose mode is capped on operations per second
+        if efs_config.get("performance_mode", "generalPurpose") == "generalPurpose":
+            CloudwatchMetricAlarm(self, "EFS_Alarm_IOLimit",
+                                  alarm_name="alarm-efs-shared-io-limit",
+                                  alarm_description="EFS close to the general purpose I/O limit",
+                                  namespace="AWS/EFS",
+                                  metric_name="PercentIOLimit",
+                                  dimensions={"FileSystemId": self._efs.id},
+                                  statistic="Maximum",
+                                  period=300,
+                                  evaluation_periods=3,
+                                  threshold=90,
+                                  comparison_operator="GreaterThanThreshold",
+                                  alarm_actions=alarm_actions)
 
     @property
     def vpc(self):
         return self._vpc
 
     @property
-    def primary_availability_zone(self):
-        return self._primary_az
+    def availability_zones(self):
+        return self._azs
 
-    @property
-    def primary_public_subnet(self):
-        return self._vpc.public_subnets[0]
+    # zone indexed lookups, index follows availability_zones
+    def availability_zone(self, index: int = 0):
+        return self._azs[index]
 
-    @property
-    def primary_private_subnet(self):
-        return self._vpc.private_subnets[0]
+    def subnet_id(self, tier: str, index: int = 0):
+        # tier: public, private or database
+        return Fn.element(self.subnet_ids(tier), index)
+
+    def subnet_ids(self, tier: str, zones: int = None):
+        # subnets of the first zones (all by default)
+        subnets = Token.as_list(getattr(self._vpc, f"{tier}_subnets_output"))
+        if zones is None or zones >= len(self._azs):
+            return subnets
+        return [Fn.element(subnets, index) for index in range(zones)]
 
     @property
-    def primary_database_subnet(self):
-        return self._vpc.database_subnets[0]
+    def primary_availability_zone(self):
+        return self._primary_az
 
     @property
     def primary_public_subnet_id(self):
-        return Fn.element(Token.as_list(self._vpc.public_subnets_output), 0)
+        return self.subnet_id("public")
 
     @property
     def primary_private_subnet_id(self):
-        return Fn.element(Token.as_list(self._vpc.private_subnets_output), 0)
+        return self.subnet_id("private")
 
     @property
     def primary_database_subnet_id(self):
-        return Fn.element(Token.as_list(self._vpc.database_subnets_output), 0)
+        return self.subnet_id("database")
 
     @property
     def vpc_sgroup(self):
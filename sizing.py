@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# Capacity profiles: instance types, task sizes, worker counts and database class that fit together.
+#
+#   capacity_profile("small")       named profile
+#   capacity_profile("2000")        smallest profile for 2000 active users
+#
+# A profile is checked when it is built (main.py, at synth time): every task fits on the instances it is placed
+# on, all tasks at their max counts fit in the ASGs, and every synapse process gets a usable DB connection pool.
+from typing import Mapping, Sequence
+
+# ECS host instance types: (vCPUs, memory MiB), graviton only (arm64 AMI)
+ECS_INSTANCE_RESOURCES = {
+    "a1.medium": (1, 2048),
+    "a1.large": (2, 4096),
+    "t4g.medium": (2, 4096),
+    "t4g.large": (2, 8192),
+    "t4g.xlarge": (4, 16384),
+    "m6g.medium": (1, 4096),
+    "m6g.large": (2, 8192),
+    "m6g.xlarge": (4, 16384),
+    "m6g.2xlarge": (8, 32768),
+    "m7g.medium": (1, 4096),
+    "m7g.large": (2, 8192),
+    "m7g.xlarge": (4, 16384),
+    "c6g.large": (2, 4096),
+    "c6g.xlarge": (4, 8192),
+    "c6g.2xlarge": (8, 16384),
+    "r6g.large": (2, 16384)
+}
+
+# instance memory in GiB, used to derive postgres defaults that depend on DBInstanceClassMemory
+DB_INSTANCE_MEMORY_GIB = {
+    "db.t4g.micro": 1,
+    "db.t4g.small": 2,
+    "db.t4g.medium": 4,
+    "db.t4g.large": 8,
+    "db.t4g.xlarge": 16,
+    "db.t4g.2xlarge": 32,
+    "db.m6g.large": 8,
+    "db.m6g.xlarge": 16,
+    "db.m6g.2xlarge": 32,
+    "db.m6g.4xlarge": 64,
+    "db.r6g.large": 16,
+    "db.r6g.xlarge": 32,
+    "db.r6g.2xlarge": 64,
+    "db.r6g.4xlarge": 128
+}
+
+# memory of the optional sidecars (metrics collector, log router), they have no reservation
+SIDECAR_MEMORY = 128
+
+# synapse default cp_min, a process needs at least that many connections
+SYNAPSE_MIN_DB_POOL = 5
+
+
+def ecs_instance_capacity(instance_type: str):
+    # (cpu units, memory MiB) ECS can place tasks on. the registered memory is below the nominal size
+    # (kernel, docker and the agent)
+    vcpus, memory = ECS_INSTANCE_RESOURCES[instance_type]
+    return vcpus * 1024, int(memory * 0.95) - 128
+
+
+def db_max_connections(instance_class: str):
+    # RDS postgres default: LEAST({DBInstanceClassMemory/9531392}, 5000)
+    return min(DB_INSTANCE_MEMORY_GIB[instance_class] * 1024 ** 3 // 9531392, 5000)
+
+
+def db_pool_size_per_client(max_connections: int, clients: int, connections_percent: int = 100, reserved: int = 3):
+    # connections a single client (e.g. a synapse process) may hold, leaving some for admin sessions
+    usable = (max_connections - reserved) * connections_percent // 100
+    return max(usable // max(clients, 1), 1)
+
+
+class _Config:
+    # the repr is part of the incremental synth input hashes, see synth_cache.py
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+class TaskConfig(_Config):
+    # sizing of one synapse process type: the main process or a worker pool
+    __slots__ = ("cpu", "memory_soft", "memory_hard", "count", "max_count", "spot")
+
+    def __init__(self, cpu: int, memory_soft: int, memory_hard: int, count: int = 1, max_count: int = None,
+                 spot: bool = False):
+        self.cpu = cpu
+        self.memory_soft = memory_soft
+        self.memory_hard = memory_hard
+        self.count = count
+        self.max_count = count if max_count is None else max_count
+        self.spot = spot
+        if not 0 < memory_soft <= memory_hard:
+            raise ValueError(f"memory_soft {memory_soft}MiB must be positive and at most memory_hard {memory_hard}MiB")
+        if not 0 <= count <= self.max_count:
+            raise ValueError(f"count {count} must be between 0 and max_count {self.max_count}")
+
+    def as_dict(self):
+        # service_config / worker pool keys
+        return {"cpu": self.cpu, "memory_soft": self.memory_soft, "memory_hard": self.memory_hard}
+
+
+class ServiceConfig(_Config):
+    # synapse main process and worker pools
+    __slots__ = ("main", "workers")
+
+    def __init__(self, main: TaskConfig, workers: Mapping[str, TaskConfig]):
+        self.main = main
+        self.workers = dict(workers)
+
+    def tasks(self):
+        return [("main", self.main)] + list(self.workers.items())
+
+
+class ClusterConfig(_Config):
+    # on-demand ASG and the spot ASG of the stateless workers
+    __slots__ = ("instance_type", "desired_capacity", "min_capacity", "max_capacity",
+                 "spot_instance_types", "spot_max_capacity")
+
+    def __init__(self, instance_type: str, min_capacity: int, max_capacity: int, desired_capacity: int = None,
+                 spot_instance_types: Sequence[str] = (), spot_max_capacity: int = 0):
+        unknown = [t for t in [instance_type, *spot_instance_types] if t not in ECS_INSTANCE_RESOURCES]
+        if unknown:
+            raise ValueError(f"Unknown ECS instance types {unknown}, add them to ECS_INSTANCE_RESOURCES")
+        self.instance_type = instance_type
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        self.desired_capacity = min_capacity if desired_capacity is None else desired_capacity
+        self.spot_instance_types = list(spot_instance_types)
+        self.spot_max_capacity = spot_max_capacity
+        if not 0 <= self.min_capacity <= self.desired_capacity <= self.max_capacity:
+            raise ValueError(f"cluster capacity needs min <= desired <= max, got {self.min_capacity}/"
+                             f"{self.desired_capacity}/{self.max_capacity}")
+
+    def instance_types(self, spot: bool):
+        return self.spot_instance_types if spot else [self.instance_type]
+
+    def max_instances(self, spot: bool):
+        return self.spot_max_capacity if spot else self.max_capacity
+
+
+class DbConfig(_Config):
+    # RDS instance and the proxy clients, one per synapse process at max scale
+    __slots__ = ("instance_class", "clients", "max_connections_percent")
+
+    def __init__(self, instance_class: str, clients: int = 1, max_connections_percent: int = 90):
+        if instance_class not in DB_INSTANCE_MEMORY_GIB:
+            raise ValueError(f"Unknown DB instance class '{instance_class}', add it to DB_INSTANCE_MEMORY_GIB")
+        self.instance_class = instance_class
+        self.clients = clients
+        self.max_connections_percent = max_connections_percent
+
+    @property
+    def max_connections(self):
+        return db_max_connections(self.instance_class)
+
+    @property
+    def pool_size(self):
+        # cp_max per synapse process
+        return db_pool_size_per_client(self.max_connections, self.clients, self.max_connections_percent)
+
+
+class CapacityProfile(_Config):
+    __slots__ = ("name", "users", "cluster", "service", "db", "cache_node_type", "sidecars")
+
+    def __init__(self, name: str, users: int, cluster: ClusterConfig, service: ServiceConfig, db: DbConfig,
+                 cache_node_type: str, sidecars: int = 0):
+        self.name = name
+        self.users = users
+        self.cluster = cluster
+        self.service = service
+        self.db = db
+        self.cache_node_type = cache_node_type
+        self.sidecars = sidecars
+        # every process holds its own pool, scaled pools at their max
+        self.db.clients = sum(task.max_count for _, task in service.tasks())
+        self._check_tasks()
+        self._check_capacity()
+        self._check_db()
+
+    def _check_tasks(self):
+        # a task must fit on the smallest instance type it can be placed on
+        overhead = self.sidecars * SIDECAR_MEMORY
+        for name, task in self.service.tasks():
+            instance_types = self.cluster.instance_types(task.spot)
+            if not instance_types:
+                raise ValueError(f"{self.name}: '{name}' runs on spot, but the cluster has no spot instance types")
+            for instance_type in instance_types:
+                cpu, memory = ecs_instance_capacity(instance_type)
+                if task.memory_hard + overhead > memory or task.cpu > cpu:
+                    raise ValueError(f"{self.name}: '{name}' task ({task.cpu} cpu, {task.memory_hard}+{overhead}MiB) "
+                                     f"does not fit on {instance_type} ({cpu} cpu, {memory}MiB usable)")
+
+    def _check_capacity(self):
+        # all tasks at their max counts fit in the ASGs at max size, by reservation
+        overhead = self.sidecars * SIDECAR_MEMORY
+        for spot in (False, True):
+            tasks = [task for _, task in self.service.tasks() if task.spot == spot]
+            if not tasks:
+                continue
+            cpu = sum(task.cpu * task.max_count for task in tasks)
+            memory = sum((task.memory_soft + overhead) * task.max_count for task in tasks)
+            capacity = [ecs_instance_capacity(t) for t in self.cluster.instance_types(spot)]
+            instances = self.cluster.max_instances(spot)
+            cpu_capacity = min(c for c, _ in capacity) * instances
+            memory_capacity = min(m for _, m in capacity) * instances
+            if cpu > cpu_capacity or memory > memory_capacity:
+                group = "spot" if spot else "on-demand"
+                raise ValueError(f"{self.name}: {group} tasks at max scale need {cpu} cpu / {memory}MiB, {instances} "
+                                 f"{group} instances provide {cpu_capacity} cpu / {memory_capacity}MiB")
+
+    def _check_db(self):
+        if self.db.pool_size < SYNAPSE_MIN_DB_POOL:
+            raise ValueError(f"{self.name}: {self.db.clients} synapse processes get {self.db.pool_size} DB connections "
+                             f"each on {self.db.instance_class} ({self.db.max_connections} max), "
+                             f"synapse needs at least {SYNAPSE_MIN_DB_POOL}")
+
+
+def _profile_small():
+    return dict(
+        users=100,
+        cluster=ClusterConfig("a1.medium", min_capacity=1, max_capacity=4,
+                              spot_instance_types=["t4g.medium", "m6g.medium", "c6g.large", "m7g.medium"],
+                              spot_max_capacity=6),
+        service=ServiceConfig(
+            main=TaskConfig(128, 512, 1024),
+            workers={"generic-worker": TaskConfig(128, 512, 1024, count=2, max_count=6, spot=True),
+                     "synchrotron": TaskConfig(128, 512, 1024, count=1, max_count=3, spot=True),
+                     "media-repository": TaskConfig(128, 512, 1024, count=1, spot=True),
+                     "federation-sender": TaskConfig(128, 512, 1024, count=1)}),
+        db=DbConfig("db.t4g.micro"),
+        cache_node_type="cache.t4g.micro")
+
+
+def _profile_medium():
+    return dict(
+        users=1000,
+        cluster=ClusterConfig("m6g.large", min_capacity=1, max_capacity=3,
+                              spot_instance_types=["m6g.large", "m7g.large", "t4g.large", "c6g.xlarge"],
+                              spot_max_capacity=8),
+        service=ServiceConfig(
+            main=TaskConfig(512, 1536, 2048),
+            workers={"generic-worker": TaskConfig(256, 768, 1536, count=3, max_count=9, spot=True),
+                     "synchrotron": TaskConfig(256, 1024, 1536, count=2, max_count=6, spot=True),
+                     "media-repository": TaskConfig(256, 512, 1024, count=1, spot=True),
+                     "federation-sender": TaskConfig(256, 768, 1536, count=1)}),
+        db=DbConfig("db.t4g.medium"),
+        cache_node_type="cache.t4g.small")
+
+
+def _profile_large():
+    return dict(
+        users=5000,
+        cluster=ClusterConfig("m6g.xlarge", min_capacity=2, max_capacity=4,
+                              spot_instance_types=["m6g.xlarge", "m7g.xlarge", "c6g.2xlarge"],
+                              spot_max_capacity=12),
+        service=ServiceConfig(
+            main=TaskConfig(1024, 3072, 4096),
+            workers={"generic-worker": TaskConfig(512, 1024, 2048, count=6, max_count=18, spot=True),
+                     "synchrotron": TaskConfig(512, 1536, 2048, count=4, max_count=12, spot=True),
+                     "media-repository": TaskConfig(512, 768, 1536, count=2, spot=True),
+                     "federation-sender": TaskConfig(512, 1024, 2048, count=1)}),
+        db=DbConfig("db.m6g.large"),
+        cache_node_type="cache.t4g.medium")
+
+
+# name -> profile arguments, smallest first
+PROFILES = {
+    "small": _profile_small,
+    "medium": _profile_medium,
+    "large": _profile_large
+}
+
+
+def capacity_profile(name: str, sidecars: int = 0, instance_type: str = None, db_instance_class: str = None,
+                     worker_counts: Mapping[str, int] = None):
+    # a named profile, or the smallest one for a number of active users. the overrides are checked with the rest
+    if name.isdigit():
+        users = int(name)
+        fitting = [profile for profile, args in PROFILES.items() if args()["users"] >= users]
+        if not fitting:
+            raise ValueError(f"No capacity profile for {users} users, the largest is sized for "
+                             f"{list(PROFILES.values())[-1]()['users']}")
+        name = fitting[0]
+    if name not in PROFILES:
+        raise ValueError(f"Unknown capacity profile '{name}', available: {list(PROFILES)}")
+
+    args = PROFILES[name]()
+    if instance_type:
+        cluster = args["cluster"]
+        args["cluster"] = ClusterConfig(instance_type, cluster.min_capacity, cluster.max_capacity,
+                                        cluster.desired_capacity, cluster.spot_instance_types,
+                                        cluster.spot_max_capacity)
+    if db_instance_class:
+        args["db"] = DbConfig(db_instance_class, max_connections_percent=args["db"].max_connections_percent)
+    for pool, count in (worker_counts or {}).items():
+        if pool not in args["service"].workers:
+            raise ValueError(f"Unknown worker pool '{pool}' in profile '{name}'")
+        task = args["service"].workers[pool]
+        # keep the profile's scale-out ratio
+        args["service"].workers[pool] = TaskConfig(task.cpu, task.memory_soft, task.memory_hard, count,
+                                                   count * task.max_count // max(task.count, 1), task.spot)
+    return CapacityProfile(name, sidecars=sidecars, **args)
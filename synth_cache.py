@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# Incremental synthesis: per stack content hashes, cached cdktf output and a manifest of changed stacks.
+#
+# A stack's input hash covers its builder source, the globals the builder reads, the local modules it
+# imports (transitively), cdktf.json and the input hashes of its dependencies. Only stacks whose inputs changed, plus
+# their dependents, are synthesized fresh. Dependencies built just to resolve cross-stack references are
+# restored from the cache, since their fresh output only holds the outputs used by the stacks built now.
+import ast
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable
+
+CACHE_DIR = ".synth-cache"
+CHANGED_MANIFEST = "changed-stacks.json"
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def local_module_files(source: str, root: str = ROOT_DIR, seen: set = None):
+    # files of the repo modules imported by the given source, transitively
+    seen = set() if seen is None else seen
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.ImportFrom) and node.module:
+            modules = [node.module]
+        elif isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        else:
+            continue
+        for module in modules:
+            path = os.path.join(root, *module.split(".")) + ".py"
+            if os.path.isfile(path) and path not in seen:
+                seen.add(path)
+                with open(path) as module_file:
+                    local_module_files(module_file.read(), root, seen)
+    return seen
+
+
+def stack_input_hashes(stacks: dict, settings: dict, root: str = ROOT_DIR):
+    # stacks: name -> (dependencies, builder), in build order. settings: globals builders may read
+    hashes = {}
+    for name, (dependencies, builder) in stacks.items():
+        source = inspect.getsource(builder)
+        digest = hashlib.sha256(source.encode())
+        for global_name in sorted(set(builder.__code__.co_names) & set(settings)):
+            digest.update(f"{global_name}={settings[global_name]!r}".encode())
+        # cdktf.json pins the provider versions the generated bindings come from
+        for path in [os.path.join(root, "cdktf.json")] + sorted(local_module_files(source, root)):
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as module_file:
+                digest.update(module_file.read())
+        for dependency in dependencies:
+            digest.update(hashes[dependency].encode())
+        hashes[name] = digest.hexdigest()
+    return hashes
+
+
+def dependency_closure(stacks: dict, names: set):
+    closure = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in closure:
+            closure.add(name)
+            pending.extend(stacks[name][0])
+    return closure
+
+
+def dependents_closure(stacks: dict, names: set):
+    closure = set(names)
+    grown = True
+    while grown:
+        grown = False
+        for name, (dependencies, _) in stacks.items():
+            if name not in closure and closure & set(dependencies):
+                closure.add(name)
+                grown = True
+    return closure
+
+
+def output_hash(stack_dir: str):
+    digest = hashlib.sha256()
+    for dir_path, _, file_names in sorted(os.walk(stack_dir)):
+        for file_name in sorted(file_names):
+            with open(os.path.join(dir_path, file_name), "rb") as stack_file:
+                digest.update(file_name.encode())
+                digest.update(stack_file.read())
+    return digest.hexdigest()
+
+
+def output_names(stack_dir: str):
+    with open(os.path.join(stack_dir, "cdk.tf.json")) as stack_file:
+        return set(json.load(stack_file).get("output", {}))
+
+
+class SynthCache:
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        self._cache_dir = cache_dir
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._index = {"version": "", "stacks": {}}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as index_file:
+                self._index = json.load(index_file)
+
+    @property
+    def manifest_version(self):
+        return self._index["version"]
+
+    @manifest_version.setter
+    def manifest_version(self, version: str):
+        self._index["version"] = version
+
+    def entry(self, name: str):
+        return self._index["stacks"].get(name)
+
+    def stack_dir(self, name: str):
+        return os.path.join(self._cache_dir, "stacks", name)
+
+    def store(self, name: str, input_hash: str, stack_dir: str, manifest_entry: dict):
+        shutil.rmtree(self.stack_dir(name), ignore_errors=True)
+        shutil.copytree(stack_dir, self.stack_dir(name))
+        self._index["stacks"][name] = {"input_hash": input_hash,
+                                       "output_hash": output_hash(stack_dir),
+                                       "manifest": manifest_entry}
+
+    def pending(self):
+        # stacks whose last synthesized output was not deployed yet
+        deployed = self._index.get("deployed", {})
+        return [name for name, entry in self._index["stacks"].items() if deployed.get(name) != entry["output_hash"]]
+
+    def mark_deployed(self, names: list):
+        deployed = self._index.setdefault("deployed", {})
+        for name in names:
+            deployed[name] = self._index["stacks"][name]["output_hash"]
+
+    def save(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        with open(self._index_path, "w") as index_file:
+            json.dump(self._index, index_file, indent=2, sort_keys=True)
+
+
+def incremental_synth(stacks: dict, targets: list, synth: Callable[[str, list], None], settings: dict,
+                      outdir: str, cache_dir: str = CACHE_DIR):
+    # synth(outdir, names) must build the given (dependency closed) stacks and synthesize them into outdir.
+    # returns the names of the stacks whose synthesized output changed
+    cache = SynthCache(cache_dir)
+    names = dependency_closure(stacks, set(targets or stacks))
+    input_hashes = stack_input_hashes(stacks, settings)
+
+    changed_inputs = {name for name in names
+                      if (cache.entry(name) or {}).get("input_hash") != input_hashes[name]
+                      or not os.path.isdir(cache.stack_dir(name))}
+    fresh = {}
+    manifest_entries = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        while changed_inputs:
+            # dependents of a changed stack are rebuilt too (even if not targeted), so its cross-stack
+            # outputs are complete
+            rebuilt = dependents_closure(stacks, changed_inputs)
+            build_dir = tempfile.mkdtemp(dir=work_dir)
+            synth(build_dir, [name for name in stacks if name in dependency_closure(stacks, rebuilt)])
+            with open(os.path.join(build_dir, "manifest.json")) as manifest_file:
+                manifest = json.load(manifest_file)
+            built = manifest["stacks"]
+
+            # a cached dependency is only reusable if it already has every output the rebuilt stacks use,
+            # dependencies never cached (cold cache) are rebuilt as well
+            missing = {name for name in built if name not in rebuilt and
+                       (not os.path.isdir(cache.stack_dir(name)) or
+                        not output_names(os.path.join(build_dir, "stacks", name)) <= output_names(cache.stack_dir(name)))}
+            if missing:
+                changed_inputs |= missing
+                continue
+
+            for name in rebuilt:
+                fresh[name] = os.path.join(build_dir, "stacks", name)
+                manifest_entries[name] = built[name]
+            cache.manifest_version = manifest["version"]
+            names |= set(built)
+            break
+
+        # assemble the output dir from fresh and cached stacks
+        changed = []
+        for name in [name for name in stacks if name in names]:
+            target_dir = os.path.join(outdir, "stacks", name)
+            shutil.rmtree(target_dir, ignore_errors=True)
+            if name in fresh:
+                if output_hash(fresh[name]) != (cache.entry(name) or {}).get("output_hash"):
+                    changed.append(name)
+                shutil.copytree(fresh[name], target_dir)
+                cache.store(name, input_hashes[name], fresh[name], manifest_entries[name])
+            else:
+                shutil.copytree(cache.stack_dir(name), target_dir)
+                manifest_entries[name] = cache.entry(name)["manifest"]
+
+    cache.save()
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, "manifest.json"), "w") as manifest_file:
+        json.dump({"version": cache.manifest_version, "stacks": manifest_entries}, manifest_file, indent=2)
+    with open(os.path.join(outdir, CHANGED_MANIFEST), "w") as changed_file:
+        json.dump(changed, changed_file, indent=2)
+    return changed
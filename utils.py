@@ -1,22 +1,44 @@
 #!/usr/bin/env python
 import json
+import re
 from typing import Sequence
 
-from cdktf import S3Backend, TerraformStack, Token, Fn
+from cdktf import S3Backend, TerraformStack, Token, Fn, TerraformResourceLifecycle
 from constructs import Construct
 
+from imports.aws.appautoscaling_policy import (
+    AppautoscalingPolicy, AppautoscalingPolicyStepScalingPolicyConfiguration,
+    AppautoscalingPolicyStepScalingPolicyConfigurationStepAdjustment,
+    AppautoscalingPolicyTargetTrackingScalingPolicyConfiguration,
+    AppautoscalingPolicyTargetTrackingScalingPolicyConfigurationPredefinedMetricSpecification)
+from imports.aws.appautoscaling_scheduled_action import (
+    AppautoscalingScheduledAction, AppautoscalingScheduledActionScalableTargetAction)
+from imports.aws.appautoscaling_target import AppautoscalingTarget
 from imports.aws.cloudwatch_log_group import CloudwatchLogGroup
+from imports.aws.cloudwatch_metric_alarm import CloudwatchMetricAlarm
+from imports.aws.data_aws_acm_certificate import DataAwsAcmCertificate
+from imports.aws.data_aws_ecr_image import DataAwsEcrImage
 from imports.aws.data_aws_iam_policy_document import (
     DataAwsIamPolicyDocument, DataAwsIamPolicyDocumentStatement,
     DataAwsIamPolicyDocumentStatementPrincipals)
+from imports.aws.data_aws_route53_zone import DataAwsRoute53Zone
 from imports.aws.ecs_service import (EcsService,
+                                     EcsServiceCapacityProviderStrategy,
+                                     EcsServiceDeploymentCircuitBreaker,
+                                     EcsServiceLoadBalancer,
                                      EcsServiceNetworkConfiguration,
+                                     EcsServiceOrderedPlacementStrategy,
+                                     EcsServicePlacementConstraints,
                                      EcsServiceServiceRegistries)
 from imports.aws.ecs_task_definition import EcsTaskDefinition, EcsTaskDefinitionVolume, EcsTaskDefinitionVolumeEfsVolumeConfiguration
 from imports.aws.iam_policy import IamPolicy
 from imports.aws.iam_role import IamRole
 from imports.aws.iam_role_policy_attachment import IamRolePolicyAttachment
+from imports.aws.lb_listener_rule import (LbListenerRule, LbListenerRuleAction, LbListenerRuleCondition,
+                                          LbListenerRuleConditionHttpRequestMethod, LbListenerRuleConditionPathPattern)
+from imports.aws.lb_target_group import LbTargetGroup, LbTargetGroupHealthCheck
 from imports.aws.provider import AwsProvider
+from imports.aws.route53_record import Route53Record, Route53RecordAlias
 from imports.aws.service_discovery_service import (
     ServiceDiscoveryService, ServiceDiscoveryServiceDnsConfig,
     ServiceDiscoveryServiceDnsConfigDnsRecords,
@@ -24,6 +46,113 @@ from imports.aws.service_discovery_service import (
 from imports.aws.apigatewayv2_integration import Apigatewayv2Integration
 from imports.aws.apigatewayv2_route import Apigatewayv2Route
 
+# target tracking metrics, ALB request count also needs a "resource_label" of the target group
+TARGET_TRACKING_METRICS = {
+    "cpu": "ECSServiceAverageCPUUtilization",
+    "memory": "ECSServiceAverageMemoryUtilization",
+    "alb_request_count": "ALBRequestCountPerTarget"
+}
+
+# named task placement strategies -> (type, field), applied in the given order
+PLACEMENT_STRATEGIES = {
+    "spread_az": ("spread", "attribute:ecs.availability-zone"),
+    "spread_instance": ("spread", "instanceId"),
+    "binpack_memory": ("binpack", "memory"),
+    "binpack_cpu": ("binpack", "cpu"),
+    "random": ("random", None)
+}
+
+# ADOT collector sidecar, scrapes the service prometheus endpoint
+ADOT_IMAGE = "public.ecr.aws/aws-observability/aws-otel-collector:v0.40.0"
+METRICS_CONTAINER = "adot-collector"
+
+# FireLens log router sidecar, its generated config includes LOG_ROUTER_CONFIG_PATH
+LOG_ROUTER_IMAGE = "public.ecr.aws/aws-observability/aws-for-fluent-bit:stable"
+LOG_ROUTER_CONTAINER = "log-router"
+LOG_ROUTER_CONFIG_PATH = "/fluent-bit/etc/extra.conf"
+
+DOCKER_HUB = "docker.io"
+
+
+def parse_image(image: str):
+    # "[registry/]repository[:tag][@digest]" -> (registry, repository, tag, digest), docker hub without a registry
+    name, _, digest = image.partition("@")
+    registry, _, path = name.partition("/")
+    if not path or not ("." in registry or ":" in registry or registry == "localhost"):
+        registry, path = DOCKER_HUB, name
+    if registry == DOCKER_HUB and "/" not in path:
+        path = f"library/{path}"
+    repository, _, tag = path.partition(":")
+    return registry, repository, tag or (None if digest else "latest"), digest or None
+
+
+def fluent_bit_config(region: str, log_group_name: str, stream_prefix: str, log_router: dict):
+    # FireLens tags records "<container>-firelens-<task id>". access lines are tagged for firehose, lines matching
+    # cloudwatch_pattern (warnings and errors) for cloudwatch, everything else is archived or dropped.
+    # rewrite_tag rules are space separated, patterns have to use \s
+    patterns = [log_router["access_pattern"], log_router["cloudwatch_pattern"]] + log_router.get("drop", [])
+    if any(" " in pattern for pattern in patterns):
+        raise ValueError(f"log router patterns can't contain spaces, use \\s: {patterns}")
+
+    sections = [("SERVICE", [("Flush", log_router.get("flush", 5)),
+                             ("Grace", 30)])]
+    for pattern in log_router.get("drop", []):
+        sections.append(("FILTER", [("Name", "grep"),
+                                    ("Match", "*-firelens-*"),
+                                    ("Exclude", f"log {pattern}")]))
+    sections.append(("FILTER", [("Name", "rewrite_tag"),
+                                ("Match", "*-firelens-*"),
+                                ("Rule", f"$log {log_router['access_pattern']} access false"),
+                                ("Rule", f"$log {log_router['cloudwatch_pattern']} cloudwatch false"),
+                                ("Emitter_Mem_Buf_Limit", log_router.get("emitter_buffer", "10M"))]))
+    # caps bursts of repeated errors, records over the rate are dropped
+    sample = log_router.get("sample")
+    if sample:
+        sections.append(("FILTER", [("Name", "throttle"),
+                                    ("Match", "cloudwatch"),
+                                    ("Rate", sample["rate"]),
+                                    ("Window", sample.get("window", 60)),
+                                    ("Interval", sample.get("interval", "1s"))]))
+    sections.append(("OUTPUT", [("Name", "cloudwatch_logs"),
+                                ("Match", "cloudwatch"),
+                                ("region", region),
+                                ("log_group_name", log_group_name),
+                                ("log_stream_prefix", f"{stream_prefix}-")]))
+    archived = ["access"] + (["*-firelens-*"] if log_router.get("archive_app_logs") else [])
+    for match in archived:
+        sections.append(("OUTPUT", [("Name", "kinesis_firehose"),
+                                    ("Match", match),
+                                    ("region", region),
+                                    ("delivery_stream", log_router["delivery_stream"]),
+                                    ("time_key", "time")]))
+    return "\n".join(f"[{name}]\n" + "".join(f"    {key} {value}\n" for key, value in options)
+                     for name, options in sections)
+
+
+# ALB listener rule limits: condition values and wildcards per rule
+ALB_RULE_MAX_VALUES = 5
+ALB_RULE_MAX_WILDCARDS = 5
+
+
+def alb_rule_conditions(routes: Sequence[str]):
+    # API Gateway route keys ("GET /_matrix/client/{version}/sync") to ALB rule conditions, packed into as few
+    # rules as the limits allow. returns [(method or None, [path patterns])]
+    rules = []
+    for route in routes:
+        method, path = route.split(" ", 1)
+        method = None if method == "ANY" else method
+        pattern = re.sub(r"{[^}]+}", "*", path)
+        wildcards = pattern.count("*")
+        for rule_method, patterns in rules:
+            values = len(patterns) + 1 + (1 if method else 0)
+            if rule_method == method and values <= ALB_RULE_MAX_VALUES and \
+                    sum(p.count("*") for p in patterns) + wildcards <= ALB_RULE_MAX_WILDCARDS:
+                patterns.append(pattern)
+                break
+        else:
+            rules.append((method, [pattern]))
+    return rules
+
 
 class ExtendedTerraformStack(TerraformStack):
     def __init__(self, scope: Construct, ns: str, provider_config: dict, state_config: dict):
@@ -41,6 +170,23 @@ class ExtendedTerraformStack(TerraformStack):
                                   region=state_config["region"]
                                   )
 
+    def _initCertificate(self, certificate_name: str, provider: AwsProvider = None):
+        return DataAwsAcmCertificate(self, "main_cert", domain=certificate_name, provider=provider)
+
+    def _initDnsAlias(self, construct_id: str, domain_name: str, alias_name: str, alias_zone_id: str, zone_name: str = None):
+        # A record aliasing the domain to a regional endpoint (API Gateway domain, load balancer)
+        zone = DataAwsRoute53Zone(self, "hosted_zone", name=zone_name or domain_name)
+        return Route53Record(self, construct_id,
+                             zone_id=zone.id,
+                             name=domain_name,
+                             type="A",
+                             alias=[Route53RecordAlias(
+                                 zone_id=alias_zone_id,
+                                 name=alias_name,
+                                 evaluate_target_health=True
+                             )]
+                             )
+
 
 class EcsServiceStack(ExtendedTerraformStack):
     def __init__(self, scope: Construct, ns: str,
@@ -48,44 +194,94 @@ class EcsServiceStack(ExtendedTerraformStack):
                  state_config: dict,
                  service_config: dict):
         super().__init__(scope, ns, provider_config, state_config)
+        self._region = provider_config["region"]
+        self._log_group_name = f"log-group-{service_config['service_name']}"
+        # images are pulled from the regional ECR mirror / pull-through cache when configured, see shared/ecr.py
+        self._ecr = service_config.get("ecr")
+        self._ecr_images = {}
 
         # init Service in Service discovery registry
-        self._initServiceDiscovery(service_config)
+        self._reg_srv = self._initServiceDiscovery(service_config)
+
+        # behind the ALB ingress the service registers its tasks in a target group
+        self._target_group = self._initTargetGroup(service_config) if "alb_listener_arns" in service_config else None
+        # further target groups of the service, e.g. internal endpoints on another container port
+        self._extra_targets = self._initExtraTargets(service_config)
 
         # cloudwatch logs
         log_group = CloudwatchLogGroup(self, f"LogGroup_{service_config['service_name']}",
-                                       name=f"log-group-{service_config['service_name']}",
+                                       name=self._log_group_name,
                                        retention_in_days=7)
+
+        # remote write to AMP needs the workspace, an empty arn would only fail at apply
+        metrics = service_config.get("metrics")
+        if metrics and metrics.get("exporter", "emf") != "emf":
+            missing = [key for key in ("amp_workspace_arn", "amp_remote_write_url") if not metrics.get(key)]
+            if missing:
+                raise ValueError(f"The amp metrics exporter needs {', '.join(missing)}")
+
+        # embedded metric format logs of the metrics sidecar
+        self._metrics_log_group = None
+        if metrics and metrics.get("exporter", "emf") == "emf":
+            self._metrics_log_group = CloudwatchLogGroup(self, "LogGroup_metrics",
+                                                         name=f"/metrics/{service_config['service_name']}",
+                                                         retention_in_days=metrics.get("retention_in_days", 14))
+
         # init IAM Roles and Polices
-        self._initIAMRoles(service_config["service_name"], log_group.arn)
+        self._initIAMRoles(service_config["service_name"], log_group.arn,
+                           service_config.get("media_store", {}).get("bucket_arn"),
+                           metrics,
+                           service_config.get("log_router"))
 
         # init Ecs Service
-        self._initEcsService(provider_config["region"],
-                             service_config["subnets_ids"],
-                             service_config["sec_group_id"],
-                             f"log-group-{service_config['service_name']}",
-                             service_config)
-
-        # init GW route
-        self._initGatewayRoute(service_config["service_name"],
-                               service_config["api_gw_id"],
-                               service_config["vpc_link_id"],
-                               self._reg_srv.arn,
-                               service_config["route_key"])
-
-    def _initEcsService(self, region: str, subnets_ids: Sequence[str], sg_ecs_id: str, log_group_name: str, service_config: dict):
+        self._ecs_service = self._initEcsService(self._region,
+                                                 service_config["subnets_ids"],
+                                                 service_config["sec_group_id"],
+                                                 self._log_group_name,
+                                                 service_config,
+                                                 self._reg_srv.arn,
+                                                 target_group=self._target_group,
+                                                 extra_targets=self._extra_targets)
+
+        # init Service auto scaling
+        self._initAutoScaling(service_config, self._ecs_service, target_group=self._target_group)
+
+        # init ALB listener rules or GW route
+        if self._target_group:
+            self._initListenerRules(service_config["service_name"],
+                                    service_config["alb_listener_arns"],
+                                    self._target_group.arn,
+                                    [service_config["route_key"]],
+                                    service_config.get("alb_priority", 1))
+        else:
+            self._initGatewayRoute(service_config["service_name"],
+                                   service_config["api_gw_id"],
+                                   service_config["vpc_link_id"],
+                                   self._reg_srv.arn,
+                                   [service_config["route_key"]])
+
+    def _initEcsService(self, region: str, subnets_ids: Sequence[str], sg_ecs_id: str, log_group_name: str,
+                        service_config: dict, registry_arn: str, construct_suffix: str = "",
+                        target_group: LbTargetGroup = None, extra_targets: Sequence = ()):
         service_name = service_config["service_name"]
         efs_volume_name = f"{service_name}-EfsVolume"
         mount_path = service_config["mount_path"]
+        env_vars = service_config["env_vars"]
+        # awsvpc: a trunked ENI per task, the container port is the task's own port.
+        # bridge: hostPort 0 picks a dynamic host port
+        awsvpc = service_config.get("network_mode", "bridge") == "awsvpc"
+        port_mappings = [service_config["port_mappings"]] + service_config.get("extra_port_mappings", [])
+        if awsvpc:
+            port_mappings = [{**mapping, "hostPort": mapping["containerPort"]} for mapping in port_mappings]
         task = [{
             "name": service_name,
-            "image": service_config["image"],
+            "image": self._initImage(service_config["image"]),
             "cpu": service_config["cpu"],
             "memory": service_config["memory_hard"],
             "memoryReservation": service_config["memory_soft"],
             "essential": True,
-            "environment": [service_config["env_vars"]],
-            "portMappings": [service_config["port_mappings"]],
+            "environment": env_vars if isinstance(env_vars, list) else [env_vars],
+            "portMappings": port_mappings,
             "logConfiguration": {
                 "logDriver": "awslogs",
                 "options": {
@@ -102,6 +298,42 @@ class EcsServiceStack(ExtendedTerraformStack):
             ]
 
         }]
+        # optional process overrides, e.g. to start a worker instead of the image default
+        for key, container_key in (("entry_point", "entryPoint"), ("command", "command"), ("user", "user")):
+            if key in service_config:
+                task[0][container_key] = service_config[key]
+
+        # container health check - ECS reports it to the custom health check of the Cloud Map registration,
+        # so tasks only receive traffic once they are healthy
+        health_check = service_config.get("health_check")
+        if health_check:
+            container_port = service_config["port_mappings"]["containerPort"]
+            task[0]["healthCheck"] = {
+                "command": ["CMD-SHELL", f"curl -fSs http://localhost:{container_port}{health_check['path']} || exit 1"],
+                "interval": health_check.get("interval", 15),
+                "timeout": health_check.get("timeout", 5),
+                "retries": health_check.get("retries", 3),
+                # migrations and cache warm-up, failures don't count during this period
+                "startPeriod": health_check.get("start_period", 120)
+            }
+
+        # ship the service logs through the FireLens log router instead of awslogs
+        if service_config.get("log_router"):
+            task[0]["logConfiguration"] = {
+                "logDriver": "awsfirelens",
+                "options": {"log-driver-buffer-limit": str(service_config["log_router"].get("buffer_limit", 4096))}
+            }
+            task[0]["dependsOn"] = [{"containerName": LOG_ROUTER_CONTAINER, "condition": "START"}]
+            task.append(self._log_router_sidecar(region, log_group_name, service_config))
+
+        # metrics collector next to the service container
+        if service_config.get("metrics"):
+            task.append(self._metrics_sidecar(region, log_group_name, service_config))
+
+        # task scoped scratch volumes (docker managed, removed with the task), e.g. for local caches
+        scratch_volumes = service_config.get("scratch_volumes", {})
+        for volume_name, container_path in scratch_volumes.items():
+            task[0]["mountPoints"].append({"sourceVolume": volume_name, "containerPath": container_path})
 
         efs_volume = EcsTaskDefinitionVolume(name=efs_volume_name,                              efs_volume_configuration=EcsTaskDefinitionVolumeEfsVolumeConfiguration(
             file_system_id=service_config["efs_id"],
@@ -110,29 +342,280 @@ class EcsServiceStack(ExtendedTerraformStack):
 
         ))
 
-        task_tef = EcsTaskDefinition(self, "TaskDef",
+        task_tef = EcsTaskDefinition(self, f"TaskDef{construct_suffix}",
                                      family=service_name,
-                                     cpu=str(service_config["cpu"]),
-                                     memory=str(service_config["memory_hard"]),
+                                     # task size covers every container, sidecars included
+                                     cpu=str(sum(container["cpu"] for container in task)),
+                                     memory=str(sum(container["memory"] for container in task)),
                                      requires_compatibilities=[service_config["cluster_type"]],
+                                     network_mode="awsvpc" if awsvpc else "bridge",
                                      execution_role_arn=self._role_task_execution.arn,
                                      task_role_arn=self._role_task.arn,
                                      container_definitions=json.dumps(task),
-                                     volume=[efs_volume])
-
-        self._ecs_service = EcsService(self, "EcsService",
-                                       name=service_name,
-                                       cluster=service_config["cluster_id"],
-                                       task_definition=task_tef.arn,
-                                       launch_type=service_config["cluster_type"],
-                                       desired_count=1,
-                                       service_registries=EcsServiceServiceRegistries(
-                                           registry_arn=self._reg_srv.arn,
-                                           container_name=service_name,
-                                           container_port=service_config["port"])
-                                       )
+                                     volume=[efs_volume] + [EcsTaskDefinitionVolume(name=volume_name)
+                                                            for volume_name in scratch_volumes])
+
+        # with auto scaling, the task count is owned by the scalable target
+        scaling = service_config.get("scaling")
+        # placing through the cluster capacity provider lets the cluster grow with the tasks
+        capacity_provider = service_config.get("capacity_provider")
+        # rolling deploys: keep healthy tasks until replacements pass their health checks, roll back on failure
+        deployment = service_config.get("deployment", {})
+        return EcsService(self, f"EcsService{construct_suffix}",
+                          name=service_name,
+                          cluster=service_config["cluster_id"],
+                          task_definition=task_tef.arn,
+                          launch_type=None if capacity_provider else service_config["cluster_type"],
+                          capacity_provider_strategy=[EcsServiceCapacityProviderStrategy(
+                              capacity_provider=capacity_provider,
+                              weight=100)] if capacity_provider else None,
+                          desired_count=scaling["min_capacity"] if scaling else service_config.get("desired_count", 1),
+                          network_configuration=EcsServiceNetworkConfiguration(
+                              subnets=subnets_ids,
+                              security_groups=[sg_ecs_id]) if awsvpc else None,
+                          # e.g. spread over zones, then pack instances by memory
+                          ordered_placement_strategy=[EcsServiceOrderedPlacementStrategy(
+                              type=PLACEMENT_STRATEGIES[strategy][0],
+                              field=PLACEMENT_STRATEGIES[strategy][1])
+                              for strategy in service_config.get("placement_strategy", [])] or None,
+                          placement_constraints=[EcsServicePlacementConstraints(
+                              type=constraint["type"],
+                              expression=constraint.get("expression"))
+                              for constraint in service_config.get("placement_constraints", [])] or None,
+                          service_registries=EcsServiceServiceRegistries(
+                              registry_arn=registry_arn,
+                              container_name=service_name,
+                              container_port=service_config["port"]),
+                          load_balancer=[EcsServiceLoadBalancer(
+                              target_group_arn=group.arn,
+                              container_name=service_name,
+                              container_port=port)
+                              for group, port in ([(target_group, service_config["port"])] if target_group else [])
+                              + list(extra_targets)] or None,
+                          # don't let failing load balancer health checks replace tasks still starting up
+                          health_check_grace_period_seconds=service_config.get("health_check", {}).get(
+                              "start_period", 120) if target_group or extra_targets else None,
+                          deployment_minimum_healthy_percent=deployment.get("minimum_healthy_percent", 100),
+                          deployment_maximum_percent=deployment.get("maximum_percent", 200),
+                          deployment_circuit_breaker=EcsServiceDeploymentCircuitBreaker(
+                              enable=deployment.get("circuit_breaker", True),
+                              rollback=deployment.get("circuit_breaker", True)),
+                          lifecycle=TerraformResourceLifecycle(ignore_changes=["desired_count"]) if scaling else None
+                          )
+
+    def _initAutoScaling(self, service_config: dict, ecs_service: EcsService, construct_suffix: str = "",
+                         target_group: LbTargetGroup = None):
+        scaling = service_config.get("scaling")
+        if not scaling:
+            return None
+
+        cluster_name = service_config["cluster_name"]
+        target = AppautoscalingTarget(self, f"ScalingTarget{construct_suffix}",
+                                      service_namespace="ecs",
+                                      scalable_dimension="ecs:service:DesiredCount",
+                                      resource_id=f"service/{cluster_name}/{ecs_service.name}",
+                                      min_capacity=scaling["min_capacity"],
+                                      max_capacity=scaling["max_capacity"])
 
-    def _initIAMRoles(self, service_name: str, log_group_arn: str):
+        # target tracking - keep a metric around a target value
+        for policy in scaling.get("target_tracking", []):
+            metric_type = TARGET_TRACKING_METRICS[policy["metric"]]
+            resource_label = policy.get("resource_label")
+            if policy["metric"] == "alb_request_count" and not resource_label and target_group:
+                resource_label = f"{service_config['alb_arn_suffix']}/{target_group.arn_suffix}"
+            AppautoscalingPolicy(self, f"ScalingPolicy{construct_suffix}_{policy['metric']}",
+                                 name=f"scale-{service_config['service_name']}-{policy['metric']}",
+                                 policy_type="TargetTrackingScaling",
+                                 service_namespace=target.service_namespace,
+                                 scalable_dimension=target.scalable_dimension,
+                                 resource_id=target.resource_id,
+                                 target_tracking_scaling_policy_configuration=AppautoscalingPolicyTargetTrackingScalingPolicyConfiguration(
+                                     target_value=policy["target"],
+                                     scale_in_cooldown=policy.get("scale_in_cooldown", 300),
+                                     scale_out_cooldown=policy.get("scale_out_cooldown", 60),
+                                     predefined_metric_specification=AppautoscalingPolicyTargetTrackingScalingPolicyConfigurationPredefinedMetricSpecification(
+                                         predefined_metric_type=metric_type,
+                                         resource_label=resource_label)
+                                 ))
+
+        # step scaling - a cloudwatch alarm triggers fixed capacity adjustments
+        step_metrics = {
+            "cpu": ("AWS/ECS", "CPUUtilization", "Average",
+                    {"ClusterName": cluster_name, "ServiceName": ecs_service.name}),
+            "memory": ("AWS/ECS", "MemoryUtilization", "Average",
+                       {"ClusterName": cluster_name, "ServiceName": ecs_service.name}),
+            "api_request_count": ("AWS/ApiGateway", "Count", "Sum",
+                                  {"ApiId": service_config.get("api_gw_id")}),
+            "alb_request_count": ("AWS/ApplicationELB", "RequestCountPerTarget", "Sum",
+                                  {"TargetGroup": target_group.arn_suffix if target_group else None})
+        }
+        for policy in scaling.get("step_scaling", []):
+            namespace, metric_name, statistic, dimensions = step_metrics[policy["metric"]]
+            step_policy = AppautoscalingPolicy(self, f"ScalingPolicy{construct_suffix}_step_{policy['name']}",
+                                               name=f"step-{service_config['service_name']}-{policy['name']}",
+                                               policy_type="StepScaling",
+                                               service_namespace=target.service_namespace,
+                                               scalable_dimension=target.scalable_dimension,
+                                               resource_id=target.resource_id,
+                                               step_scaling_policy_configuration=AppautoscalingPolicyStepScalingPolicyConfiguration(
+                                                   adjustment_type="ChangeInCapacity",
+                                                   cooldown=policy.get("cooldown", 60),
+                                                   metric_aggregation_type="Maximum",
+                                                   step_adjustment=[
+                                                       AppautoscalingPolicyStepScalingPolicyConfigurationStepAdjustment(
+                                                           scaling_adjustment=step["change"],
+                                                           metric_interval_lower_bound=step.get("lower"),
+                                                           metric_interval_upper_bound=step.get("upper"))
+                                                       for step in policy["steps"]
+                                                   ]))
+            CloudwatchMetricAlarm(self, f"ScalingAlarm{construct_suffix}_step_{policy['name']}",
+                                  alarm_name=f"alarm-{service_config['service_name']}-{policy['name']}",
+                                  namespace=namespace,
+                                  metric_name=metric_name,
+                                  statistic=statistic,
+                                  dimensions=dimensions,
+                                  period=policy.get("period", 60),
+                                  evaluation_periods=policy.get("evaluation_periods", 2),
+                                  threshold=policy["threshold"],
+                                  comparison_operator=policy.get("comparison", "GreaterThanOrEqualToThreshold"),
+                                  alarm_actions=[step_policy.arn])
+
+        # scheduled scaling - move the capacity window for known busy hours
+        for action in scaling.get("scheduled", []):
+            AppautoscalingScheduledAction(self, f"ScheduledScaling{construct_suffix}_{action['name']}",
+                                          name=f"schedule-{service_config['service_name']}-{action['name']}",
+                                          service_namespace=target.service_namespace,
+                                          scalable_dimension=target.scalable_dimension,
+                                          resource_id=target.resource_id,
+                                          schedule=action["schedule"],
+                                          timezone=action.get("timezone"),
+                                          scalable_target_action=AppautoscalingScheduledActionScalableTargetAction(
+                                              min_capacity=action["min_capacity"],
+                                              max_capacity=action["max_capacity"]))
+        return target
+
+    def _metrics_sidecar(self, region: str, log_group_name: str, service_config: dict):
+        service_name = service_config["service_name"]
+        metrics = service_config["metrics"]
+        exporter = metrics.get("exporter", "emf")
+
+        # the service container shares the task ENI in awsvpc mode, in bridge mode it is reached through a link
+        awsvpc = service_config.get("network_mode", "bridge") == "awsvpc"
+        scrape_host = "localhost" if awsvpc else service_name
+        scrape_config = {
+            "job_name": service_name,
+            "scrape_interval": metrics.get("interval", "30s"),
+            "metrics_path": metrics.get("path", "/metrics"),
+            "static_configs": [{
+                "targets": [f"{scrape_host}:{metrics['port']}"],
+                "labels": {"service": service_name}
+            }]
+        }
+        collector_config = {
+            "receivers": {"prometheus": {"config": {"scrape_configs": [scrape_config]}}},
+            "processors": {"batch/metrics": {"timeout": "60s"}},
+            "exporters": {},
+            "extensions": {},
+            "service": {"extensions": [], "pipelines": {"metrics": {
+                "receivers": ["prometheus"],
+                "processors": ["batch/metrics"],
+                "exporters": ["awsemf" if exporter == "emf" else "prometheusremotewrite"]
+            }}}
+        }
+        if exporter == "emf":
+            # every sample is kept in the log group, the declarations pick what becomes a cloudwatch metric
+            collector_config["exporters"]["awsemf"] = {
+                "namespace": metrics.get("namespace", "ECS/Services"),
+                "log_group_name": self._metrics_log_group.name,
+                "region": region,
+                "dimension_rollup_option": "NoDimensionRollup",
+                "metric_declarations": metrics.get("metric_declarations", [])
+            }
+        else:
+            collector_config["extensions"]["sigv4auth"] = {"region": region, "service": "aps"}
+            collector_config["service"]["extensions"] = ["sigv4auth"]
+            collector_config["exporters"]["prometheusremotewrite"] = {
+                "endpoint": metrics["amp_remote_write_url"],
+                "auth": {"authenticator": "sigv4auth"}
+            }
+
+        sidecar = {
+            "name": METRICS_CONTAINER,
+            "image": self._initImage(metrics.get("image", ADOT_IMAGE)),
+            "cpu": metrics.get("cpu", 32),
+            "memory": metrics.get("memory", 128),
+            "essential": False,
+            # json is valid yaml
+            "environment": [{"name": "AOT_CONFIG_CONTENT", "value": json.dumps(collector_config)}],
+            "logConfiguration": {
+                "logDriver": "awslogs",
+                "options": {
+                    "awslogs-group": log_group_name,
+                    "awslogs-region": region,
+                    "awslogs-stream-prefix": f"{service_name}-metrics"
+                }
+            }
+        }
+        if not awsvpc:
+            sidecar["links"] = [service_name]
+        return sidecar
+
+    def _log_router_sidecar(self, region: str, log_group_name: str, service_config: dict):
+        service_name = service_config["service_name"]
+        log_router = service_config["log_router"]
+        return {
+            "name": LOG_ROUTER_CONTAINER,
+            "image": self._initImage(log_router.get("image", LOG_ROUTER_IMAGE)),
+            "cpu": log_router.get("cpu", 32),
+            "memory": log_router.get("memory", 128),
+            "essential": True,
+            "firelensConfiguration": {
+                "type": "fluentbit",
+                "options": {
+                    "config-file-type": "file",
+                    "config-file-value": LOG_ROUTER_CONFIG_PATH,
+                    "enable-ecs-log-metadata": "true"
+                }
+            },
+            # the config is rendered into the file included by the FireLens generated config, then the image
+            # entrypoint starts fluent bit
+            "environment": [{"name": "FLUENT_BIT_CONFIG",
+                             "value": fluent_bit_config(region, log_group_name, service_name, log_router)}],
+            "entryPoint": ["/bin/sh", "-c"],
+            "command": [f'printf "%s\\n" "$FLUENT_BIT_CONFIG" > {LOG_ROUTER_CONFIG_PATH} && exec /entrypoint.sh'],
+            # the router's own logs
+            "logConfiguration": {
+                "logDriver": "awslogs",
+                "options": {
+                    "awslogs-group": log_group_name,
+                    "awslogs-region": region,
+                    "awslogs-stream-prefix": f"{service_name}-log-router"
+                }
+            }
+        }
+
+    def _initImage(self, image: str):
+        # upstream image -> regional ECR uri. mirrored tags are pinned by digest, pull-through cached images keep
+        # their tag - the cache repository only exists after the first pull
+        if not self._ecr:
+            return image
+        registry, repository, tag, digest = parse_image(image)
+        mirror = self._ecr.get("mirrors", {}).get(f"{registry}/{repository}")
+        if mirror:
+            if not digest:
+                if (mirror, tag) not in self._ecr_images:
+                    self._ecr_images[(mirror, tag)] = DataAwsEcrImage(self, f"EcrImage_{mirror}_{tag}".replace("/", "_"),
+                                                                      repository_name=mirror,
+                                                                      image_tag=tag)
+                digest = self._ecr_images[(mirror, tag)].image_digest
+            return f"{self._ecr['registry']}/{mirror}@{digest}"
+        prefix = self._ecr.get("pull_through", {}).get(registry)
+        if prefix:
+            return f"{self._ecr['registry']}/{prefix}/{repository}" + (f"@{digest}" if digest else f":{tag}")
+        return image
+
+    def _initIAMRoles(self, service_name: str, log_group_arn: str, media_bucket_arn: str = None,
+                      metrics_config: dict = None, log_router_config: dict = None):
         ### Task Execution Role - Create Polices ###
         # CloudWatch
         policy_doc_cloudwatch_logs = DataAwsIamPolicyDocument(self, "LogsPolicyDoc",
@@ -155,7 +638,10 @@ class EcsServiceStack(ExtendedTerraformStack):
                                                       actions=["ecr:GetAuthorizationToken",
                                                                "ecr:BatchCheckLayerAvailability",
                                                                "ecr:GetDownloadUrlForLayer",
-                                                               "ecr:BatchGetImage"],
+                                                               "ecr:BatchGetImage"] +
+                                                              # the first pull through the cache creates the repository
+                                                              (["ecr:CreateRepository", "ecr:BatchImportUpstreamImage"]
+                                                               if (self._ecr or {}).get("pull_through") else []),
                                                       effect="Allow",
                                                       resources=["*"]
                                                   )])
@@ -200,23 +686,95 @@ class EcsServiceStack(ExtendedTerraformStack):
                                 policy_arn=policy_cloudwatch_logs.arn
                                 )
 
-    def _initServiceDiscovery(self, service_config: dict):
-        self._reg_srv = ServiceDiscoveryService(self, "ServiceDiscovery",
-                                                name=service_config["service_name"],
-                                                dns_config=ServiceDiscoveryServiceDnsConfig(
-                                                    namespace_id=service_config["ns_id"],
-                                                    dns_records=[
-                                                        ServiceDiscoveryServiceDnsConfigDnsRecords(
-                                                            ttl=15,
-                                                            type="SRV")
-                                                    ],
-                                                    routing_policy="MULTIVALUE"
-                                                ),
-                                                health_check_custom_config=ServiceDiscoveryServiceHealthCheckCustomConfig(
-                                                    failure_threshold=1)
-                                                )
-
-    def _initGatewayRoute(self, service_name: str, api_id: str, vpc_link_id: str, service_arn: str, route: str):
+        # S3 - media store, scoped to the media bucket
+        if media_bucket_arn:
+            policy_doc_media = DataAwsIamPolicyDocument(self, "MediaPolicyDoc",
+                                                        statement=[DataAwsIamPolicyDocumentStatement(
+                                                            sid="ListMediaBucket",
+                                                            actions=["s3:ListBucket"],
+                                                            effect="Allow",
+                                                            resources=[media_bucket_arn]
+                                                        ), DataAwsIamPolicyDocumentStatement(
+                                                            sid="ReadWriteMediaObjects",
+                                                            actions=["s3:GetObject",
+                                                                     "s3:PutObject",
+                                                                     "s3:DeleteObject"],
+                                                            effect="Allow",
+                                                            resources=[f"{media_bucket_arn}/*"]
+                                                        )])
+            policy_media = IamPolicy(self, "MediaAccessPolicy",
+                                     name=f"policy-ecs-allow-media-{service_name}",
+                                     description="Allow ECS tasks to read and write the media bucket",
+                                     policy=policy_doc_media.json
+                                     )
+            IamRolePolicyAttachment(self, "TaskRole_AttachPolicy_Media",
+                                    role=self._role_task.name,
+                                    policy_arn=policy_media.arn
+                                    )
+
+        # metrics sidecar - EMF log events or AMP remote write
+        if metrics_config:
+            if metrics_config.get("exporter", "emf") == "emf":
+                metrics_statement = DataAwsIamPolicyDocumentStatement(
+                    sid="PutMetricLogEvents",
+                    actions=["logs:CreateLogStream",
+                             "logs:DescribeLogStreams",
+                             "logs:PutLogEvents"],
+                    effect="Allow",
+                    resources=[f"{self._metrics_log_group.arn}:*"])
+            else:
+                metrics_statement = DataAwsIamPolicyDocumentStatement(
+                    sid="RemoteWriteMetrics",
+                    actions=["aps:RemoteWrite"],
+                    effect="Allow",
+                    resources=[metrics_config["amp_workspace_arn"]])
+            policy_doc_metrics = DataAwsIamPolicyDocument(self, "MetricsPolicyDoc", statement=[metrics_statement])
+            policy_metrics = IamPolicy(self, "MetricsPolicy",
+                                       name=f"policy-ecs-allow-metrics-{service_name}",
+                                       description="Allow the ECS metrics sidecar to publish metrics",
+                                       policy=policy_doc_metrics.json
+                                       )
+            IamRolePolicyAttachment(self, "TaskRole_AttachPolicy_Metrics",
+                                    role=self._role_task.name,
+                                    policy_arn=policy_metrics.arn
+                                    )
+
+        # log router - batches to the log archive firehose stream, cloudwatch goes through the logs policy above
+        if log_router_config:
+            policy_doc_firehose = DataAwsIamPolicyDocument(self, "FirehosePolicyDoc",
+                                                           statement=[DataAwsIamPolicyDocumentStatement(
+                                                               sid="PutLogRecords",
+                                                               actions=["firehose:PutRecordBatch"],
+                                                               effect="Allow",
+                                                               resources=[log_router_config["delivery_stream_arn"]]
+                                                           )])
+            policy_firehose = IamPolicy(self, "FirehosePolicy",
+                                        name=f"policy-ecs-allow-firehose-{service_name}",
+                                        description="Allow the ECS log router to write to the log archive stream",
+                                        policy=policy_doc_firehose.json
+                                        )
+            IamRolePolicyAttachment(self, "TaskRole_AttachPolicy_Firehose",
+                                    role=self._role_task.name,
+                                    policy_arn=policy_firehose.arn
+                                    )
+
+    def _initServiceDiscovery(self, service_config: dict, construct_suffix: str = ""):
+        return ServiceDiscoveryService(self, f"ServiceDiscovery{construct_suffix}",
+                                       name=service_config["service_name"],
+                                       dns_config=ServiceDiscoveryServiceDnsConfig(
+                                           namespace_id=service_config["ns_id"],
+                                           dns_records=[
+                                               ServiceDiscoveryServiceDnsConfigDnsRecords(
+                                                   ttl=15,
+                                                   type="SRV")
+                                           ],
+                                           routing_policy="MULTIVALUE"
+                                       ),
+                                       health_check_custom_config=ServiceDiscoveryServiceHealthCheckCustomConfig(
+                                           failure_threshold=1)
+                                       )
+
+    def _initGatewayRoute(self, service_name: str, api_id: str, vpc_link_id: str, service_arn: str, routes: Sequence[str]):
         integration = Apigatewayv2Integration(self, f"API_Integration_{service_name}",
                                               api_id=api_id,
                                               integration_uri=service_arn,
@@ -224,10 +782,53 @@ class EcsServiceStack(ExtendedTerraformStack):
                                               integration_method="ANY",
                                               connection_type="VPC_LINK",
                                               connection_id=vpc_link_id)
-        Apigatewayv2Route(self, f"API_Route_{service_name}",
-                          api_id=api_id,
-                          route_key=route,
-                          target=f"integrations/{integration.id}")
+        # one route per route key, all sharing the service integration
+        for index, route in enumerate(routes):
+            route_suffix = f"_{index}" if index else ""
+            Apigatewayv2Route(self, f"API_Route_{service_name}{route_suffix}",
+                              api_id=api_id,
+                              route_key=route,
+                              target=f"integrations/{integration.id}")
+
+    def _initTargetGroup(self, service_config: dict, construct_suffix: str = ""):
+        # ECS registers the targets: instance:port pairs in bridge mode (dynamic host ports), task ENIs in awsvpc mode
+        health_check = service_config.get("health_check", {})
+        return LbTargetGroup(self, f"TargetGroup{construct_suffix}",
+                             name=service_config["service_name"][:32],
+                             vpc_id=service_config["vpc_id"],
+                             port=service_config["port"],
+                             protocol="HTTP",
+                             target_type="ip" if service_config.get("network_mode") == "awsvpc" else "instance",
+                             # long-polling /sync requests make round robin uneven
+                             load_balancing_algorithm_type="least_outstanding_requests",
+                             deregistration_delay=str(service_config.get("deregistration_delay", 30)),
+                             health_check=LbTargetGroupHealthCheck(
+                                 path=health_check.get("path", "/health"),
+                                 interval=health_check.get("interval", 15),
+                                 timeout=health_check.get("timeout", 5),
+                                 healthy_threshold=2,
+                                 unhealthy_threshold=health_check.get("retries", 3),
+                                 matcher="200"))
+
+    def _initExtraTargets(self, service_config: dict):
+        # (target group, container port) pairs the service registers its tasks in besides the ingress one
+        return []
+
+    def _initListenerRules(self, service_name: str, listener_arns: dict, target_group_arn: str,
+                           routes: Sequence[str], priority: int):
+        # listener_arns: port -> listener arn. priorities must be unique per listener, rules take consecutive
+        # priorities starting at the given one
+        for port, listener_arn in listener_arns.items():
+            for index, (method, patterns) in enumerate(alb_rule_conditions(routes)):
+                condition = [LbListenerRuleCondition(path_pattern=LbListenerRuleConditionPathPattern(values=patterns))]
+                if method:
+                    condition.append(LbListenerRuleCondition(
+                        http_request_method=LbListenerRuleConditionHttpRequestMethod(values=[method])))
+                LbListenerRule(self, f"ALB_Rule_{service_name}_{port}_{index}",
+                               listener_arn=listener_arn,
+                               priority=priority + index,
+                               action=[LbListenerRuleAction(type="forward", target_group_arn=target_group_arn)],
+                               condition=condition)
 
     @property
     def task_exec_role(self):
@@ -241,6 +842,10 @@ class EcsServiceStack(ExtendedTerraformStack):
     def registry_service(self):
         return self._reg_srv
 
-    # @property
-    # def ecs_service(self):
-    #     return self._ecs_service
+    @property
+    def ecs_service(self):
+        return self._ecs_service
+
+    @property
+    def target_group(self):
+        return self._target_group